@@ -0,0 +1,276 @@
+import queue
+import threading
+import time
+from functools import partial
+from data_generator import consume_batches
+
+WRITE_EVERY = 10
+QUEUE_SIZE_PER_WORKER = 4
+
+def run_indexed(args):
+    """
+    Runs a generation function for a single task and tags the result with
+    the task index so that results can be consumed out of order, together
+    with the time it took to generate it.
+
+    Parameters
+    ----------
+    idx : task index
+    function : generation function
+    function_args : arguments passed to the generation function
+
+    Returns
+    -------
+    idx : task index
+    result : generation function result
+    elapsed : generation time in seconds
+    """
+
+    idx, function, function_args = args
+
+    start = time.perf_counter()
+    result = function(function_args)
+    return idx, result, time.perf_counter() - start
+
+class AsyncWriter:
+    """
+    A class that stores and writes generated data in a dedicated thread.
+
+    Results are passed to the writer thread through a queue and are stored in
+    the wrapped writer in the order of task indices, regardless of the order
+    in which they arrive. Tasks are dispatched only while fewer than
+    `queue_size` results are generated, queued or waiting to be reordered,
+    which puts a hard cap on the memory held by pending results. Every task's
+    region is marked as completed in the wrapped writer once its result is
+    stored, so that it is committed together with its data.
+
+    Tasks run in threads of the same process can stream their batches to the
+    writer thread as they are generated instead. Batches of the task whose
+    result is stored next are stored right away, while batches of later
+    tasks are kept until all earlier tasks are completed. A task is
+    completed once its result, which carries no data, is put after its
+    batches.
+
+    Attributes
+    ----------
+    writer : wrapped .hdf5 data writer
+    regions : regions of tasks, indexed by task index
+    queue_size : maximum number of tasks in flight
+    write_every : number of stored regions after which data is written to disk
+    queue : queue of results passed to the writer thread
+    slots : semaphore limiting the number of tasks in flight
+    stopped : an event set when generation is aborted
+    thread : writer thread
+    error : an exception raised in the writer thread
+    dispatch_stall_time : time spent waiting for a free slot before dispatching a task
+    write_time : time spent in the writer thread storing and writing data
+    max_depth : maximum number of pending results seen by the writer thread
+    total_depth : sum of pending results seen on every received result
+    sent : number of results passed to the writer thread
+    received : number of received results
+    """
+
+    def __init__(self, writer, regions, queue_size, write_every=WRITE_EVERY):
+        """
+        Parameters
+        ----------
+        writer : .hdf5 data writer
+        regions : regions of tasks, indexed by task index
+        queue_size : maximum number of tasks in flight
+        write_every : number of stored regions after which data is written to disk
+        """
+
+        self.writer = writer
+        self.regions = regions
+        self.queue_size = queue_size
+        self.write_every = write_every
+
+        self.queue = queue.Queue(maxsize=queue_size + 1)
+        self.slots = threading.Semaphore(queue_size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.error = None
+
+        self.dispatch_stall_time = 0.0
+        self.write_time = 0.0
+        self.max_depth = 0
+        self.total_depth = 0
+        self.sent = 0
+        self.received = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self.stopped.set()
+        # a failed writer thread no longer empties the queue
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+
+        if type is None:
+            self.__check_error()
+            self.print_stats()
+
+    def tasks(self, function, arguments, stream=False):
+        """
+        Yields indexed tasks, waiting for a free slot before each one.
+
+        Parameters
+        ----------
+        function : generation function
+        arguments : an array of generation function arguments
+        stream : a flag indicating whether the function yields batches,
+            which are streamed to the writer thread by the task
+
+        Returns
+        -------
+        tasks : tasks that can be passed to `run_indexed`
+        """
+
+        for idx, args in enumerate(arguments):
+            start = time.perf_counter()
+            while not self.slots.acquire(timeout=0.1):
+                if self.stopped.is_set() or self.error: return
+            self.dispatch_stall_time += time.perf_counter() - start
+
+            yield idx, partial(self.stream, function, idx) if stream else function, args
+
+    def stream(self, function, idx, args):
+        """
+        Runs a generation function yielding batches and passes every batch to
+        the writer thread as soon as it is generated.
+
+        Parameters
+        ----------
+        function : generation function yielding batches
+        idx : task index
+        args : generation function arguments
+
+        Returns
+        -------
+        result : the value returned by the generation function, which has to
+            be put once it is received
+        """
+
+        return consume_batches(function(args), lambda batch: self.__put((idx, batch, False)))
+
+    def put(self, idx, result):
+        """
+        Passes a result to the writer thread, completing its task.
+
+        Parameters
+        ----------
+        idx : task index
+        result : generation function result
+        """
+
+        self.__put((idx, result, True))
+        self.sent += 1
+
+    def print_stats(self):
+        """
+        Prints queue depth and stall time statistics.
+        """
+
+        mean_depth = self.total_depth / self.received if self.received else 0
+        print(f'>> writer queue depth - max: {self.max_depth}/{self.queue_size}, mean: {mean_depth:.2f}')
+        print(f'>> task dispatch blocked on full queue: {self.dispatch_stall_time:.2f}s, writer busy: {self.write_time:.2f}s')
+
+    def __check_error(self):
+        """
+        Raises an exception raised in the writer thread, if any.
+        """
+
+        if self.error: raise RuntimeError('Writer thread failed.') from self.error
+
+    def __put(self, item):
+        """
+        Puts an item in the queue, waiting for free space unless the writer
+        thread failed or generation is aborted.
+        """
+
+        while True:
+            self.__check_error()
+            if self.stopped.is_set(): raise RuntimeError('Generation was aborted.')
+
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __run(self):
+        """
+        Receives results, reorders them and stores them in the wrapped writer.
+        """
+
+        # batches received for every task and a flag indicating whether the
+        # task is completed
+        pending = dict()
+        next_idx = 0
+        regions_finished = 0
+        # a flag indicating whether data was stored for the next task
+        stored = False
+
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None: break
+
+                idx, result, completed = item
+                batches, _ = pending.get(idx, ([], False))
+                if result: batches.append(result)
+                pending[idx] = (batches, completed)
+
+                if completed:
+                    self.received += 1
+
+                    # results still in the queue are counted from results sent,
+                    # since its size also counts the shutdown sentinel
+                    depth = len(pending) + max(self.sent - self.received, 0)
+                    self.max_depth = max(self.max_depth, depth)
+                    self.total_depth += depth
+
+                while next_idx in pending:
+                    batches, completed = pending[next_idx]
+
+                    start = time.perf_counter()
+                    for batch in batches: self.writer.store(batch)
+                    stored = stored or bool(batches)
+                    batches.clear()
+
+                    if not completed:
+                        self.write_time += time.perf_counter() - start
+                        break
+
+                    del pending[next_idx]
+                    next_idx += 1
+
+                    if stored: regions_finished += 1
+                    self.writer.complete(str(self.regions[next_idx - 1]))
+
+                    if stored and regions_finished % self.write_every == 0:
+                        print(f'>> writing to disk started')
+                        self.writer.write()
+                        print(f'>> writing to disk finished')
+                    stored = False
+                    self.write_time += time.perf_counter() - start
+
+                    self.slots.release()
+
+            if self.stopped.is_set(): return
+            assert not pending
+
+            start = time.perf_counter()
+            self.writer.write()
+            self.write_time += time.perf_counter() - start
+
+        except BaseException as e:
+            self.error = e
@@ -0,0 +1,896 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from types import SimpleNamespace
+import numpy as np
+import pysam
+import torch
+from Bio import SeqIO
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from collections import namedtuple
+from data_generator import generate_regions, filter_aligns, generate_train_data, generate_inference_data, TargetAlign, AlignIndex
+from export import export, SHARD_SIZE
+from dataset import InferenceDataset, TrainDataset, InMemoryTrainDataset, MemmapTrainDataset, BlockShuffleSampler, batch_loader, BLOCK_SIZE, MEMORY_STORAGES, PRIVATE_STORAGE
+from geometry import GEOMETRIES
+from hdf5_writer import TrainHDF5Writer, InferenceHDF5Writer, get_segment_dir
+from hdf5_options import HDF5Options, DEFAULT_HDF5_OPTIONS, COMPRESSIONS, check_hdf5_options
+import gen
+
+SyntheticAlign = namedtuple('SyntheticAlign', ['reference_start', 'reference_length'])
+
+def load_refs(ref_path):
+    """
+    Loads reference sequences from the provided FASTA file.
+
+    Parameters
+    ----------
+    ref_path : path to a draft assembly in FASTA format
+
+    Returns
+    -------
+    refs : a dictionary of reference sequences
+    """
+
+    with open(ref_path, 'r') as ref_file:
+        return {str(r.id): str(r.seq) for r in SeqIO.parse(ref_file, 'fasta')}
+
+def time_regions(bam, refs, regions):
+    """
+    Generates features for every provided region and measures elapsed time.
+
+    Parameters
+    ----------
+    bam : path to the aligned reads file or an opened `gen.BAMFile`
+    refs : a dictionary of reference sequences
+    regions : regions for which features are generated
+
+    Returns
+    -------
+    elapsed : an array of elapsed times in seconds, one per region
+    windows : total number of generated windows
+    """
+
+    elapsed = []
+    windows = 0
+    for region in regions:
+        region_string = f'{region.name}:{region.start + 1}-{region.end}'
+
+        start = time.perf_counter()
+        positions, _ = gen.generate_features(bam, refs[region.name], region_string)
+        elapsed.append(time.perf_counter() - start)
+
+        windows += len(positions)
+
+    return elapsed, windows
+
+def benchmark_bam_reuse(args):
+    """
+    Compares per-region feature generation time when the BAM file, index and
+    header are reopened for every region against reusing a single `gen.BAMFile`.
+    """
+
+    refs = load_refs(args.ref_path)
+
+    regions = []
+    for ref_name, ref in refs.items():
+        regions.extend(generate_regions(len(ref), ref_name, window=args.region_size, overlap=0))
+    regions = regions[:args.num_regions]
+
+    reopened, windows = time_regions(args.reads_path, refs, regions)
+
+    start = time.perf_counter()
+    bam_file = gen.BAMFile(args.reads_path)
+    open_time = time.perf_counter() - start
+    reused, _ = time_regions(bam_file, refs, regions)
+
+    reopened_mean = sum(reopened) / len(regions)
+    reused_mean = sum(reused) / len(regions)
+
+    print(f'>> regions: {len(regions)}, region size: {args.region_size}, windows: {windows}')
+    print(f'>> reopened BAM file: {1000 * reopened_mean:.3f} ms per region')
+    print(f'>> reused BAM file:   {1000 * reused_mean:.3f} ms per region (+ {1000 * open_time:.3f} ms to open once)')
+    print(f'>> per-region overhead removed: {1000 * (reopened_mean - reused_mean):.3f} ms')
+
+def synthesize_aligns(num_aligns, mean_len, rng):
+    """
+    Synthesizes fragmented truth aligns with random starts and lengths.
+
+    Parameters
+    ----------
+    num_aligns : number of aligns
+    mean_len : mean align length
+    rng : random number generator
+
+    Returns
+    -------
+    aligns : aligns ordered by reference start
+    """
+
+    starts = np.sort(rng.integers(0, num_aligns * mean_len // 2, num_aligns))
+    lengths = rng.integers(mean_len // 10, 2 * mean_len, num_aligns)
+
+    return [
+        TargetAlign(SyntheticAlign(int(s), int(l)), int(s), int(s + l))
+        for s, l in zip(starts, lengths)
+    ]
+
+def benchmark_filter_aligns(args):
+    """
+    Measures truth align filtering and region membership lookups on
+    synthetic fragmented truth aligns of increasing size.
+    """
+
+    rng = np.random.default_rng(args.seed)
+
+    for num_aligns in args.num_aligns:
+        aligns = synthesize_aligns(num_aligns, args.mean_len, rng)
+
+        start = time.perf_counter()
+        filtered_aligns = filter_aligns(aligns)
+        filter_time = time.perf_counter() - start
+
+        positions = rng.integers(0, num_aligns * args.mean_len // 2, args.num_positions)
+
+        start = time.perf_counter()
+        align_index = AlignIndex(filtered_aligns)
+        contained = align_index.contains(positions)
+        index_time = time.perf_counter() - start
+
+        sample = positions[:args.num_positions // 100]
+        start = time.perf_counter()
+        for p in sample:
+            any(a.start <= p < a.end for a in filtered_aligns)
+        scan_time = (time.perf_counter() - start) * len(positions) / max(len(sample), 1)
+
+        print(f'>> aligns: {num_aligns}, kept: {len(filtered_aligns)}, filtering: {1000 * filter_time:.2f} ms')
+        print(f'>> membership of {len(positions)} positions ({contained.mean():.2%} contained) - '
+            f'index: {1000 * index_time:.2f} ms, linear scan (estimated): {1000 * scan_time:.2f} ms')
+
+BASES = np.array(list('ACGT'))
+
+def simulate_read(ref, start, end, error_rate, rng):
+    """
+    Simulates a read aligned to the provided part of the reference with
+    substitution, insertion and deletion errors.
+
+    Parameters
+    ----------
+    ref : reference sequence
+    start : read start
+    end : read end
+    error_rate : probability of an error at every position
+    rng : random number generator
+
+    Returns
+    -------
+    seq : read sequence
+    cigar : cigar tuples of the read, starting and ending with a match
+    """
+
+    errors = rng.random(end - start)
+    seq, cigar = [], []
+    for i, e in zip(range(start, end), errors):
+        if e < error_rate / 3:
+            op, bases = 0, BASES[rng.integers(4)]
+        elif e < 2 * error_rate / 3:
+            op, bases = 1, BASES[rng.integers(4)] + ref[i]
+        elif e < error_rate and cigar:
+            op, bases = 2, ''
+        else:
+            op, bases = 0, ref[i]
+
+        seq.append(bases)
+        if op == 1:
+            cigar.extend(((1, 1), (0, 1)))
+        elif cigar and cigar[-1][0] == op:
+            cigar[-1] = (op, cigar[-1][1] + 1)
+        else:
+            cigar.append((op, 1))
+
+    if cigar[-1][0] == 2: cigar.pop()
+    return ''.join(seq), cigar
+
+def simulate_reads(ref, depth, read_len, error_rate, rng):
+    """
+    Simulates reads sampled uniformly from the reference with substitution,
+    insertion and deletion errors.
+
+    Parameters
+    ----------
+    ref : reference sequence
+    depth : mean read depth
+    read_len : mean read length
+    error_rate : probability of an error at every position
+    rng : random number generator
+
+    Returns
+    -------
+    reads : an array of read starts, strands, sequences and cigar tuples, ordered by start
+    """
+
+    reads = []
+    for _ in range(len(ref) * depth // read_len):
+        start = int(rng.integers(0, len(ref) - read_len // 10))
+        end = min(start + int(rng.integers(read_len // 2, 3 * read_len // 2)), len(ref))
+
+        seq, cigar = simulate_read(ref, start, end, error_rate, rng)
+        reads.append((start, bool(rng.random() < 0.5), seq, cigar))
+
+    reads.sort(key=lambda r: r[0])
+    return reads
+
+def write_reads(path, ref_name, ref, reads):
+    """
+    Writes simulated reads in a sorted and indexed BAM file.
+
+    Parameters
+    ----------
+    path : path to the output BAM file
+    ref_name : reference name
+    ref : reference sequence
+    reads : reads returned by `simulate_reads`
+    """
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': ref_name, 'LN': len(ref)}]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as reads_file:
+        for i, (start, rev, seq, cigar) in enumerate(reads):
+            read = pysam.AlignedSegment()
+            read.query_name = f'read_{i}'
+            read.query_sequence = seq
+            read.flag = 16 if rev else 0
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            reads_file.write(read)
+
+    pysam.index(path)
+
+def benchmark_features(args):
+    """
+    Measures feature generation throughput in pileup columns per second on
+    simulated reads of increasing depth.
+    """
+
+    geometry = GEOMETRIES[args.geometry]
+    rng = np.random.default_rng(args.seed)
+    ref = ''.join(BASES[rng.integers(0, 4, args.length)])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for depth in args.depths:
+            reads_path = os.path.join(tmp_dir, f'reads_{depth}.bam')
+            write_reads(reads_path, 'ref', ref, simulate_reads(ref, depth, args.read_len, args.error_rate, rng))
+
+            bam_file = gen.BAMFile(reads_path)
+            elapsed = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                positions, _ = gen.generate_features(bam_file, ref, f'ref:1-{args.length}', **geometry._asdict())
+                elapsed.append(time.perf_counter() - start)
+
+            columns = len(np.unique(positions.reshape(-1, 2), axis=0))
+            best = min(elapsed)
+            print(f'>> depth: {depth}, columns: {columns}, windows: {len(positions)} - '
+                f'{columns / best:,.0f} columns/s, {len(positions) / best:,.0f} windows/s')
+
+def benchmark_max_depth(args):
+    """
+    Measures feature generation time on a deep simulated region with reads
+    downsampled to different maximum depths as they enter the pileup.
+    """
+
+    geometry = GEOMETRIES[args.geometry]
+    rng = np.random.default_rng(args.seed)
+    ref = ''.join(BASES[rng.integers(0, 4, args.length)])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reads_path = os.path.join(tmp_dir, 'reads.bam')
+        write_reads(reads_path, 'ref', ref, simulate_reads(ref, args.depth, args.read_len, args.error_rate, rng))
+
+        bam_file = gen.BAMFile(reads_path)
+        baseline = None
+        for max_depth in args.max_depths:
+            elapsed = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                features = gen.FeatureIterator(bam_file, ref, f'ref:1-{args.length}', max_depth=max_depth, **geometry._asdict())
+                windows = sum(len(positions) for positions, _ in features)
+                elapsed.append(time.perf_counter() - start)
+
+            stats = features.stats
+            best = min(elapsed)
+            if baseline is None: baseline = best
+            print(f'>> max depth: {max_depth or "none"}, skipped reads: {stats["skipped_reads"]}, '
+                f'pileup depth - mean: {stats["depth_sum"] / max(stats["positions"], 1):.1f}, max: {stats["max_depth"]}, '
+                f'windows: {windows} - {best:.2f}s, {windows / best:,.0f} windows/s, speedup: {baseline / best:.2f}x')
+
+def write_ref(path, ref_name, ref):
+    """
+    Writes a reference sequence in an indexed FASTA file.
+
+    Parameters
+    ----------
+    path : path to the output FASTA file
+    ref_name : reference name
+    ref : reference sequence
+    """
+
+    with open(path, 'w') as ref_file:
+        ref_file.write(f'>{ref_name}\n{ref}\n')
+
+    pysam.faidx(path)
+
+def synthesize_data(data_dir, args, rng):
+    """
+    Synthesizes a draft assembly, reads aligned to it and an alignment of
+    the truth genome, from which the draft differs at `truth_error_rate` of
+    positions.
+
+    Parameters
+    ----------
+    data_dir : directory in which files are written
+    args : benchmark arguments
+    rng : random number generator
+
+    Returns
+    -------
+    ref_path : path to the draft assembly
+    reads_path : path to the aligned reads file
+    truth_genome_path : path to the truth genome alignment
+    """
+
+    ref = ''.join(BASES[rng.integers(0, 4, args.length)])
+
+    ref_path = os.path.join(data_dir, 'ref.fasta')
+    write_ref(ref_path, 'ref', ref)
+
+    reads_path = os.path.join(data_dir, 'reads.bam')
+    write_reads(reads_path, 'ref', ref, simulate_reads(ref, args.depth, args.read_len, args.error_rate, rng))
+
+    truth_genome_path = os.path.join(data_dir, 'truth.bam')
+    seq, cigar = simulate_read(ref, 0, len(ref), args.truth_error_rate, rng)
+    write_reads(truth_genome_path, 'ref', ref, [(0, False, seq, cigar)])
+
+    return ref_path, reads_path, truth_genome_path
+
+def write_train_data(train_path, ref, ref_path, reads_path, truth_genome_path, geometry):
+    """
+    Generates training data of the whole synthetic contig.
+
+    Parameters
+    ----------
+    train_path : path to the written training data file
+    ref : draft assembly sequence
+    ref_path : path to the draft assembly
+    reads_path : path to the aligned reads file
+    truth_genome_path : path to the truth genome alignment
+    geometry : geometry of generated windows
+
+    Returns
+    -------
+    windows : number of written windows
+    """
+
+    with TrainHDF5Writer(train_path, geometry=geometry) as writer:
+        writer.write_contigs([('ref', ref)])
+        windows = 0
+        for region in generate_regions(len(ref), 'ref'):
+            result = generate_train_data((reads_path, truth_genome_path, ref_path, geometry, 0, region))
+            if result is None: continue
+            writer.store(result)
+            windows += len(result[1])
+        writer.write()
+
+    return windows
+
+def measure(name, function, count, unit):
+    """
+    Measures the throughput of the provided function.
+
+    Parameters
+    ----------
+    name : name of the measurement
+    function : measured function returning the number of processed units
+    count : number of measurements, the fastest one is reported
+    unit : name of processed units
+
+    Returns
+    -------
+    result : a dictionary holding the number of processed units, elapsed
+        time of the fastest measurement and throughput
+    """
+
+    best, processed = None, 0
+    for _ in range(count):
+        start = time.perf_counter()
+        processed = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    throughput = processed / best if best > 0 else 0.0
+    print(f'>> {name}: {processed} {unit} in {best:.3f}s - {throughput:,.1f} {unit}/s')
+    return {unit: processed, 'seconds': best, f'{unit}_per_second': throughput}
+
+def data_files(path):
+    """
+    Returns paths to the provided file and its segment files, or to all files
+    in the provided directory.
+    """
+
+    if os.path.isdir(path): return [entry.path for entry in os.scandir(path) if entry.is_file()]
+
+    segment_dir = get_segment_dir(path)
+    return [path] + (data_files(segment_dir) if os.path.isdir(segment_dir) else [])
+
+def evict(path):
+    """
+    Evicts the provided file and its segment files, or all files in the
+    provided directory, from the page cache, so that they are read from the
+    disk. Only supported on Linux, elsewhere files are left cached.
+    """
+
+    if not hasattr(os, 'posix_fadvise'): return
+
+    for file_path in data_files(path):
+        with open(file_path, 'rb') as f:
+            os.fdatasync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def prepare_train_data(data_dir, args):
+    """
+    Returns path to the training data of a benchmark, which is synthesized
+    as in the `suite` benchmark unless provided.
+
+    Parameters
+    ----------
+    data_dir : directory in which synthesized files are written
+    args : benchmark arguments
+
+    Returns
+    -------
+    train_path : path to the training data
+    """
+
+    if args.train_path is not None: return args.train_path
+
+    rng = np.random.default_rng(args.seed)
+    geometry = GEOMETRIES[args.geometry]
+    ref_path, reads_path, truth_genome_path = synthesize_data(data_dir, args, rng)
+    with pysam.FastaFile(ref_path) as ref_file:
+        ref = ref_file.fetch('ref')
+
+    train_path = os.path.join(data_dir, 'train.hdf5')
+    write_train_data(train_path, ref, ref_path, reads_path, truth_genome_path, geometry)
+    return train_path
+
+def benchmark_loader(args):
+    """
+    Measures training data loader throughput in samples per second when
+    samples are uniformly shuffled and read one at a time, as they were
+    before block shuffling, against uniform and block shuffling with
+    batched reads, and sequential batched reads as an upper bound.
+    """
+
+    torch.manual_seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        train_path = prepare_train_data(tmp_dir, args)
+        dataset = TrainDataset(train_path)
+        print(f'>> samples: {len(dataset)}, groups: {len(dataset.group_names)}, page cache: {"cold" if args.cold else "warm"}')
+
+        loaders = {
+            'random, per sample': lambda: DataLoader(
+                dataset, args.batch_size, sampler=RandomSampler(dataset), num_workers=args.num_workers
+            ),
+            'random, batched': lambda: batch_loader(dataset, args.batch_size, RandomSampler(dataset), args.num_workers),
+        }
+        for block_size in args.block_sizes:
+            loaders[f'blocks of {block_size}, batched'] = lambda block_size=block_size: batch_loader(
+                dataset, args.batch_size, BlockShuffleSampler(dataset, block_size), args.num_workers
+            )
+        loaders['sequential, batched'] = lambda: batch_loader(
+            dataset, args.batch_size, SequentialSampler(dataset), args.num_workers
+        )
+
+        baseline = None
+        for name, loader in loaders.items():
+            def load_data():
+                if args.cold: evict(train_path)
+                samples = 0
+                for i, (X, _) in enumerate(loader()):
+                    if i == args.num_batches: break
+                    samples += len(X)
+                return samples
+
+            result = measure(name, load_data, args.repeats, 'samples')
+            if baseline is None: baseline = result['samples_per_second']
+            print(f'>> {name}: speedup: {result["samples_per_second"] / baseline:.2f}x')
+
+def benchmark_epoch(args):
+    """
+    Measures the time of a training epoch over data read from .hdf5 files
+    with uniform and block shuffling, loaded into RAM and exported to the
+    flat format and memory mapped, together with the one-time cost of
+    loading or exporting data.
+    """
+
+    torch.manual_seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        train_path = prepare_train_data(tmp_dir, args)
+
+        flat_path = os.path.join(tmp_dir, 'flat')
+        start = time.perf_counter()
+        export(train_path, flat_path, args.shard_size)
+        print(f'>> export: {time.perf_counter() - start:.2f}s')
+
+        # datasets are created together with their samplers, so that the
+        # time of loading data into RAM is reported
+        configurations = {
+            'hdf5, uniform shuffle': (train_path, lambda: TrainDataset(train_path), RandomSampler),
+            'hdf5, block shuffle': (
+                train_path, lambda: TrainDataset(train_path), lambda dataset: BlockShuffleSampler(dataset, args.block_size)
+            ),
+            'in memory': (None, lambda: InMemoryTrainDataset(train_path, args.memory_storage), RandomSampler),
+            'memmap': (flat_path, lambda: MemmapTrainDataset(flat_path), RandomSampler),
+        }
+
+        for name, (data_path, create_dataset, create_sampler) in configurations.items():
+            start = time.perf_counter()
+            dataset = create_dataset()
+            print(f'>> {name}: setup: {time.perf_counter() - start:.2f}s')
+
+            def epoch(dataset=dataset, data_path=data_path, create_sampler=create_sampler):
+                if args.cold and data_path is not None: evict(data_path)
+                # data is loaded as by `DataModule`
+                if isinstance(dataset, TrainDataset):
+                    loader = batch_loader(dataset, args.batch_size, create_sampler(dataset), args.num_workers)
+                else:
+                    loader = DataLoader(dataset, args.batch_size, sampler=create_sampler(dataset), num_workers=args.num_workers)
+                return sum(len(X) for X, _ in loader)
+
+            measure(f'{name} epoch', epoch, args.repeats, 'samples')
+
+def parse_options_spec(spec, compression_level):
+    """
+    Parses chunking and filters of a benchmarked configuration, written as
+    `<chunk_size>[:<compression>][:shuffle]`, e.g. `16:gzip:shuffle`.
+
+    Parameters
+    ----------
+    spec : configuration specification
+    compression_level : compression level of the `gzip` filter
+
+    Returns
+    -------
+    options : `HDF5Options` object
+    """
+
+    chunk_size, *filters = spec.split(':')
+    unknown = [f for f in filters if f not in COMPRESSIONS and f != 'shuffle']
+    if unknown: raise ValueError(f'Unknown filters {unknown} in {spec}.')
+
+    compressions = [f for f in filters if f in COMPRESSIONS]
+    options = HDF5Options(
+        chunk_size=int(chunk_size),
+        compression=compressions[0] if compressions else None,
+        compression_level=compression_level,
+        shuffle='shuffle' in filters,
+    )
+    check_hdf5_options(options)
+    return options
+
+def benchmark_hdf5_options(args):
+    """
+    Measures file size, write time and uniformly shuffled, block shuffled
+    and sequential read throughput through `TrainDataset` of training data
+    written with different chunking and filters.
+    """
+
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    geometry = GEOMETRIES[args.geometry]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref_path, reads_path, truth_genome_path = synthesize_data(tmp_dir, args, rng)
+        with pysam.FastaFile(ref_path) as ref_file:
+            ref = ref_file.fetch('ref')
+
+        # data is generated once, so that only writing is measured
+        results = [
+            generate_train_data((reads_path, truth_genome_path, ref_path, geometry, 0, region))
+            for region in generate_regions(len(ref), 'ref')
+        ]
+        results = [result for result in results if result is not None]
+
+        for idx, spec in enumerate(args.configs):
+            options = parse_options_spec(spec, args.compression_level)
+            train_path = os.path.join(tmp_dir, f'train_{idx}.hdf5')
+
+            # a write per region, as regions are written by `generate.py`
+            start = time.perf_counter()
+            with TrainHDF5Writer(train_path, geometry=geometry, options=options) as writer:
+                writer.write_contigs([('ref', ref)])
+                for result in results:
+                    writer.store(result)
+                    writer.write()
+            write_time = time.perf_counter() - start
+
+            dataset = TrainDataset(train_path)
+            print(f'>> {spec}: file size: {sum(map(os.path.getsize, data_files(train_path))) / 2**20:,.1f} MB, write: {write_time:.2f}s, '
+                f'{len(dataset) / write_time:,.0f} windows/s')
+
+            samplers = {
+                'uniform shuffle': RandomSampler,
+                'block shuffle': lambda dataset: BlockShuffleSampler(dataset, args.block_size),
+                'sequential': SequentialSampler,
+            }
+            for name, create_sampler in samplers.items():
+                def load_data():
+                    if args.cold: evict(train_path)
+                    loader = batch_loader(dataset, args.batch_size, create_sampler(dataset), args.num_workers)
+                    samples = 0
+                    for i, (X, _) in enumerate(loader):
+                        if i == args.num_batches: break
+                        samples += len(X)
+                    return samples
+
+                measure(f'{spec}, {name}', load_data, args.repeats, 'samples')
+
+def benchmark_suite(args):
+    """
+    Measures throughput of every stage of the pipeline on synthetic data:
+    windows per second of feature generation, labelled windows per second
+    of train data generation, samples per second of the training data loader
+    and training steps, and polished bases per second of inference. Results
+    are written in JSON format and compared with a previous run if provided.
+    """
+
+    # these modules import pytorch_lightning, which the other benchmarks do
+    # not need
+    from data_module import DataModule
+    from inference import polish_contigs
+    from model import RNN
+
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    geometry = GEOMETRIES[args.geometry]
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ref_path, reads_path, truth_genome_path = synthesize_data(tmp_dir, args, rng)
+        with pysam.FastaFile(ref_path) as ref_file:
+            ref = ref_file.fetch('ref')
+        regions = list(generate_regions(len(ref), 'ref'))
+
+        def generate_features():
+            bam_file = gen.BAMFile(reads_path)
+            return sum(
+                len(gen.generate_features(bam_file, ref, f'ref:{r.start + 1}-{r.end}', **geometry._asdict())[0])
+                for r in regions
+            )
+
+        results['generate_features'] = measure('generate_features', generate_features, args.repeats, 'windows')
+
+        train_path = os.path.join(tmp_dir, 'train.hdf5')
+        def train_data():
+            return write_train_data(train_path, ref, ref_path, reads_path, truth_genome_path, geometry)
+
+        results['generate_train_data'] = measure('generate_train_data', train_data, 1, 'labels')
+
+        data_module = DataModule(SimpleNamespace(
+            train_path=train_path, val_path=None, batch_size=args.batch_size, num_workers=args.num_workers,
+            memory=args.memory, memory_storage=args.memory_storage, mmap_dir=None, block_size=args.block_size
+        ))
+        data_module.setup()
+        batches = args.num_batches
+
+        def load_data():
+            samples = 0
+            for i, (X, _) in enumerate(data_module.train_dataloader()):
+                if i == batches: break
+                samples += len(X)
+            return samples
+
+        results['data_loader'] = measure('data loader', load_data, 1, 'samples')
+
+        model = RNN(rows=geometry.rows, cols=geometry.cols)
+        optimizer = model.configure_optimizers()
+        model.train()
+
+        def train_steps():
+            samples = 0
+            for i, batch in enumerate(data_module.train_dataloader()):
+                if i == batches: break
+                loss = model.training_step(batch, i)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                samples += len(batch[0])
+            return samples
+
+        results['training_step'] = measure('training step', train_steps, 1, 'samples')
+
+        inference_path = os.path.join(tmp_dir, 'inference.hdf5')
+        inference_region = next(generate_regions(len(ref), 'ref', window=args.inference_length))
+        with InferenceHDF5Writer(inference_path, geometry=geometry) as writer:
+            writer.write_contigs([('ref', ref)])
+            writer.store(generate_inference_data((reads_path, ref_path, geometry, 0, inference_region)))
+            writer.write()
+
+        model.eval()
+        def inference():
+            with torch.no_grad():
+                polish_contigs(model, InferenceDataset(inference_path), args.batch_size, args.num_workers)
+            return inference_region.end - inference_region.start
+
+        results['inference'] = measure('inference', inference, 1, 'bases')
+
+    report = {
+        'config': {name: value for name, value in vars(args).items() if name != 'func'},
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+
+    if args.out_path:
+        with open(args.out_path, 'w') as out_file:
+            json.dump(report, out_file, indent=4)
+
+    if args.baseline_path:
+        with open(args.baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        ignored = ('out_path', 'baseline_path')
+        changed = [
+            name for name, value in report['config'].items()
+            if name not in ignored and baseline['config'].get(name) != value
+        ]
+        if changed: print(f'>> baseline was run with different options: {", ".join(changed)}')
+        compare_results(baseline['results'], results)
+
+def compare_results(baseline, results):
+    """
+    Prints throughput changes relative to a baseline run.
+
+    Parameters
+    ----------
+    baseline : results of the baseline run
+    results : results of the current run
+    """
+
+    for name, result in results.items():
+        if name not in baseline: continue
+
+        key = next(k for k in result if k.endswith('_per_second'))
+        before, after = baseline[name].get(key), result[key]
+        if not before: continue
+
+        print(f'>> {name}: {before:,.1f} -> {after:,.1f} {key.replace("_", " ")} ({after / before - 1:+.1%})')
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    bam_reuse = subparsers.add_parser('bam_reuse')
+    bam_reuse.add_argument('--reads_path', type=str)
+    bam_reuse.add_argument('--ref_path', type=str)
+    bam_reuse.add_argument('--region_size', type=int, default=1_000)
+    bam_reuse.add_argument('--num_regions', type=int, default=100)
+    bam_reuse.set_defaults(func=benchmark_bam_reuse)
+
+    filter_aligns_parser = subparsers.add_parser('filter_aligns')
+    filter_aligns_parser.add_argument('--num_aligns', type=int, nargs='+', default=[1_000, 5_000, 20_000])
+    filter_aligns_parser.add_argument('--mean_len', type=int, default=20_000)
+    filter_aligns_parser.add_argument('--num_positions', type=int, default=1_000_000)
+    filter_aligns_parser.add_argument('--seed', type=int, default=0)
+    filter_aligns_parser.set_defaults(func=benchmark_filter_aligns)
+
+    features = subparsers.add_parser('features')
+    features.add_argument('--depths', type=int, nargs='+', default=[10, 50, 100, 200])
+    features.add_argument('--length', type=int, default=50_000)
+    features.add_argument('--read_len', type=int, default=5_000)
+    features.add_argument('--error_rate', type=float, default=0.1)
+    features.add_argument('--repeats', type=int, default=3)
+    features.add_argument('--seed', type=int, default=0)
+    features.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    features.set_defaults(func=benchmark_features)
+
+    max_depth = subparsers.add_parser('max_depth')
+    max_depth.add_argument('--max_depths', type=int, nargs='+', default=[0, 1000, 500, 200])
+    max_depth.add_argument('--depth', type=int, default=1000)
+    max_depth.add_argument('--length', type=int, default=10_000)
+    max_depth.add_argument('--read_len', type=int, default=2_000)
+    max_depth.add_argument('--error_rate', type=float, default=0.1)
+    max_depth.add_argument('--repeats', type=int, default=3)
+    max_depth.add_argument('--seed', type=int, default=0)
+    max_depth.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    max_depth.set_defaults(func=benchmark_max_depth)
+
+    loader = subparsers.add_parser('loader')
+    loader.add_argument('--train_path', type=str, default=None)
+    loader.add_argument('--length', type=int, default=200_000)
+    loader.add_argument('--depth', type=int, default=30)
+    loader.add_argument('--read_len', type=int, default=5_000)
+    loader.add_argument('--error_rate', type=float, default=0.1)
+    loader.add_argument('--truth_error_rate', type=float, default=0.01)
+    loader.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    loader.add_argument('--batch_size', type=int, default=128)
+    loader.add_argument('--num_batches', type=int, default=20)
+    loader.add_argument('--num_workers', type=int, default=0)
+    loader.add_argument('--block_sizes', type=int, nargs='+', default=[4, BLOCK_SIZE, 64])
+    loader.add_argument('--cold', action='store_true')
+    loader.add_argument('--repeats', type=int, default=3)
+    loader.add_argument('--seed', type=int, default=0)
+    loader.set_defaults(func=benchmark_loader)
+
+    epoch = subparsers.add_parser('epoch')
+    epoch.add_argument('--train_path', type=str, default=None)
+    epoch.add_argument('--length', type=int, default=100_000)
+    epoch.add_argument('--depth', type=int, default=30)
+    epoch.add_argument('--read_len', type=int, default=5_000)
+    epoch.add_argument('--error_rate', type=float, default=0.1)
+    epoch.add_argument('--truth_error_rate', type=float, default=0.01)
+    epoch.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    epoch.add_argument('--batch_size', type=int, default=128)
+    epoch.add_argument('--num_workers', type=int, default=0)
+    epoch.add_argument('--block_size', type=int, default=BLOCK_SIZE)
+    epoch.add_argument('--memory_storage', type=str, choices=MEMORY_STORAGES, default=PRIVATE_STORAGE)
+    epoch.add_argument('--shard_size', type=int, default=SHARD_SIZE)
+    epoch.add_argument('--cold', action='store_true')
+    epoch.add_argument('--repeats', type=int, default=3)
+    epoch.add_argument('--seed', type=int, default=0)
+    epoch.set_defaults(func=benchmark_epoch)
+
+    hdf5_options = subparsers.add_parser('hdf5_options')
+    hdf5_options.add_argument('--configs', type=str, nargs='+', default=['1', '16', '16:lzf', '16:lzf:shuffle', '16:gzip', '16:gzip:shuffle', '64:gzip:shuffle'])
+    hdf5_options.add_argument('--compression_level', type=int, default=DEFAULT_HDF5_OPTIONS.compression_level)
+    hdf5_options.add_argument('--length', type=int, default=100_000)
+    hdf5_options.add_argument('--depth', type=int, default=30)
+    hdf5_options.add_argument('--read_len', type=int, default=5_000)
+    hdf5_options.add_argument('--error_rate', type=float, default=0.1)
+    hdf5_options.add_argument('--truth_error_rate', type=float, default=0.01)
+    hdf5_options.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    hdf5_options.add_argument('--batch_size', type=int, default=128)
+    hdf5_options.add_argument('--num_batches', type=int, default=20)
+    hdf5_options.add_argument('--num_workers', type=int, default=0)
+    hdf5_options.add_argument('--block_size', type=int, default=BLOCK_SIZE)
+    hdf5_options.add_argument('--cold', action='store_true')
+    hdf5_options.add_argument('--repeats', type=int, default=3)
+    hdf5_options.add_argument('--seed', type=int, default=0)
+    hdf5_options.set_defaults(func=benchmark_hdf5_options)
+
+    suite = subparsers.add_parser('suite')
+    suite.add_argument('--length', type=int, default=200_000)
+    suite.add_argument('--depth', type=int, default=30)
+    suite.add_argument('--read_len', type=int, default=5_000)
+    suite.add_argument('--error_rate', type=float, default=0.1)
+    suite.add_argument('--truth_error_rate', type=float, default=0.01)
+    suite.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    suite.add_argument('--repeats', type=int, default=3)
+    suite.add_argument('--batch_size', type=int, default=128)
+    suite.add_argument('--num_batches', type=int, default=10)
+    suite.add_argument('--num_workers', type=int, default=0)
+    suite.add_argument('--memory', action='store_true')
+    suite.add_argument('--memory_storage', type=str, choices=MEMORY_STORAGES, default=PRIVATE_STORAGE)
+    suite.add_argument('--block_size', type=int, default=1)
+    suite.add_argument('--inference_length', type=int, default=10_000)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--out_path', type=str, default=None)
+    suite.add_argument('--baseline_path', type=str, default=None)
+    suite.set_defaults(func=benchmark_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import numpy as np
+
 class Coder:
     """
     A class used for encoding and decoding nucleobases.
@@ -14,6 +16,12 @@ class Coder:
     encodings = { 'A': 0, 'C': 1, 'G': 2, 'T': 3, GAP: 4, UNKNOWN: 5 }
     decodings = { 0: 'A', 1: 'C', 2: 'G', 3: 'T', 4: GAP, 5: UNKNOWN }
 
+    # maps ASCII codes to encodings, case-insensitively; everything outside
+    # of the alphabet is encoded as unknown
+    encoding_table = np.full(256, encodings[UNKNOWN], dtype=np.uint8)
+    encoding_table[[ord(value) for value in encodings]] = list(encodings.values())
+    encoding_table[[ord(value.lower()) for value in encodings]] = list(encodings.values())
+
     @staticmethod
     def encode(value):
         """
@@ -55,3 +63,22 @@ class Coder:
         """
 
         return Coder.decodings[value]
+
+    @staticmethod
+    def encode_array(values):
+        """
+        Encodes an array of ASCII characters using a lookup table.
+
+        Characters are encoded case-insensitively and those that are not
+        elements of the alphabet are encoded as `UNKNOWN`.
+
+        Parameters
+        ----------
+        values : a uint8 array of ASCII codes
+
+        Returns
+        -------
+        encodings : a uint8 array of encodings
+        """
+
+        return Coder.encoding_table[values]
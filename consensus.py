@@ -0,0 +1,128 @@
+import numpy as np
+from coder import Coder
+
+# number of buffered votes after which they are merged with counted votes
+COMPACT_EVERY = 1 << 22
+
+DECODINGS = np.array(Coder.ALPHABET)
+NUM_CLASSES = len(Coder.ALPHABET)
+
+class Votes:
+    """
+    A class that accumulates votes of predicted bases for positions of a
+    single contig and builds its consensus sequence.
+
+    Every vote is encoded as a single key combining its position, insertion
+    index and base. Added votes are buffered and periodically merged into
+    sorted unique keys and their counts, so memory grows with the number of
+    voted positions rather than with the number of windows.
+
+    Attributes
+    ----------
+    max_ins : maximum insertion index of a position
+    compact_every : number of buffered votes after which they are merged
+    buffered : an array of buffered vote key arrays
+    buffered_size : number of buffered votes
+    keys : sorted unique keys of merged votes
+    counts : number of votes of every merged key
+    """
+
+    def __init__(self, max_ins, compact_every=COMPACT_EVERY):
+        """
+        Parameters
+        ----------
+        max_ins : maximum insertion index of a position
+        compact_every : number of buffered votes after which they are merged
+        """
+
+        self.max_ins = max_ins
+        self.compact_every = compact_every
+
+        self.buffered = []
+        self.buffered_size = 0
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def add(self, positions, Y):
+        """
+        Adds votes of predicted bases.
+
+        Parameters
+        ----------
+        positions : an (N, cols, 2) array of window positions
+        Y : an (N, cols) array of predicted base encodings
+        """
+
+        positions = np.asarray(positions, dtype=np.int64)
+        column = positions[..., 0] * (self.max_ins + 1) + positions[..., 1]
+        keys = (column * NUM_CLASSES + np.asarray(Y, dtype=np.int64)).ravel()
+
+        self.buffered.append(keys)
+        self.buffered_size += len(keys)
+        if self.buffered_size >= self.compact_every: self.compact()
+
+    def compact(self):
+        """
+        Merges buffered votes into counted votes.
+        """
+
+        if not self.buffered: return
+
+        keys, counts = np.unique(np.concatenate(self.buffered), return_counts=True)
+        self.buffered = []
+        self.buffered_size = 0
+
+        if len(self.keys) > 0:
+            keys, inverse = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts))).astype(np.int64)
+
+        self.keys = keys
+        self.counts = counts
+
+    def __len__(self):
+        """
+        Returns the number of added votes.
+        """
+
+        return int(self.counts.sum()) + self.buffered_size
+
+    def consensus(self, seq):
+        """
+        Builds the consensus sequence of the contig. Every voted position gets
+        its most voted base, where ties are broken in favour of the base with
+        the lowest encoding, and gaps are removed. The contig sequence is kept
+        before the first and after the last voted reference position.
+
+        Parameters
+        ----------
+        seq : contig sequence
+
+        Returns
+        -------
+        consensus : consensus sequence, `None` if there are no votes
+        """
+
+        self.compact()
+        if len(self.keys) == 0: return None
+
+        column, base = np.divmod(self.keys, NUM_CLASSES)
+
+        # sorting by column, descending count and base puts the winner of
+        # every column first
+        order = np.lexsort((base, -self.counts, column))
+        column, base = column[order], base[order]
+        winners = np.concatenate(([True], column[1:] != column[:-1]))
+        column, base = column[winners], base[winners]
+
+        position, ins = np.divmod(column, self.max_ins + 1)
+
+        # insertions preceding the first voted reference position are dropped
+        ref_positions = np.flatnonzero(ins == 0)
+        if len(ref_positions) == 0: return None
+        position, base = position[ref_positions[0]:], base[ref_positions[0]:]
+
+        bases = DECODINGS[base]
+        bases = bases[bases != Coder.GAP]
+
+        first, last = position[0], position[-1]
+        return seq[:first] + ''.join(bases) + seq[last + 1:]
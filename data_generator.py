@@ -1,10 +1,14 @@
 import argparse
 from collections import namedtuple
 import pysam
-import itertools
+import numpy as np
+import threading
+import time
 from abc import ABC
 from abc import abstractmethod
 from coder import Coder
+from feature_cache import CachedResult
+from profiler import add_metrics
 import gen
 
 class Region:
@@ -23,6 +27,27 @@ class Region:
         self.start = start
         self.end = end
 
+    def __str__(self):
+        return f'{self.name}:{self.start}-{self.end}'
+
+    @staticmethod
+    def parse(region):
+        """
+        Parses a region from its string representation.
+
+        Parameters
+        ----------
+        region : a string in the `name:start-end` format
+
+        Returns
+        -------
+        region : `Region` object
+        """
+
+        name, interval = region.rsplit(':', 1)
+        start, end = interval.split('-')
+        return Region(name=name, start=int(start), end=int(end))
+
 class TargetAlign:
     """
     A class that represents a single align.
@@ -39,34 +64,129 @@ class TargetAlign:
         self.start = start
         self.end = end
 
-class AlignedPosition:
+WINDOW = 100_000
+OVERLAP = 300
+BATCH_SIZE = gen.BATCH_SIZE
+
+# files are opened per thread since neither `gen.BAMFile` nor pysam files
+# can be read from multiple threads at the same time
+opened_files = threading.local()
+
+def get_opened_files():
     """
-    A class that represents a single aligned position.
+    Returns files opened in the current thread.
 
-    Attributes
+    Returns
+    -------
+    opened_files : an object holding dictionaries of opened reads, truth genome
+        and reference files, keyed by their paths
+    """
+
+    if not hasattr(opened_files, 'reads'):
+        opened_files.reads = dict()
+        opened_files.truth_genome = dict()
+        opened_files.ref = dict()
+    return opened_files
+
+def open_files(reads_path, ref_path, truth_genome_path=None):
+    """
+    Opens BAM and reference files in the current thread so that their indices
+    and headers are loaded only once and reused for every region. Intended to
+    be used as a `multiprocessing.Pool` or `ThreadPool` initializer.
+
+    Parameters
     ----------
-    query_position : position on an aligned query
-    query_base : query base on the aligned position
-    ref_position : position on the reference genome
-    ref_base : reference base on the aligned position
+    reads_path : path to the aligned reads file
+    ref_path : path to the draft assembly file
+    truth_genome_path : path to the truth genome file
     """
 
-    def __init__(self, query_position, query_base, ref_position, ref_base):
-        self.query_position = query_position
-        self.query_base = query_base
-        self.ref_position = ref_position
-        self.ref_base = ref_base
+    get_reads_file(reads_path)
+    get_ref_file(ref_path)
+    if truth_genome_path is not None:
+        get_truth_genome_file(truth_genome_path)
 
-WINDOW = 100_000
-OVERLAP = 300
+def get_reads_file(reads_path):
+    """
+    Returns the aligned reads file opened in the current thread.
+
+    Parameters
+    ----------
+    reads_path : path to the aligned reads file
+
+    Returns
+    -------
+    reads_file : `gen.BAMFile` object
+    """
+
+    reads_files = get_opened_files().reads
+    if reads_path not in reads_files:
+        reads_files[reads_path] = gen.BAMFile(reads_path)
+    return reads_files[reads_path]
+
+def get_truth_genome_file(truth_genome_path):
+    """
+    Returns the truth genome file opened in the current thread.
+
+    Parameters
+    ----------
+    truth_genome_path : path to the truth genome file
+
+    Returns
+    -------
+    truth_genome_file : `pysam.AlignmentFile` object
+    """
+
+    truth_genome_files = get_opened_files().truth_genome
+    if truth_genome_path not in truth_genome_files:
+        truth_genome_files[truth_genome_path] = pysam.AlignmentFile(
+            truth_genome_path, 'rb', index_filename=truth_genome_path + '.bai'
+        )
+    return truth_genome_files[truth_genome_path]
+
+def get_ref_file(ref_path):
+    """
+    Returns the draft assembly file opened in the current thread. Sequences
+    are fetched through the faidx index, which is created next to the file if
+    it does not exist.
+
+    Parameters
+    ----------
+    ref_path : path to the draft assembly file
+
+    Returns
+    -------
+    ref_file : `pysam.FastaFile` object
+    """
 
-def generate_regions(ref, ref_name, window=WINDOW, overlap=OVERLAP):
+    ref_files = get_opened_files().ref
+    if ref_path not in ref_files:
+        ref_files[ref_path] = pysam.FastaFile(ref_path)
+    return ref_files[ref_path]
+
+def fetch_ref(ref_path, region):
+    """
+    Fetches the part of the reference sequence covered by the provided region.
+
+    Parameters
+    ----------
+    ref_path : path to the draft assembly file
+    region : region for which the sequence is required
+
+    Returns
+    -------
+    ref : reference sequence starting at `region.start`
+    """
+
+    return get_ref_file(ref_path).fetch(region.name, region.start, region.end)
+
+def generate_regions(length, ref_name, window=WINDOW, overlap=OVERLAP):
     """
     Generates regions for the provided sequence.
 
     Parameters
     ----------
-    ref : sequence that need to be devided into regions
+    length : length of the sequence that need to be devided into regions
     ref_name : corresponding sequence name
     window : size of a single region
     overlap : size of a window overlap
@@ -76,7 +196,6 @@ def generate_regions(ref, ref_name, window=WINDOW, overlap=OVERLAP):
     regions : generated regions
     """
 
-    length = len(ref)
     i = 0
     while i < length:
         end = i + window
@@ -85,118 +204,326 @@ def generate_regions(ref, ref_name, window=WINDOW, overlap=OVERLAP):
         if end >= length: break
         i = end - overlap
 
-def generate_inference_data(args):
+def iter_inference_data(args, batch_size=BATCH_SIZE):
     """
-    Generates inference data for the region provided through arguments.
+    Generates inference data for the region provided through arguments in
+    batches, which are yielded as the pileup advances, so that memory does
+    not grow with the size of the region.
 
     Parameters
     ----------
     reads_path : path to the aligned reads file
-    ref : reference sequence
+    ref_path : path to the draft assembly file
+    geometry : geometry of generated windows
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
     region : region for which data is required
+    batch_size : maximum number of windows in a batch
 
     Returns
     -------
-    region_name : region name
-    positions : positions corresponding provided region
-    examples : examples corresponding provided region
+    batches : (region name, positions, examples) batches, where positions are
+        a (B, cols, 2) array and examples a (B, rows, cols) array
     """
 
-    reads_path, ref, region = args
+    reads_path, ref_path, geometry, max_depth, region = args
+    ref = fetch_ref(ref_path, region)
 
     region_string = f'{region.name}:{region.start + 1}-{region.end}'
-    result = gen.generate_features(reads_path, ref, region_string)
-
-    positions = []
-    examples = []
-    for P, X in zip(*result):
-        positions.append(P)
-        examples.append(X)
+    features = gen.FeatureIterator(
+        get_reads_file(reads_path), ref, region_string, region.start, batch_size=batch_size, max_depth=max_depth,
+        **geometry._asdict()
+    )
+    for positions, examples in features:
+        yield region.name, positions, examples
+    add_metrics(**features.stats)
 
     print(f'>> finished generating examples for {region.name}:{region.start}-{region.end}')
-    return region.name, positions, examples
+
+def generate_inference_data(args):
+    """
+    Generates inference data for the region provided through arguments.
+
+    Parameters
+    ----------
+    reads_path : path to the aligned reads file
+    ref_path : path to the draft assembly file
+    geometry : geometry of generated windows
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
+    region : region for which data is required
+
+    Returns
+    -------
+    region_name : region name
+    positions : an (N, cols, 2) array of positions corresponding provided region
+    examples : an (N, rows, cols) array of examples corresponding provided region
+    """
+
+    return collect_batches(iter_inference_data(args))
 
 REF_START_GETTER = lambda r: r.align.reference_start
 REF_LEN_GETTER = lambda r: r.align.reference_length
 ALIGN_START_GETTER = lambda a: a.start
 
-def generate_train_data(args):
+def iter_train_data(args, batch_size=BATCH_SIZE):
     """
-    Generates train data for the region provided through arguments.
+    Generates train data for the region provided through arguments in
+    batches, which are yielded as the pileup advances, so that memory does
+    not grow with the size of the region.
 
     Parameters
     ----------
     reads_path : path to the aligned reads file
     truth_genome_path : path to the truth genome
-    ref : reference sequence
+    ref_path : path to the draft assembly file
+    geometry : geometry of generated windows
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
     region : region for which data is required
+    batch_size : maximum number of windows in a batch before windows without
+        labels are discarded
 
     Returns
     -------
-    region_name : region name
-    positions : positions corresponding provided region
-    examples : examples corresponding provided region
-    labels : labels corresponding provided region
+    batches : (region name, positions, examples, labels) batches, where
+        positions are a (B, cols, 2) array, examples a (B, rows, cols) array
+        and labels a (B, cols) array
     """
 
-    reads_path, truth_genome_path, ref, region = args
+    reads_path, truth_genome_path, ref_path, geometry, max_depth, region = args
+    ref = fetch_ref(ref_path, region)
 
+    start = time.perf_counter()
     aligns = get_aligns(truth_genome_path, region)
     filtered_aligns = filter_aligns(aligns)
+    add_metrics(label_time=time.perf_counter() - start)
 
     print(f'>> finished generating labels for {region.name}:{region.start}-{region.end}')
 
     if not filtered_aligns: 
         print(f'>> no alignments')
-        return None
-
-    positions = []
-    examples = []
-    labels = []
+        return
 
+    align_index = AlignIndex(filtered_aligns)
     for align in filtered_aligns:
-        position_label_dict = dict()
-        positions_with_unknown_base = set()
-
-        pos, lbls = get_postions_and_labels(align, ref, region)
-        for position, label in zip(pos, lbls):
-            if label == Coder.encode(Coder.UNKNOWN):
-                positions_with_unknown_base.add(position)
-            else:
-                position_label_dict[position] = label
-
-        sorted_positions = sorted(list(position_label_dict.keys()))
-        region_string = f'{region.name}:{sorted_positions[0][0] + 1}-{sorted_positions[-1][0]}'
-        result = gen.generate_features(reads_path, str(ref), region_string)
-
-        for P, X in zip(*result):
-            Y = []
-            to_yield = True
-
-            for p in P:
-                assert is_in_region(p[0], filtered_aligns)
-
-                if p in positions_with_unknown_base:
-                    to_yield = False
-                    break
-
-                try:
-                    y_label = position_label_dict[p]
-                except KeyError:
-                    if p[1] != 0:
-                        y_label = Coder.encode(Coder.GAP)
-                    else:
-                        raise KeyError(f'error: No label mapping for position {p}!')
-
-                Y.append(y_label)
-
-            if to_yield:
-                positions.append(P)
-                examples.append(X)
-                labels.append(Y)
+        start = time.perf_counter()
+        label_positions, align_labels = get_postions_and_labels(align, region)
+        # built once per align, since batches only look labels up
+        table = LabelTable(label_positions, align_labels, geometry.max_ins)
+        add_metrics(label_time=time.perf_counter() - start)
+
+        known_positions = label_positions[align_labels != Coder.encode(Coder.UNKNOWN), 0]
+        if len(known_positions) == 0: continue
+
+        region_string = f'{region.name}:{known_positions.min() + 1}-{known_positions.max()}'
+        features = gen.FeatureIterator(
+            get_reads_file(reads_path), ref, region_string, region.start, batch_size=batch_size, max_depth=max_depth,
+            **geometry._asdict()
+        )
+        for P, X in features:
+            assert np.all(align_index.contains(P[:, :, 0]))
+
+            start = time.perf_counter()
+            to_yield, Y = assign_labels(P, table)
+            add_metrics(label_time=time.perf_counter() - start, dropped_windows=len(P) - len(Y))
+            if len(Y) == 0: continue
+
+            yield region.name, P[to_yield], X[to_yield], Y
+        add_metrics(**features.stats)
 
     print(f'>> finished generating examples for {region.name}:{region.start}-{region.end}')
-    return region.name, positions, examples, labels
+
+def generate_train_data(args):
+    """
+    Generates train data for the region provided through arguments.
+
+    Parameters
+    ----------
+    reads_path : path to the aligned reads file
+    truth_genome_path : path to the truth genome
+    ref_path : path to the draft assembly file
+    geometry : geometry of generated windows
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
+    region : region for which data is required
+
+    Returns
+    -------
+    region_name : region name
+    positions : an (N, cols, 2) array of positions corresponding provided region
+    examples : an (N, rows, cols) array of examples corresponding provided region
+    labels : an (N, cols) array of labels corresponding provided region
+    """
+
+    return collect_batches(iter_train_data(args))
+
+def collect_batches(batches):
+    """
+    Concatenates batches of a single region into a single result. Used where
+    a whole region has to be passed at once, e.g. between processes.
+
+    Parameters
+    ----------
+    batches : batches yielded by `iter_inference_data` or `iter_train_data`
+
+    Returns
+    -------
+    result : a region name followed by concatenated arrays of all batches,
+        `None` if there are no batches
+    """
+
+    batches = list(batches)
+    if not batches: return None
+    if len(batches) == 1: return batches[0]
+
+    region_name = batches[0][0]
+    return (region_name,) + tuple(np.concatenate(arrays) for arrays in list(zip(*batches))[1:])
+
+def consume_batches(batches, store):
+    """
+    Passes every batch to the provided function as soon as it is generated.
+
+    Parameters
+    ----------
+    batches : a generator of batches, e.g. one returned by a generation
+        function wrapped with the feature cache
+    store : function called with every batch
+
+    Returns
+    -------
+    result : the value returned by the generator
+    """
+
+    while True:
+        try:
+            batch = next(batches)
+        except StopIteration as e:
+            return e.value
+        store(batch)
+
+class CollectedFunction:
+    """
+    A generation function yielding batches, whose batches are collected into
+    a single result per region, so that a whole region can be passed from a
+    worker process to the parent process.
+
+    Attributes
+    ----------
+    function : generation function yielding batches, optionally wrapped with
+        the feature cache
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, args):
+        batches = []
+        result = consume_batches(self.function(args), batches.append)
+
+        collected = collect_batches(batches)
+        return result._replace(result=collected) if isinstance(result, CachedResult) else collected
+
+MISSING_LABEL = -1
+
+class LabelTable:
+    """
+    A class that represents labels of an align scattered into a dense
+    (reference position, insertion index) table, so that labels of window
+    positions are looked up by indexing.
+
+    Attributes
+    ----------
+    start : the first reference position of the table
+    table : an (L, I) array of labels, `MISSING_LABEL` where positions are
+        not labelled
+    """
+
+    def __init__(self, label_positions, labels, max_ins):
+        """
+        Parameters
+        ----------
+        label_positions : an (M, 2) array of labelled positions
+        labels : an array of M labels
+        max_ins : maximum insertion index of window positions, labels of
+            further insertion positions are never looked up
+        """
+
+        self.start, end, width = 0, 0, 0
+        if len(labels) > 0:
+            self.start = label_positions[:, 0].min()
+            end = label_positions[:, 0].max() + 1
+            width = min(label_positions[:, 1].max(), max_ins) + 1
+
+        self.table = np.full((end - self.start, width), MISSING_LABEL, dtype=np.int8)
+        in_table = label_positions[:, 1] < width
+        self.table[label_positions[in_table, 0] - self.start, label_positions[in_table, 1]] = labels[in_table]
+
+    def lookup(self, positions):
+        """
+        Returns labels of the provided positions.
+
+        Parameters
+        ----------
+        positions : an (..., 2) array of positions
+
+        Returns
+        -------
+        labels : an array of labels, `MISSING_LABEL` for positions that are
+            not labelled
+        """
+
+        rows = positions[..., 0] - self.start
+        cols = positions[..., 1]
+        in_table = (rows >= 0) & (rows < self.table.shape[0]) & (cols < self.table.shape[1])
+
+        labels = np.full(positions.shape[:-1], MISSING_LABEL, dtype=np.int64)
+        labels[in_table] = self.table[rows[in_table], cols[in_table]]
+        return labels
+
+def assign_labels(positions, table):
+    """
+    Assigns labels to all positions of generated windows at once.
+
+    Labels of window positions are looked up in the dense label table of
+    the align. Windows containing a position labelled as unknown are
+    discarded. Missing insertion positions are labelled as gaps, while a
+    missing reference position preceding any unknown position in its window
+    is an error.
+
+    Parameters
+    ----------
+    positions : an (N, W, 2) array of window positions
+    table : `LabelTable` of the align covering the windows
+
+    Returns
+    -------
+    to_yield : an array of N flags marking windows that are kept
+    Y : an (K, W) array of labels for kept windows
+
+    Raises
+    ------
+    KeyError
+        If a reference position of a kept window has no label.
+    """
+
+    num_windows, width = positions.shape[:2]
+    if num_windows == 0:
+        return np.zeros(0, dtype=bool), np.empty((0, width), dtype=np.int64)
+
+    Y = table.lookup(positions)
+
+    unknown = Y == Coder.encode(Coder.UNKNOWN)
+    missing = Y == MISSING_LABEL
+    missing_ref = missing & (positions[:, :, 1] == 0)
+
+    first_unknown = np.where(unknown.any(axis=1), unknown.argmax(axis=1), width)
+    first_missing_ref = np.where(missing_ref.any(axis=1), missing_ref.argmax(axis=1), width)
+    errors = np.flatnonzero(first_missing_ref < first_unknown)
+    if len(errors) > 0:
+        p = tuple(positions[errors[0], first_missing_ref[errors[0]]].tolist())
+        raise KeyError(f'error: No label mapping for position {p}!')
+
+    to_yield = first_unknown == width
+    Y[missing] = Coder.encode(Coder.GAP)
+
+    return to_yield, Y[to_yield]
 
 def get_aligns(truth_genome_path, region):
     """
@@ -209,13 +536,13 @@ def get_aligns(truth_genome_path, region):
     """
 
     aligns = []
-    with pysam.AlignmentFile(truth_genome_path, 'rb', index_filename=truth_genome_path + '.bai') as f:
-        for r in f.fetch(region.name, region.start, region.end):
-            if r.reference_name != region.name: raise ValueError()
-            if r.reference_end <= region.start or r.reference_start >= region.end: continue
+    f = get_truth_genome_file(truth_genome_path)
+    for r in f.fetch(region.name, region.start, region.end):
+        if r.reference_name != region.name: raise ValueError()
+        if r.reference_end <= region.start or r.reference_start >= region.end: continue
 
-            if not r.is_unmapped and not r.is_secondary:
-                aligns.append(TargetAlign(align=r, start=r.reference_start, end=r.reference_end))
+        if not r.is_unmapped and not r.is_secondary:
+            aligns.append(TargetAlign(align=r, start=r.reference_start, end=r.reference_end))
 
     aligns.sort(key=REF_START_GETTER)
     return aligns
@@ -245,60 +572,71 @@ def filter_aligns(aligns, len_threshold=2.0, overlap_threshold=0.5, min_len=1000
     Finally, only those aligns that are now longer than the minimal required
     length are returned.
 
+    Pairs are visited in the same order as all pairs of aligns ordered by
+    reference start would be, but the scan for the second align stops as
+    soon as it starts after the end of the first one. Align starts only
+    grow and ends only shrink, so no later align can overlap the first one
+    either, which makes filtering linear in the number of aligns and
+    overlapping pairs.
+
     Returns
     -------
     filtered_aligns : aligns that satisfy certain conditions.
     """
 
-    to_be_removed = set()
-    for i, j in itertools.combinations(aligns, 2):
-        first, second = order_by_ref_start(i, j)
-
-        overlap = get_overlap(first, second)
-        if overlap is None: continue
-        overlap_start, overlap_end = overlap
-
-        shorter, longer = order_by_ref_len(i, j)
-
-        len_ratio = longer.align.reference_length / shorter.align.reference_length
-        overlap_ratio = (overlap_end - overlap_start) / shorter.align.reference_length
+    aligns = sorted(aligns, key=REF_START_GETTER)
 
-        if len_ratio < len_threshold:
-            if overlap_ratio < overlap_threshold:
-                first.end = overlap_start
-                second.start = overlap_end
-            else:
-                to_be_removed.add(shorter)
-                to_be_removed.add(longer)
+    to_be_removed = set()
+    for i, first in enumerate(aligns):
+        for j in range(i + 1, len(aligns)):
+            second = aligns[j]
+            if second.align.reference_start >= first.end: break
 
-        else:
-            if overlap_ratio >= overlap_threshold:
-                to_be_removed.add(shorter)
-            else:
-                second.start = overlap_end
+            resolve_overlap(first, second, to_be_removed, len_threshold, overlap_threshold)
 
     filtered_aligns = list(filter(lambda a: (a.end - a.start >= min_len) and a not in to_be_removed, aligns))
     filtered_aligns.sort(key=ALIGN_START_GETTER)
     return filtered_aligns
 
-def get_overlap(first, second):
+def resolve_overlap(first, second, to_be_removed, len_threshold, overlap_threshold):
     """
-    Gets overlap for provided aligs.
+    Resolves overlap between two aligns as described in `filter_aligns`.
 
     Parameters
     ----------
-    first : first align
-    second : second align
+    first : align with the smaller reference start
+    second : align with the bigger reference start
+    to_be_removed : a set of discarded aligns that is updated
+    len_threshold : length ratio threshold
+    overlap_threshold : overlap ratio threshold
     """
 
-    if second.start < first.end:
-        return second.start, first.end
+    overlap = get_overlap(first, second)
+    if overlap is None: return
+    overlap_start, overlap_end = overlap
+
+    shorter, longer = order_by_ref_len(first, second)
+
+    len_ratio = longer.align.reference_length / shorter.align.reference_length
+    overlap_ratio = (overlap_end - overlap_start) / shorter.align.reference_length
+
+    if len_ratio < len_threshold:
+        if overlap_ratio < overlap_threshold:
+            first.end = overlap_start
+            second.start = overlap_end
+        else:
+            to_be_removed.add(shorter)
+            to_be_removed.add(longer)
+
     else:
-        return None
+        if overlap_ratio >= overlap_threshold:
+            to_be_removed.add(shorter)
+        else:
+            second.start = overlap_end
 
-def order_by_ref_start(first, second):
+def get_overlap(first, second):
     """
-    Returns aligns ordered by reference start.
+    Gets overlap for provided aligs.
 
     Parameters
     ----------
@@ -306,7 +644,10 @@ def order_by_ref_start(first, second):
     second : second align
     """
 
-    return sorted((first, second), key=REF_START_GETTER)
+    if second.start < first.end:
+        return second.start, first.end
+    else:
+        return None
 
 def order_by_ref_len(first, second):
     """
@@ -320,33 +661,66 @@ def order_by_ref_len(first, second):
 
     return sorted((first, second), key=REF_LEN_GETTER)
 
-def get_pairs(align, ref):
+# CIGAR operations (M, I, D, N, S, H, P, =, X, B) that consume the reference and the query
+CONSUMES_REF = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1, 0], dtype=bool)
+CONSUMES_QUERY = np.array([1, 1, 0, 0, 1, 0, 0, 1, 1, 0], dtype=bool)
+
+def expand_cigar(align):
     """
-    Gets aligned positions for provided align and reference sequence.
+    Expands CIGAR of the provided align into arrays of aligned positions.
+    Aligned positions are ordered in the same way as in
+    `pysam.AlignedSegment.get_aligned_pairs`.
 
     Parameters
     ----------
     align : read aligned to the reference sequence
-    ref : reference sequence
+
+    Returns
+    -------
+    ref_positions : positions on the reference genome, -1 for query bases
+        that are not aligned to the reference
+    query_positions : positions on the query, -1 for reference bases
+        that are not aligned to the query
     """
 
-    query = align.query_sequence
-    if query is None: raise StopIteration()
+    cigar = np.array(align.cigartuples, dtype=np.int64).reshape(-1, 2)
+    operations, lengths = cigar[:, 0], cigar[:, 1]
+    consumes_ref, consumes_query = CONSUMES_REF[operations], CONSUMES_QUERY[operations]
+
+    ref_lengths = lengths * consumes_ref
+    query_lengths = lengths * consumes_query
+    ref_starts = align.reference_start + np.cumsum(ref_lengths) - ref_lengths
+    query_starts = np.cumsum(query_lengths) - query_lengths
 
-    for query_position, ref_position in align.get_aligned_pairs():
-        ref_base = ref[ref_position] if ref_position is not None else None
-        query_base = query[query_position] if query_position is not None else None
-        yield AlignedPosition(query_position, query_base, ref_position, ref_base)
+    emitted = consumes_ref | consumes_query
+    emitted_lengths = lengths[emitted]
+    operation_idx = np.repeat(np.flatnonzero(emitted), emitted_lengths)
+    operation_offsets = np.arange(len(operation_idx)) - np.repeat(np.cumsum(emitted_lengths) - emitted_lengths, emitted_lengths)
 
-def get_postions_and_labels(align, ref, region):
+    ref_positions = np.where(consumes_ref[operation_idx], ref_starts[operation_idx] + operation_offsets, -1)
+    query_positions = np.where(consumes_query[operation_idx], query_starts[operation_idx] + operation_offsets, -1)
+    return ref_positions, query_positions
+
+def get_postions_and_labels(align, region):
     """
-    Returns list of corresponding positions and labels.
+    Returns arrays of corresponding positions and labels.
+
+    Aligned positions are taken from the first one aligned to the reference
+    at or after the start of both region and align, up to the first one
+    aligned to the reference at or after the end of either of them. Query
+    bases that are not aligned to the reference get the last reference
+    position and an increasing insertion index.
 
     Parameters
     ----------
     align : align for which positions and labels are required
-    ref : corresponding reference sequence
     region : corresponding region
+
+    Returns
+    -------
+    positions : an (M, 2) array of (reference position, insertion index) pairs
+    labels : an array of M encoded query bases, or gaps where the query is not
+        aligned to the reference
     """
 
     start, end = region.start, region.end
@@ -354,48 +728,80 @@ def get_postions_and_labels(align, ref, region):
     if end is None: end = float('inf')
     start, end = max(start, align.start), min(end, align.end)
 
-    positions = []
-    labels = []
+    query = align.align.query_sequence
+    if query is None: raise ValueError(f'Align {align.align.query_name} has no query sequence.')
 
-    pairs = get_pairs(align.align, ref)
-    current_position = None
-    insert_count = 0
+    ref_positions, query_positions = expand_cigar(align.align)
+    aligned_to_ref = ref_positions >= 0
 
-    for pair in itertools.dropwhile(lambda p: (p.ref_position is None) or (p.ref_position < start), pairs):
-        if pair.ref_position == align.align.reference_end or (pair.ref_position is not None and pair.ref_position >= end):
-            break
+    first = np.flatnonzero(aligned_to_ref & (ref_positions >= start))
+    if len(first) == 0:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.uint8)
+    first = first[0]
 
-        if pair.ref_position is None:
-            insert_count += 1
-        else:
-            insert_count = 0
-            current_position = pair.ref_position
+    last = np.flatnonzero(aligned_to_ref[first:] & (ref_positions[first:] >= end))
+    last = first + last[0] if len(last) > 0 else len(ref_positions)
 
-        position = (current_position, insert_count)
-        positions.append(position)
+    ref_positions = ref_positions[first:last]
+    query_positions = query_positions[first:last]
+    aligned_to_ref = aligned_to_ref[first:last]
 
-        label = pair.query_base.upper() if pair.query_base else Coder.GAP
+    idx = np.arange(len(ref_positions))
+    last_aligned_to_ref = np.maximum.accumulate(np.where(aligned_to_ref, idx, 0))
+    positions = np.stack((ref_positions[last_aligned_to_ref], idx - last_aligned_to_ref), axis=1)
 
-        try:
-            encoded_label = Coder.encode(label)
-        except KeyError:
-            encoded_label = Coder.encode(Coder.UNKNOWN)
-
-        labels.append(encoded_label)
+    labels = np.full(len(idx), Coder.encode(Coder.GAP), dtype=np.uint8)
+    aligned_to_query = query_positions >= 0
+    query = np.frombuffer(query.encode('ascii'), dtype=np.uint8)
+    labels[aligned_to_query] = Coder.encode_array(query[query_positions[aligned_to_query]])
 
     return positions, labels
 
-def is_in_region(position, aligns):
+class AlignIndex:
     """
-    Returns true if at least one of the provided aligns contains
-    provided postions.
+    A class that represents reference intervals covered by aligns, merged
+    into sorted disjoint intervals so that positions can be looked up with
+    a binary search.
 
-    Parameters
+    Attributes
     ----------
-    position : sequence position
-    aligns : list of aligns
+    starts : an array of interval starts
+    ends : an array of interval ends
     """
 
-    for align in aligns:
-        if align.start <= position < align.end: return True
-    return False
+    def __init__(self, aligns):
+        """
+        Parameters
+        ----------
+        aligns : list of aligns
+        """
+
+        intervals = sorted((a.start, a.end) for a in aligns if a.start < a.end)
+        starts = np.array([start for start, _ in intervals], dtype=np.int64)
+        ends = np.maximum.accumulate(np.array([end for _, end in intervals], dtype=np.int64))
+
+        new_interval = np.ones(len(starts), dtype=bool)
+        new_interval[1:] = starts[1:] > ends[:-1]
+        last_in_interval = np.roll(new_interval, -1)
+
+        self.starts = starts[new_interval]
+        self.ends = ends[last_in_interval]
+
+    def contains(self, positions):
+        """
+        Returns true for positions contained in at least one of the aligns.
+
+        Parameters
+        ----------
+        positions : a sequence position or an array of positions
+
+        Returns
+        -------
+        contained : a flag or an array of flags
+        """
+
+        positions = np.asarray(positions)
+        if len(self.starts) == 0: return np.zeros(positions.shape, dtype=bool)
+
+        idx = np.searchsorted(self.starts, positions, side='right') - 1
+        return (idx >= 0) & (positions < self.ends[np.maximum(idx, 0)])
@@ -1,7 +1,8 @@
 import pytorch_lightning as pl
 import argparse
-from torch.utils.data import DataLoader
-from dataset import InMemoryTrainDataset, TrainDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from dataset import InMemoryTrainDataset, TrainDataset, MemmapTrainDataset, BlockShuffleSampler, get_geometry, \
+    is_flat_data, batch_loader, MEMORY_STORAGES, PRIVATE_STORAGE
 import torch
 
 class DataModule(pl.LightningDataModule):
@@ -16,6 +17,11 @@ class DataModule(pl.LightningDataModule):
     batch_size : size of a single batch
     num_workers : number of subprocesses used for data loading
     is_data_stored_in_RAM : flag that indicates whether all data is immediately loaded and stored in RAM
+    memory_storage : storage of data stored in RAM, one of `MEMORY_STORAGES`
+    mmap_dir : directory of memory mapped data stored in RAM
+    block_size : number of consecutive samples shuffled together as a block if data is read from .hdf5 files,
+        1 for a uniform shuffle
+    geometry : geometry of windows in training and validation data
     """
 
     def __init__(self, args):
@@ -31,6 +37,13 @@ class DataModule(pl.LightningDataModule):
         self.batch_size = args.batch_size
         self.num_workers = args.num_workers
         self.is_data_stored_in_RAM = args.memory
+        self.memory_storage = args.memory_storage
+        self.mmap_dir = args.mmap_dir
+        self.block_size = args.block_size
+
+        self.geometry = get_geometry(self.train_path)
+        if self.val_path and get_geometry(self.val_path) != self.geometry:
+            raise ValueError('Training and validation data were generated with different window geometries.')
 
         self.train = None
         self.val = None
@@ -38,26 +51,49 @@ class DataModule(pl.LightningDataModule):
     def setup(self, stage=None):
         """
         Sets up training and validation (if provided) dataset according to
-        flag `is_data_stored_in_RAM`.
+        flag `is_data_stored_in_RAM`. Data exported by `export.py` is always
+        memory mapped.
         """
 
-        data_class = InMemoryTrainDataset if self.is_data_stored_in_RAM else TrainDataset
-
-        self.train = data_class(self.train_path)
+        self.train = self.load(self.train_path)
 
         if self.val_path:
-            self.val = data_class(self.val_path)
+            self.val = self.load(self.val_path)
+
+    def load(self, path):
+        """
+        Returns the dataset of data at the provided path.
+
+        Parameters
+        ----------
+        path : path to a .hdf5 file, directory containing .hdf5 files or
+            directory of exported data
+
+        Returns
+        -------
+        dataset : training or validation dataset
+        """
+
+        if is_flat_data(path): return MemmapTrainDataset(path)
+        if self.is_data_stored_in_RAM: return InMemoryTrainDataset(path, self.memory_storage, self.mmap_dir)
+        return TrainDataset(path)
 
     def train_dataloader(self):
         """
-        Returns training data as a `DataLoader` object.
+        Returns training data as a `DataLoader` object. Batches of data read
+        from .hdf5 files are read in a single call, and are read in a few
+        slices if shuffled in blocks of consecutive samples.
 
         Returns
         -------
         dataloader : training data
         """
 
-        return DataLoader(self.train, self.batch_size, shuffle=True, num_workers=self.num_workers)
+        if not isinstance(self.train, TrainDataset):
+            return DataLoader(self.train, self.batch_size, shuffle=True, num_workers=self.num_workers)
+
+        sampler = BlockShuffleSampler(self.train, self.block_size) if self.block_size > 1 else RandomSampler(self.train)
+        return batch_loader(self.train, self.batch_size, sampler, self.num_workers)
 
     def val_dataloader(self):
         """
@@ -73,6 +109,9 @@ class DataModule(pl.LightningDataModule):
             If validation is not required, i.e. if val_path is not provided.
         """
 
+        if isinstance(self.val, TrainDataset):
+            return batch_loader(self.val, self.batch_size, SequentialSampler(self.val), self.num_workers)
+
         return DataLoader(self.val, self.batch_size, num_workers=self.num_workers) if self.val else None
 
     @staticmethod
@@ -95,4 +134,7 @@ class DataModule(pl.LightningDataModule):
         parser.add_argument('--memory', type=bool, default=False)
         parser.add_argument('--batch_size', type=int, default=128)
         parser.add_argument('--num_workers', type=int, default=0)
+        parser.add_argument('--memory_storage', type=str, choices=MEMORY_STORAGES, default=PRIVATE_STORAGE)
+        parser.add_argument('--mmap_dir', type=str, default=None)
+        parser.add_argument('--block_size', type=int, default=1)
         return parser
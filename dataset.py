@@ -1,8 +1,41 @@
 from torch.utils import data
+import json
 import os
+import shutil
+import tempfile
+import weakref
 import h5py
 import numpy as np
 import torch
+from geometry import Geometry, read_geometry
+
+# suffix of index files written next to .hdf5 files which do not store their
+# own group offsets
+INDEX_SUFFIX = '.index.npy'
+
+# requested samples of a group are read in a single slice unless they are
+# more than this many samples apart, since every read call has a high fixed cost
+MAX_READ_GAP = 8
+
+# number of recently read groups whose datasets are kept open, since a group
+# linked from a segment file opens the segment file on every access
+OPEN_GROUPS = 64
+
+# number of consecutive samples shuffled together as a block
+BLOCK_SIZE = 16
+
+# index file of training data exported to the flat format by `export.py`,
+# which lists shards of raw arrays stored as `<shard>.<array>.npy` files
+FLAT_INDEX = 'index.json'
+FLAT_VERSION = 1
+FLAT_ARRAYS = ['examples', 'labels', 'positions']
+
+# storages of data loaded into RAM: process memory, shared memory or a
+# memory mapped file
+PRIVATE_STORAGE = 'private'
+SHARED_STORAGE = 'shared'
+MMAP_STORAGE = 'mmap'
+MEMORY_STORAGES = [PRIVATE_STORAGE, SHARED_STORAGE, MMAP_STORAGE]
 
 class TrainDataset(data.Dataset):
     """
@@ -13,8 +46,13 @@ class TrainDataset(data.Dataset):
     ----------
     file_names : an array containing all .hdf5 files that represent training dataset
     files : an array of file objects containing training dataset
-    idx : a dictionary of indices used for obtaining data
+    open_groups : a dictionary of examples and labels datasets of recently
+        read groups, keyed by group indices
+    group_files : an array of file indices of groups containing data
+    group_names : an array of names of groups containing data
+    offsets : an array of cumulative sample offsets of groups
     size : data size
+    geometry : geometry of windows
     """
 
     def __init__(self, path):
@@ -27,27 +65,26 @@ class TrainDataset(data.Dataset):
 
         self.file_names = get_file_names(path)
         self.files = None
-        self.idx = {}
+        self.open_groups = None
+        group_files, group_names = [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=str)]
+        offsets = [np.zeros(1, dtype=np.int64)]
         self.size = 0
+        self.geometry = get_geometry(path)
 
-        files = [h5py.File(f, 'r', libver='latest', swmr=True) for f in self.file_names]
-        for file_idx, f in enumerate(files):
-
-            groups = list(f.keys())
-            if 'info' in groups:
-                groups.remove('info')
-            if 'contigs' in groups:
-                groups.remove('contigs')
+        # the index is kept in arrays rather than Python objects, so that it
+        # is not copied to DataLoader workers as they access it
+        for file_idx, file_name in enumerate(self.file_names):
+            with h5py.File(file_name, 'r', libver='latest', swmr=True) as f:
+                groups, file_offsets = get_groups(f)
 
-            for g in groups:
-                group_size = f[g].attrs['size']
-                for offset in range(group_size):
-                    self.idx[self.size + offset] = (file_idx, g, offset)
+            group_files.append(np.full(len(groups), file_idx, dtype=np.int32))
+            group_names.append(groups)
+            offsets.append(self.size + file_offsets[1:])
+            self.size += int(file_offsets[-1])
 
-                self.size += group_size
-
-        for f in files:
-            f.close()
+        self.group_files = np.concatenate(group_files)
+        self.group_names = np.concatenate(group_names)
+        self.offsets = np.concatenate(offsets)
 
     def __len__(self):
         """
@@ -62,68 +99,272 @@ class TrainDataset(data.Dataset):
 
     def __getitem__(self, idx):
         """
-        Obtains training data corresponding to the provided index.
+        Obtains training data corresponding to the provided index, or a batch
+        of training data corresponding to a list of indices yielded by a
+        `BatchSampler`. Samples of a batch from a single group are read in
+        slices spanning runs of close samples.
 
         Parameters
         ----------
-        idx : index that corresponds to a training data
+        idx : index that corresponds to a training data, or a list of indices
 
         Returns
         -------
-        sample : examples and labels corresponding the provided index
+        sample : examples and labels corresponding the provided index, or
+            arrays of examples and labels in the order of indices
         """
 
-        file_idx, g, offset = self.idx[idx]
-
         if not self.files:
             self.files = [h5py.File(f, 'r', libver='latest', swmr=True) for f in self.file_names]
+            self.open_groups = dict()
+
+        if np.ndim(idx) > 0: return self.__read_batch(idx)
 
-        f = self.files[file_idx]
-        group = f[g]
+        group_idx, offset = locate(self.offsets, idx)
+        examples, labels = self.__open_group(group_idx)
 
-        sample = (group['examples'][offset], group['labels'][offset])
+        sample = (examples[offset], labels[offset])
 
         return sample
 
+    def __read_batch(self, indices):
+        """
+        Reads a batch of training data corresponding to the provided indices.
+
+        Parameters
+        ----------
+        indices : indices that correspond to training data
+
+        Returns
+        -------
+        X : an array of examples, in the order of indices
+        Y : an array of labels, in the order of indices
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) > 0 and (indices.min() < 0 or indices.max() >= self.size):
+            raise IndexError('Indices are out of range.')
+
+        group_indices = np.searchsorted(self.offsets, indices, side='right') - 1
+        offsets = indices - self.offsets[group_indices]
+
+        X = np.empty((0, self.geometry.rows, self.geometry.cols), dtype=np.uint8)
+        Y = np.empty((0, self.geometry.cols), dtype=np.int64)
+        for group_idx in np.unique(group_indices):
+            positions = np.flatnonzero(group_indices == group_idx)
+            examples, labels = self.__open_group(group_idx)
+
+            rows, inverse = np.unique(offsets[positions], return_inverse=True)
+            # runs are split where consecutive requested rows are too far apart
+            splits = np.flatnonzero(np.diff(rows) > MAX_READ_GAP) + 1
+            run_starts = rows[np.concatenate(([0], splits))]
+            run_ends = rows[np.concatenate((splits - 1, [len(rows) - 1]))] + 1
+
+            group_X, group_Y = [], []
+            for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+                group_X.append(examples[start:end])
+                group_Y.append(labels[start:end])
+            group_X, group_Y = np.concatenate(group_X), np.concatenate(group_Y)
+
+            # positions of requested rows in the concatenated runs
+            lengths = run_ends - run_starts
+            runs = np.searchsorted(run_starts, rows, side='right') - 1
+            read_rows = rows - run_starts[runs] + (np.cumsum(lengths) - lengths)[runs]
+
+            if len(X) == 0:
+                X = np.empty((len(indices), *group_X.shape[1:]), dtype=group_X.dtype)
+                Y = np.empty((len(indices), *group_Y.shape[1:]), dtype=group_Y.dtype)
+            X[positions] = group_X[read_rows[inverse]]
+            Y[positions] = group_Y[read_rows[inverse]]
+
+        return X, Y
+
+    def __open_group(self, group_idx):
+        """
+        Returns examples and labels datasets of the group with the provided
+        index, keeping datasets of recently read groups open.
+
+        Parameters
+        ----------
+        group_idx : group index
+
+        Returns
+        -------
+        examples : examples dataset of the group
+        labels : labels dataset of the group
+        """
+
+        group_idx = int(group_idx)
+        datasets = self.open_groups.pop(group_idx, None)
+        if datasets is None:
+            group = self.files[self.group_files[group_idx]][self.group_names[group_idx]]
+            datasets = group['examples'], group['labels']
+            # the least recently read group is closed
+            if len(self.open_groups) == OPEN_GROUPS: del self.open_groups[next(iter(self.open_groups))]
+
+        self.open_groups[group_idx] = datasets
+        return datasets
+
+class BlockShuffleSampler(data.Sampler):
+    """
+    A sampler of a `TrainDataset` that shuffles blocks of consecutive samples
+    of a single group instead of single samples, so that a batch is read in
+    a few slices instead of a call per sample. Samples of a block stay
+    together and in order, so a batch holds `batch_size / block_size`
+    randomly placed stretches of the data. Setting `block_size` to 1 gives
+    a uniform shuffle.
+
+    Attributes
+    ----------
+    starts : an array of indices of first samples of blocks
+    ends : an array of indices following last samples of blocks
+    generator : random number generator used to seed every epoch, the
+        default PyTorch generator if `None`
+    """
+
+    def __init__(self, dataset, block_size=BLOCK_SIZE, generator=None):
+        """
+        Parameters
+        ----------
+        dataset : `TrainDataset` object
+        block_size : maximum number of consecutive samples in a block
+        generator : random number generator used to seed every epoch
+        """
+
+        if block_size < 1: raise ValueError('Block size must be positive.')
+
+        sizes = np.diff(dataset.offsets)
+        num_blocks = -(-sizes // block_size)
+
+        groups = np.repeat(np.arange(len(sizes)), num_blocks)
+        first_blocks = np.repeat(np.cumsum(num_blocks) - num_blocks, num_blocks)
+        self.starts = dataset.offsets[groups] + (np.arange(len(groups)) - first_blocks) * block_size
+        self.ends = np.minimum(self.starts + block_size, dataset.offsets[groups + 1])
+
+        self.generator = generator
+
+    def __len__(self):
+        return int((self.ends - self.starts).sum())
+
+    def __iter__(self):
+        seed = int(torch.empty((), dtype=torch.int64).random_(generator=self.generator).item())
+        order = np.random.default_rng(seed).permutation(len(self.starts))
+
+        for block in order.tolist():
+            yield from range(self.starts[block], self.ends[block])
+
 class InMemoryTrainDataset(data.Dataset):
     """
     A class that defines a training dataset. This dataset immediately loads and 
     stores all data in RAM.
 
+    Examples and labels are loaded into two preallocated contiguous arrays,
+    which DataLoader workers share instead of copying. Arrays are allocated
+    in process memory (`private`), in shared memory (`shared`) or as memory
+    mapped files in a temporary directory (`mmap`).
+
     Attributes
     ----------
     X : an array of examples
     Y : an array of labels
+    size : data size
+    geometry : geometry of windows
+    storage : storage of arrays
+    tensors : shared memory tensors backing arrays, `None` unless `storage` is `shared`
+    mmap_dir : directory of memory mapped arrays, `None` unless `storage` is `mmap`
     """
 
-    def __init__(self, path):
+    def __init__(self, path, storage=PRIVATE_STORAGE, mmap_dir=None):
         """
         Parameters
         ----------
         path : a path to .hdf5 file or directory containing .hdf5 files 
             that represent training dataset
+        storage : storage of arrays, one of `MEMORY_STORAGES`
+        mmap_dir : directory in which the temporary directory of memory
+            mapped arrays is created, the default temporary directory if `None`
         """
 
-        self.X = []
-        self.Y = []
+        if storage not in MEMORY_STORAGES: raise ValueError(f'Unknown storage {storage}, expected one of {MEMORY_STORAGES}.')
+
+        self.geometry = get_geometry(path)
+        self.storage = storage
+        self.tensors = None
+        self.mmap_dir = None
 
+        files, dtypes = [], None
         for file_name in get_file_names(path):
             with h5py.File(file_name, 'r') as f:
+                groups, offsets = get_groups(f)
+                if dtypes is None and len(groups) > 0:
+                    dtypes = f[groups[0]]['examples'].dtype, f[groups[0]]['labels'].dtype
+            files.append((file_name, groups, np.diff(offsets).tolist()))
+        self.size = sum(sum(sizes) for _, _, sizes in files)
+
+        X_dtype, Y_dtype = dtypes or (np.uint8, np.int64)
+        self.X = self.__allocate('X', (self.size, self.geometry.rows, self.geometry.cols), X_dtype, mmap_dir)
+        self.Y = self.__allocate('Y', (self.size, self.geometry.cols), Y_dtype, mmap_dir)
+
+        # groups are read directly into their slices of the arrays
+        start = 0
+        for file_name, groups, sizes in files:
+            with h5py.File(file_name, 'r') as f:
+                for g, size in zip(groups, sizes):
+                    if size == 0: continue
+                    f[g]['examples'].read_direct(self.X, np.s_[:size], np.s_[start:start + size])
+                    f[g]['labels'].read_direct(self.Y, np.s_[:size], np.s_[start:start + size])
+                    start += size
 
-                groups = list(f.keys())
-                if 'info' in groups:
-                    groups.remove('info')
-                if 'contigs' in groups:
-                    groups.remove('contigs')
+        if self.storage == MMAP_STORAGE:
+            self.X.flush()
+            self.Y.flush()
 
-                for g in groups:
-                    X = f[g]['examples'][()]
-                    Y = f[g]['labels'][()]
+    def __allocate(self, name, shape, dtype, mmap_dir):
+        """
+        Allocates an array in the selected storage.
 
-                    self.X.extend(list(X))
-                    self.Y.extend(list(Y))
+        Parameters
+        ----------
+        name : name of the array
+        shape : shape of the array
+        dtype : data type of the array
+        mmap_dir : directory in which the directory of memory mapped arrays is created
+
+        Returns
+        -------
+        array : allocated array
+        """
 
-        self.size = len(self.X)
+        if self.storage == SHARED_STORAGE:
+            tensor = torch.empty(shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype).share_memory_()
+            self.tensors = (self.tensors or ()) + (tensor,)
+            return tensor.numpy()
+
+        if self.storage == MMAP_STORAGE:
+            if self.mmap_dir is None:
+                self.mmap_dir = tempfile.mkdtemp(prefix='train_data_', dir=mmap_dir)
+                # the directory is removed once the dataset is released by the
+                # process which created it, never by workers
+                weakref.finalize(self, remove_mmap_dir, self.mmap_dir, os.getpid())
+            return np.lib.format.open_memmap(os.path.join(self.mmap_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+        return np.empty(shape, dtype=dtype)
+
+    def __getstate__(self):
+        # arrays in shared memory are passed as tensors and memory mapped
+        # arrays are reopened, so that neither is copied to workers
+        state = self.__dict__.copy()
+        if self.storage != PRIVATE_STORAGE:
+            state['X'] = state['Y'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.storage == SHARED_STORAGE:
+            self.X, self.Y = self.tensors[0].numpy(), self.tensors[1].numpy()
+        elif self.storage == MMAP_STORAGE:
+            self.X = load_memmap(os.path.join(self.mmap_dir, 'X.npy'))
+            self.Y = load_memmap(os.path.join(self.mmap_dir, 'Y.npy'))
 
     def __len__(self):
         """
@@ -152,6 +393,81 @@ class InMemoryTrainDataset(data.Dataset):
 
         return sample
 
+class MemmapTrainDataset(data.Dataset):
+    """
+    A class that defines a training dataset exported to the flat format by
+    `export.py`. Shards are memory mapped, so samples are views of the page
+    cache which are never copied until batched, and DataLoader workers share
+    a single copy of the data.
+
+    Attributes
+    ----------
+    path : path to the directory of exported data
+    shard_names : an array of names of shards
+    offsets : an array of cumulative sample offsets of shards
+    size : data size
+    geometry : geometry of windows
+    shards : an array of memory mapped examples and labels of shards, opened
+        on the first access
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : path to the directory of exported data
+        """
+
+        index = read_flat_index(path)
+
+        self.path = path
+        self.shard_names = [shard['name'] for shard in index['shards']]
+        self.offsets = np.concatenate(([0], np.cumsum([shard['size'] for shard in index['shards']], dtype=np.int64)))
+        self.size = int(self.offsets[-1])
+        self.geometry = Geometry(**index['geometry'])
+        self.shards = None
+
+    def __getstate__(self):
+        # memory maps are reopened by workers instead of being copied
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def __len__(self):
+        """
+        Returns size of a training dataset.
+
+        Returns
+        -------
+        size : training dataset size
+        """
+
+        return self.size
+
+    def __getitem__(self, idx):
+        """
+        Obtains training data corresponding to the provided index.
+
+        Parameters
+        ----------
+        idx : index that corresponds to a training data
+
+        Returns
+        -------
+        sample : examples and labels corresponding the provided index
+        """
+
+        if self.shards is None:
+            self.shards = [
+                tuple(load_memmap(get_flat_path(self.path, name, array)) for array in ('examples', 'labels'))
+                for name in self.shard_names
+            ]
+
+        shard_idx, offset = locate(self.offsets, idx)
+        X, Y = self.shards[shard_idx]
+
+        return (X[offset], Y[offset])
+
 class InferenceDataset(data.Dataset):
     """
     A class that defines an inference dataset. This dataset does not immediately 
@@ -162,8 +478,12 @@ class InferenceDataset(data.Dataset):
     path : path to a file containing inference dataset
     size : inference data size
     f : file object containing inference dataset
-    idx : a dictionary of indices used for obtaining data
+    open_group : index, contig and examples and positions datasets of the
+        last read group, which is kept open as groups are read in order
+    groups : an array of names of groups containing data
+    offsets : an array of cumulative sample offsets of groups
     contigs : a dictionary of contigs
+    geometry : geometry of windows
     """
 
     def __init__(self, path):
@@ -174,23 +494,14 @@ class InferenceDataset(data.Dataset):
         """
 
         self.path = path
-        self.size = 0
         self.f = None
-        self.idx = {}
+        self.open_group = None
         self.contigs = {}
 
         with h5py.File(path, 'r') as f:
-
-            groups = list(f.keys())
-            groups.remove('contigs')
-
-            for g in groups:
-                group_size = f[g].attrs['size']
-
-                for offset in range(group_size):
-                    self.idx[self.size + offset] = (g, offset)
-
-                self.size += group_size
+            self.groups, self.offsets = get_groups(f)
+            self.geometry = read_geometry(f)
+            self.size = int(self.offsets[-1])
 
             end_group = f['contigs']
             for ref in end_group:
@@ -215,12 +526,14 @@ class InferenceDataset(data.Dataset):
         if not self.f:
             self.f = h5py.File(self.path, 'r')
 
-        g, offset = self.idx[idx]
-        group = self.f[g]
+        group_idx, offset = locate(self.offsets, idx)
+        if self.open_group is None or self.open_group[0] != group_idx:
+            group = self.f[self.groups[group_idx]]
+            self.open_group = (group_idx, group.attrs['contig'], group['examples'], group['positions'])
 
-        contig = group.attrs['contig']
-        X = group['examples'][offset]
-        positions = group['positions'][offset]
+        _, contig, examples, group_positions = self.open_group
+        X = examples[offset]
+        positions = group_positions[offset]
 
         return (contig, positions, X)
 
@@ -235,6 +548,241 @@ class InferenceDataset(data.Dataset):
 
         return self.size
 
+def get_groups(f):
+    """
+    Returns names of groups containing data in the provided file together
+    with cumulative sample offsets of those groups.
+
+    Files written by `HDF5Writer` store both in the `info` group. For older
+    files, groups are scanned and their sizes are summed once, after which
+    the result is stored in an index file next to the .hdf5 file and memory
+    mapped on later calls, as long as the .hdf5 file is not modified.
+
+    Parameters
+    ----------
+    f : .hdf5 file object
+
+    Returns
+    -------
+    groups : an array of group names
+    offsets : an array of cumulative sample offsets, one longer than `groups`
+    """
+
+    if 'info' in f and 'offsets' in f['info']:
+        offsets = f['info']['offsets'][()].astype(np.int64)
+        # names appended by an interrupted commit have no offsets
+        groups = np.array(f['info']['groups'].asstr()[:len(offsets) - 1], dtype=str)
+        return groups, offsets
+
+    index_path = f.filename + INDEX_SUFFIX
+    index = read_index(index_path, f.filename)
+
+    if index is None:
+        groups = [g for g in f.keys() if g not in ('info', 'contigs')]
+        sizes = [f[g].attrs['size'] for g in groups]
+
+        index = np.empty(len(groups), dtype=[('group', np.array(groups, dtype=str).dtype), ('end', np.int64)])
+        index['group'] = groups
+        index['end'] = np.cumsum(sizes, dtype=np.int64)
+        write_index(index_path, index)
+
+    offsets = np.concatenate(([0], index['end']))
+    return index['group'], offsets
+
+def read_index(index_path, file_name):
+    """
+    Memory maps the index file of the provided .hdf5 file.
+
+    Parameters
+    ----------
+    index_path : path to the index file
+    file_name : path to the indexed .hdf5 file
+
+    Returns
+    -------
+    index : a structured array of group names and cumulative sample offsets
+        of their ends, `None` if the index is missing or older than the file
+    """
+
+    try:
+        if os.stat(index_path).st_mtime_ns < os.stat(file_name).st_mtime_ns: return None
+        return np.load(index_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+def write_index(index_path, index):
+    """
+    Writes an index file atomically, so that it can be shared by concurrent
+    readers. An index that cannot be written is rebuilt on the next read.
+
+    Parameters
+    ----------
+    index_path : path to the index file
+    index : a structured array of group names and cumulative sample offsets
+        of their ends
+    """
+
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as index_file:
+            np.save(index_file, index)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f'>> failed to write index {index_path}: {e}')
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def remove_mmap_dir(mmap_dir, pid):
+    """
+    Removes the directory of memory mapped arrays of an `InMemoryTrainDataset`
+    if called in the process which created it.
+
+    Parameters
+    ----------
+    mmap_dir : directory of memory mapped arrays
+    pid : ID of the process which created the directory
+    """
+
+    if os.getpid() == pid: shutil.rmtree(mmap_dir, ignore_errors=True)
+
+def load_memmap(path):
+    """
+    Memory maps a .npy file. The map is copy-on-write, so that arrays are
+    writable without modifying the file, since PyTorch warns about
+    converting read-only arrays to tensors.
+
+    Parameters
+    ----------
+    path : path to the .npy file
+
+    Returns
+    -------
+    array : memory mapped array
+    """
+
+    return np.load(path, mmap_mode='c')
+
+def is_flat_data(path):
+    """
+    Returns a flag indicating whether the provided path is a directory of
+    training data exported to the flat format.
+    """
+
+    return os.path.isfile(os.path.join(path, FLAT_INDEX))
+
+def get_flat_path(path, shard_name, array):
+    """
+    Returns path to the file of an array of a shard of exported data.
+
+    Parameters
+    ----------
+    path : path to the directory of exported data
+    shard_name : name of the shard
+    array : name of the array, one of `FLAT_ARRAYS`
+
+    Returns
+    -------
+    array_path : path to the .npy file of the array
+    """
+
+    return os.path.join(path, f'{shard_name}.{array}.npy')
+
+def read_flat_index(path):
+    """
+    Reads the index of training data exported to the flat format.
+
+    Parameters
+    ----------
+    path : path to the directory of exported data
+
+    Returns
+    -------
+    index : a dictionary holding the format version, geometry of windows,
+        data types and shapes of arrays and names and sizes of shards
+
+    Raises
+    ------
+    ValueError
+        If data was exported in an unsupported version of the format.
+    """
+
+    with open(os.path.join(path, FLAT_INDEX)) as index_file:
+        index = json.load(index_file)
+
+    if index.get('version') != FLAT_VERSION:
+        raise ValueError(f'Unsupported version {index.get("version")} of exported data in {path}, expected {FLAT_VERSION}.')
+    return index
+
+def batch_loader(dataset, batch_size, sampler, num_workers=0):
+    """
+    Returns a data loader of a `TrainDataset` which passes batches of
+    indices drawn from the provided sampler to the dataset, so that every
+    batch is read in a single call.
+
+    Parameters
+    ----------
+    dataset : `TrainDataset` object
+    batch_size : size of a single batch
+    sampler : sampler of single samples
+    num_workers : number of subprocesses used for data loading
+
+    Returns
+    -------
+    loader : `DataLoader` object
+    """
+
+    sampler = data.BatchSampler(sampler, batch_size, drop_last=False)
+    return data.DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=num_workers)
+
+def locate(offsets, idx):
+    """
+    Locates the group containing the sample with the provided index.
+
+    Parameters
+    ----------
+    offsets : an array of cumulative sample offsets of groups
+    idx : sample index
+
+    Returns
+    -------
+    group_idx : index of the group containing the sample
+    offset : sample offset inside the group
+    """
+
+    if idx < 0 or idx >= offsets[-1]: raise IndexError(f'Index {idx} is out of range.')
+
+    group_idx = int(np.searchsorted(offsets, idx, side='right')) - 1
+    return group_idx, idx - int(offsets[group_idx])
+
+def get_geometry(path):
+    """
+    Returns geometry of windows stored in .hdf5 files or exported data at
+    the provided path.
+
+    Parameters
+    ----------
+    path : path to a .hdf5 file, directory containing .hdf5 files or
+        directory of exported data
+
+    Returns
+    -------
+    geometry : `Geometry` object
+
+    Raises
+    ------
+    ValueError
+        If files were generated with different geometries.
+    """
+
+    if is_flat_data(path): return Geometry(**read_flat_index(path)['geometry'])
+
+    geometries = set()
+    for file_name in get_file_names(path):
+        with h5py.File(file_name, 'r') as f:
+            geometries.add(read_geometry(f))
+
+    if len(geometries) != 1: raise ValueError(f'Expected a single window geometry in {path}, found {geometries}.')
+    return geometries.pop()
+
 def get_file_names(path):
     """
     Returns an array of file names ending with .hdf5 that are stored
@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import time
+import h5py
+import numpy as np
+from dataset import get_file_names, get_groups, get_geometry, get_flat_path, FLAT_INDEX, FLAT_VERSION, FLAT_ARRAYS
+
+# number of samples in a shard, about 1.2 GB of examples of the default geometry
+SHARD_SIZE = 1 << 16
+
+def get_sources(data_path):
+    """
+    Returns groups of training data at the provided path, in the order in
+    which `TrainDataset` reads them.
+
+    Parameters
+    ----------
+    data_path : path to a .hdf5 file or directory containing .hdf5 files
+
+    Returns
+    -------
+    sources : an array of (file name, group names, group sizes) triples
+    """
+
+    sources = []
+    for file_name in get_file_names(data_path):
+        with h5py.File(file_name, 'r') as f:
+            groups, offsets = get_groups(f)
+        sources.append((file_name, groups, np.diff(offsets).tolist()))
+
+    return sources
+
+def get_arrays(sources, positions):
+    """
+    Returns data types and shapes of a single sample of exported arrays,
+    read from the first group containing data.
+
+    Parameters
+    ----------
+    sources : groups of training data returned by `get_sources`
+    positions : a flag indicating whether positions are exported
+
+    Returns
+    -------
+    arrays : a dictionary of data types and sample shapes keyed by array names
+
+    Raises
+    ------
+    ValueError
+        If positions are exported, but not stored in the data.
+    """
+
+    names = FLAT_ARRAYS if positions else [name for name in FLAT_ARRAYS if name != 'positions']
+
+    for file_name, groups, sizes in sources:
+        for g, size in zip(groups, sizes):
+            if size == 0: continue
+
+            with h5py.File(file_name, 'r') as f:
+                missing = [name for name in names if name not in f[g]]
+                if missing: raise ValueError(f'Group {g} in {file_name} does not store {", ".join(missing)}.')
+                return {name: {'dtype': f[g][name].dtype.str, 'shape': list(f[g][name].shape[1:])} for name in names}
+
+    return {}
+
+def export(data_path, out_path, shard_size=SHARD_SIZE, positions=True):
+    """
+    Converts training data written by `generate.py` into the flat format:
+    shards of at most `shard_size` samples, every array of which is stored
+    as a raw .npy file that can be memory mapped, and an index listing the
+    shards. Groups are read directly into memory mapped shards.
+
+    The index is written last, so that an interrupted export is never read,
+    and shards of a previous export to the same directory are removed.
+
+    Parameters
+    ----------
+    data_path : path to a .hdf5 file or directory containing .hdf5 files
+    out_path : path to the directory of exported data
+    shard_size : maximum number of samples in a shard
+    positions : a flag indicating whether positions of samples are exported
+
+    Returns
+    -------
+    size : number of exported samples
+    """
+
+    if shard_size < 1: raise ValueError('Shard size must be positive.')
+
+    geometry = get_geometry(data_path)
+    sources = get_sources(data_path)
+    arrays = get_arrays(sources, positions)
+    size = sum(sum(sizes) for _, _, sizes in sources)
+
+    os.makedirs(out_path, exist_ok=True)
+    index_path = os.path.join(out_path, FLAT_INDEX)
+    if os.path.exists(index_path): os.remove(index_path)
+    for entry in os.scandir(out_path):
+        if entry.name.startswith('shard_') and entry.name.endswith('.npy'): os.remove(entry.path)
+
+    shards = [
+        {'name': f'shard_{idx:05d}', 'size': min(shard_size, size - start)}
+        for idx, start in enumerate(range(0, size, shard_size))
+    ]
+
+    shard_idx, shard = -1, None
+    exported = 0
+    for file_name, groups, sizes in sources:
+        with h5py.File(file_name, 'r') as f:
+            for g, group_size in zip(groups, sizes):
+                start = 0
+                while start < group_size:
+                    # shards are filled in order, so only one is open at a time
+                    if exported // shard_size != shard_idx:
+                        if shard is not None: flush_shard(shard)
+                        shard_idx = exported // shard_size
+                        shard = open_shard(out_path, shards[shard_idx], arrays)
+
+                    offset = exported - shard_idx * shard_size
+                    count = min(group_size - start, shard_size - offset)
+                    for name in arrays:
+                        f[g][name].read_direct(shard[name], np.s_[start:start + count], np.s_[offset:offset + count])
+
+                    start += count
+                    exported += count
+
+        print(f'>> exported {file_name}')
+
+    if shard is not None: flush_shard(shard)
+
+    index = {
+        'version': FLAT_VERSION,
+        'geometry': {name: int(value) for name, value in geometry._asdict().items()},
+        'arrays': arrays,
+        'shards': shards,
+        'sources': [os.path.abspath(file_name) for file_name, _, _ in sources],
+    }
+
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w') as index_file:
+        json.dump(index, index_file, indent=4)
+    os.replace(tmp_path, index_path)
+
+    return size
+
+def open_shard(out_path, shard, arrays):
+    """
+    Creates memory mapped arrays of a shard.
+
+    Parameters
+    ----------
+    out_path : path to the directory of exported data
+    shard : a dictionary holding the name and size of the shard
+    arrays : a dictionary of data types and sample shapes keyed by array names
+
+    Returns
+    -------
+    shard_arrays : a dictionary of memory mapped arrays keyed by array names
+    """
+
+    return {
+        name: np.lib.format.open_memmap(
+            get_flat_path(out_path, shard['name'], name), mode='w+',
+            dtype=np.dtype(array['dtype']), shape=(shard['size'], *array['shape'])
+        )
+        for name, array in arrays.items()
+    }
+
+def flush_shard(shard):
+    """
+    Writes memory mapped arrays of a shard to the disk.
+
+    Parameters
+    ----------
+    shard : a dictionary of memory mapped arrays keyed by array names
+    """
+
+    for array in shard.values():
+        array.flush()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str)
+    parser.add_argument('--out_path', type=str)
+    parser.add_argument('--shard_size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--no_positions', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = export(args.data_path, args.out_path, args.shard_size, not args.no_positions)
+    print(f'>> exported samples: {size}, elapsed: {time.perf_counter() - start:.2f}s')
+
+if __name__ == '__main__':
+    main()
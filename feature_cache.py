@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+import numpy as np
+
+# Bump whenever feature or label generation or the format of entries changes,
+# so that stale entries are never served.
+CACHE_VERSION = 2
+
+# Once the cache grows beyond its maximum size, entries are evicted until it
+# shrinks to this fraction of it, so that the cache directory is scanned
+# again only after many new entries are written.
+EVICT_TO = 0.9
+
+CachedResult = namedtuple('CachedResult', ['result', 'hit', 'size'])
+
+def file_identity(path):
+    """
+    Returns identity of the provided file based on its path, size and
+    modification time.
+
+    Parameters
+    ----------
+    path : path to a file
+
+    Returns
+    -------
+    identity : a list of absolute path, size and modification time in nanoseconds
+    """
+
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+class FeatureCache:
+    """
+    A class that represents an on-disk cache of per-region generation results.
+
+    Every result is stored in a separate .npz file named after its key, batch
+    by batch. Files are written atomically, so the cache can be shared by multiple workers.
+    Sizes of entries written by workers are added to a running total when
+    their results are recorded. Once it grows beyond `max_size`, the cache
+    directory is scanned and the least recently used entries are evicted,
+    where a cache hit refreshes the modification time of an entry.
+
+    Attributes
+    ----------
+    cache_dir : path to the cache directory
+    max_size : maximum size of the cache in bytes
+    hits : number of results served from the cache
+    misses : number of generated results
+    read_bytes : size of results served from the cache
+    written_bytes : size of results written to the cache
+    evicted : number of evicted entries
+    total_size : running total of sizes of cached entries in bytes, `None`
+        until the cache directory is scanned
+    """
+
+    def __init__(self, cache_dir, max_size):
+        """
+        Parameters
+        ----------
+        cache_dir : path to the cache directory
+        max_size : maximum size of the cache in bytes
+        """
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.evicted = 0
+        self.total_size = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'], state['max_size'])
+
+    def path(self, key):
+        """
+        Returns path to the entry with the provided key.
+        """
+
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        Loads the entry with the provided key.
+
+        Parameters
+        ----------
+        key : entry key
+
+        Returns
+        -------
+        found : a flag indicating whether the entry was found
+        batches : cached batches of a generation result, empty for empty results
+        size : entry size in bytes
+        """
+
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                name = str(data['name'])
+                batches = [
+                    (name,) + tuple(data[f'arr_{i}_{j}'] for j in range(data['num_arrays']))
+                    for i in range(data['num_batches'])
+                ]
+            size = os.path.getsize(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return False, [], 0
+
+        return True, batches, size
+
+    def put(self, key, batches):
+        """
+        Stores batches of a generation result with the provided key. Batches
+        are stored as they are, so that they are never concatenated.
+
+        Parameters
+        ----------
+        key : entry key
+        batches : batches of a generation result, each a region name followed
+            by arrays
+
+        Returns
+        -------
+        size : entry size in bytes, 0 if the result could not be stored
+        """
+
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        name = batches[0][0] if batches else ''
+        num_arrays = len(batches[0]) - 1 if batches else 0
+        arrays = {f'arr_{i}_{j}': array for i, batch in enumerate(batches) for j, array in enumerate(batch[1:])}
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, name=np.array(name), num_batches=np.array(len(batches)), num_arrays=np.array(num_arrays), **arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # a result that cannot be cached is still returned
+            print(f'>> failed to cache a result: {e}')
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return 0
+
+        return os.path.getsize(path)
+
+    def add(self, size):
+        """
+        Adds the size of a written entry to the running total of sizes and
+        evicts entries if the cache grew beyond its maximum size.
+
+        Parameters
+        ----------
+        size : entry size in bytes
+        """
+
+        # the first scan already counts the written entry
+        if self.total_size is None: self.total_size = self.size()
+        else: self.total_size += size
+
+        if self.total_size > self.max_size: self.evicted += self.evict()
+
+    def evict(self):
+        """
+        Scans the cache directory and, if the cache is larger than its maximum
+        size, removes the least recently used entries until it shrinks to the
+        `EVICT_TO` fraction of it. The running total of sizes is set to the
+        size of the remaining entries.
+
+        Returns
+        -------
+        evicted : number of removed entries
+        """
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npz'): continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        size = sum(s for _, s, _ in entries)
+        self.total_size = size
+        if size <= self.max_size: return 0
+
+        evicted = 0
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size * EVICT_TO: break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self.total_size = size
+        return evicted
+
+    def size(self):
+        """
+        Returns the total size of cached entries in bytes.
+        """
+
+        return sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.name.endswith('.npz'))
+
+    def cached(self, function, paths):
+        """
+        Wraps a generation function yielding batches so that its batches are
+        served from and stored in the cache.
+
+        Parameters
+        ----------
+        function : generation function yielding batches, whose arguments end
+            with a region
+        paths : paths to input files the results depend on
+
+        Returns
+        -------
+        cached_function : a picklable wrapped generation function yielding
+            batches and returning a `CachedResult` object without a result
+        """
+
+        return CachedFunction(function, self, [file_identity(p) for p in paths])
+
+    def record(self, cached_result):
+        """
+        Records statistics of a result returned by a wrapped generation function.
+
+        Parameters
+        ----------
+        cached_result : `CachedResult` object
+
+        Returns
+        -------
+        result : generation result
+        """
+
+        if cached_result.hit:
+            self.hits += 1
+            self.read_bytes += cached_result.size
+        else:
+            self.misses += 1
+            self.written_bytes += cached_result.size
+            self.add(cached_result.size)
+
+        return cached_result.result
+
+    def print_stats(self):
+        """
+        Prints hit and miss statistics.
+        """
+
+        total = self.hits + self.misses
+        size = self.total_size if self.total_size is not None else self.size()
+        hit_rate = self.hits / total if total else 0
+        print(f'>> feature cache - hits: {self.hits}, misses: {self.misses}, hit rate: {hit_rate:.2%}')
+        print(f'>> feature cache - read: {self.read_bytes / 2**20:.1f} MB, written: {self.written_bytes / 2**20:.1f} MB, '
+            f'evicted: {self.evicted}, size: {size / 2**20:.1f}/{self.max_size / 2**20:.1f} MB')
+
+class CachedFunction:
+    """
+    A generation function yielding batches wrapped with the feature cache.
+
+    Attributes
+    ----------
+    function : generation function whose arguments end with a region
+    cache : feature cache
+    identities : identities of input files the results depend on
+    """
+
+    def __init__(self, function, cache, identities):
+        self.function = function
+        self.cache = cache
+        self.identities = identities
+
+    def key(self, args):
+        """
+        Returns the cache key of the provided generation function arguments.
+        """
+
+        *other_args, region = args
+        key = {
+            'version': CACHE_VERSION,
+            'function': self.function.__name__,
+            'files': self.identities,
+            # paths and generation parameters, such as feature geometry
+            'args': other_args,
+            # reads are sampled with a seed derived from the region
+            'region': [region.name, region.start, region.end],
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def __call__(self, args):
+        key = self.key(args)
+
+        found, batches, size = self.cache.get(key)
+        if found:
+            yield from batches
+            return CachedResult(None, True, size)
+
+        # batches are kept until the region is generated, since they are
+        # stored in a single entry
+        batches = []
+        for batch in self.function(args):
+            batches.append(batch)
+            yield batch
+
+        return CachedResult(None, False, self.cache.put(key, batches))
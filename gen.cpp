@@ -1,35 +1,122 @@
 #include <Python.h>
 #include <cstdio>
+#include <cstring>
+#include <string>
 
 #define PY_ARRAY_UNIQUE_SYMBOL gen_ARRAY_API
 #include "numpy/arrayobject.h"
 #include "generate_features.h"
 
-static PyObject* generate_features_cpp(PyObject *self, PyObject *args) {
-    char *file_name, *ref, *region;
-    if (!PyArg_ParseTuple(args, "sss", &file_name, &ref, &region)) return NULL;
+typedef struct {
+    PyObject_HEAD
+    BAMFile* bam_file;
+    bool in_use;
+} BAMFileObject;
 
-    auto result = generate_features(file_name, ref, region);
+static PyTypeObject BAMFileType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+};
+
+static int BAMFile_init(BAMFileObject *self, PyObject *args, PyObject *kwds) {
+    char *file_name;
+    if (!PyArg_ParseTuple(args, "s", &file_name)) return -1;
+
+    // the opened file is still read by generate_features or a FeatureIterator
+    if (self->in_use) {
+        PyErr_SetString(PyExc_RuntimeError, "BAM file is already used by another thread.");
+        return -1;
+    }
 
-    int N = result->positions.size();
-    PyObject *positions = PyList_New(N);
-    PyObject *X = PyList_New(result->X.size());
-    for (int i = 0; i < N; i++) {
-        auto& position = result->positions[i];
+    try {
+        auto bam_file = openBAMFile(file_name);
+        delete self->bam_file;
+        self->bam_file = bam_file.release();
+    } catch (const std::runtime_error& e) {
+        PyErr_SetString(PyExc_IOError, e.what());
+        return -1;
+    }
 
-        int M = position.size();
-        PyObject *list = PyList_New(M);
-        for (int j = 0; j < M; j++) {
-            PyObject *position_tuple = PyTuple_New(2);
-            PyTuple_SetItem(position_tuple, 0, PyLong_FromLong(position[j].first));
-            PyTuple_SetItem(position_tuple, 1, PyLong_FromLong(position[j].second));
+    return 0;
+}
 
-            PyList_SetItem(list, j, position_tuple);
+static void BAMFile_dealloc(BAMFileObject *self) {
+    delete self->bam_file;
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
+// default number of windows in a batch returned by FeatureIterator
+constexpr long BATCH_SIZE = 256;
+
+static bool check_geometry(const Geometry& geometry) {
+    if (geometry.rows < 1 || geometry.cols < 1 || geometry.stride < 1 || geometry.stride > geometry.cols ||
+            geometry.max_ins < 0 || geometry.ref_rows < 0 || geometry.ref_rows > geometry.rows) {
+        PyErr_SetString(PyExc_ValueError, "Invalid feature geometry.");
+        return false;
+    }
+    return true;
+}
+
+static bool check_max_depth(int max_depth) {
+    if (max_depth < 0) {
+        PyErr_SetString(PyExc_ValueError, "Maximum depth must not be negative.");
+        return false;
+    }
+    return true;
+}
+
+static bool get_seed(PyObject *seed_obj, const char *region, uint64_t *seed) {
+    if (seed_obj == Py_None) {
+        *seed = region_seed(region);
+    } else {
+        *seed = PyLong_AsUnsignedLongLongMask(seed_obj);
+        if (PyErr_Occurred()) return false;
+    }
+    return true;
+}
+
+// resolves the bam argument either to an opened BAM file, which is reserved
+// for the caller until released, or to a file path
+static bool reserve_bam(PyObject *bam, BAMFileObject **bam_obj, const char **file_name) {
+    *bam_obj = NULL;
+    *file_name = NULL;
+
+    if (PyObject_TypeCheck(bam, &BAMFileType)) {
+        auto obj = (BAMFileObject*) bam;
+        if (!obj->bam_file) {
+            PyErr_SetString(PyExc_ValueError, "BAM file is not opened.");
+            return false;
         }
+        // a BAM file cannot be read from multiple threads at the same time
+        if (obj->in_use) {
+            PyErr_SetString(PyExc_RuntimeError, "BAM file is already used by another thread.");
+            return false;
+        }
+        obj->in_use = true;
+        *bam_obj = obj;
+    } else {
+        *file_name = PyUnicode_AsUTF8(bam);
+        if (!*file_name) return false;
+    }
+    return true;
+}
+
+static PyObject* to_arrays(const Data& data, const Geometry& geometry) {
+    npy_intp positions_dims[3] = {data.size, geometry.cols, 2};
+    PyObject *positions = PyArray_SimpleNew(3, positions_dims, NPY_INT64);
+    if (!positions) return NULL;
+    auto positions_ptr = (int64_t*) PyArray_DATA((PyArrayObject*) positions);
+    for (size_t i = 0, n = data.positions.size(); i < n; i++) {
+        positions_ptr[2 * i] = data.positions[i].first;
+        positions_ptr[2 * i + 1] = data.positions[i].second;
+    }
 
-        PyList_SetItem(positions, i, list);
-        PyList_SetItem(X, i, result->X[i]);
+    npy_intp X_dims[3] = {data.size, geometry.rows, geometry.cols};
+    PyObject *X = PyArray_SimpleNew(3, X_dims, NPY_UINT8);
+    if (!X) {
+        Py_DECREF(positions);
+        return NULL;
     }
+    std::memcpy(PyArray_DATA((PyArrayObject*) X), data.X.data(), data.X.size());
 
     PyObject *return_value = PyTuple_New(2);
     PyTuple_SetItem(return_value, 0, positions);
@@ -38,10 +125,219 @@ static PyObject* generate_features_cpp(PyObject *self, PyObject *args) {
     return return_value;
 }
 
+static PyObject* generate_features_cpp(PyObject *self, PyObject *args, PyObject *kwds) {
+    static const char *kwlist[] = {
+        "bam", "ref", "region", "ref_start", "seed", "rows", "cols", "stride", "max_ins", "ref_rows", "max_depth", NULL
+    };
+
+    PyObject *bam;
+    char *ref, *region;
+    long ref_start = 0;
+    uint64_t seed;
+    PyObject *seed_obj = Py_None;
+    Geometry geometry;
+    int max_depth = 0;
+    if (!PyArg_ParseTupleAndKeywords(
+        args, kwds, "Oss|lOiiiiii", const_cast<char**>(kwlist), &bam, &ref, &region, &ref_start, &seed_obj,
+        &geometry.rows, &geometry.cols, &geometry.stride, &geometry.max_ins, &geometry.ref_rows, &max_depth
+    )) return NULL;
+
+    if (!check_geometry(geometry) || !check_max_depth(max_depth) || !get_seed(seed_obj, region, &seed)) return NULL;
+
+    BAMFileObject *bam_obj;
+    const char *file_name;
+    if (!reserve_bam(bam, &bam_obj, &file_name)) return NULL;
+
+    // features are generated without the GIL, arguments are kept alive by
+    // the caller and the BAM file is reserved for this call
+    std::unique_ptr<Data> result;
+    std::string error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        if (bam_obj) result = generate_features(*bam_obj->bam_file, ref, region, ref_start, seed, geometry, max_depth);
+        else result = generate_features(file_name, ref, region, ref_start, seed, geometry, max_depth);
+    } catch (const std::exception& e) {
+        error = e.what();
+    }
+    Py_END_ALLOW_THREADS
+
+    if (bam_obj) bam_obj->in_use = false;
+
+    if (!result) {
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
+        return NULL;
+    }
+
+    return to_arrays(*result, geometry);
+}
+
+typedef struct {
+    PyObject_HEAD
+    FeatureGenerator* generator;
+    BAMFileObject* bam_obj;
+    PyObject* ref;
+    Geometry geometry;
+    long batch_size;
+    bool in_use;
+    GeneratorStats stats;
+} FeatureIteratorObject;
+
+static PyTypeObject FeatureIteratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+};
+
+// destroys the generator and releases the BAM file and the reference
+static void FeatureIterator_release(FeatureIteratorObject *self) {
+    delete self->generator;
+    self->generator = NULL;
+
+    if (self->bam_obj) self->bam_obj->in_use = false;
+    Py_CLEAR(self->bam_obj);
+    Py_CLEAR(self->ref);
+}
+
+static int FeatureIterator_init(FeatureIteratorObject *self, PyObject *args, PyObject *kwds) {
+    static const char *kwlist[] = {
+        "bam", "ref", "region", "ref_start", "seed", "rows", "cols", "stride", "max_ins", "ref_rows", "batch_size",
+        "max_depth", NULL
+    };
+
+    PyObject *bam, *ref_obj;
+    char *region;
+    long ref_start = 0;
+    uint64_t seed;
+    PyObject *seed_obj = Py_None;
+    Geometry geometry;
+    long batch_size = BATCH_SIZE;
+    int max_depth = 0;
+    if (!PyArg_ParseTupleAndKeywords(
+        args, kwds, "OUs|lOiiiiili", const_cast<char**>(kwlist), &bam, &ref_obj, &region, &ref_start, &seed_obj,
+        &geometry.rows, &geometry.cols, &geometry.stride, &geometry.max_ins, &geometry.ref_rows, &batch_size,
+        &max_depth
+    )) return -1;
+
+    if (!check_geometry(geometry) || !check_max_depth(max_depth) || !get_seed(seed_obj, region, &seed)) return -1;
+    if (batch_size < 1) {
+        PyErr_SetString(PyExc_ValueError, "Batch size must be positive.");
+        return -1;
+    }
+
+    const char *ref = PyUnicode_AsUTF8(ref_obj);
+    if (!ref) return -1;
+
+    if (self->in_use) {
+        PyErr_SetString(PyExc_RuntimeError, "Feature iterator is already used by another thread.");
+        return -1;
+    }
+    FeatureIterator_release(self);
+    self->stats = GeneratorStats();
+
+    BAMFileObject *bam_obj;
+    const char *file_name;
+    if (!reserve_bam(bam, &bam_obj, &file_name)) return -1;
+
+    // the BAM file stays reserved and the reference alive until the iterator
+    // is exhausted or destroyed
+    Py_XINCREF(bam_obj);
+    self->bam_obj = bam_obj;
+    Py_INCREF(ref_obj);
+    self->ref = ref_obj;
+    self->geometry = geometry;
+    self->batch_size = batch_size;
+
+    FeatureGenerator *generator = NULL;
+    std::string error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        if (bam_obj) generator = new FeatureGenerator(*bam_obj->bam_file, ref, region, ref_start, seed, geometry, max_depth);
+        else generator = new FeatureGenerator(file_name, ref, region, ref_start, seed, geometry, max_depth);
+    } catch (const std::exception& e) {
+        error = e.what();
+    }
+    Py_END_ALLOW_THREADS
+
+    if (!generator) {
+        FeatureIterator_release(self);
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
+        return -1;
+    }
+    self->generator = generator;
+
+    return 0;
+}
+
+static PyObject* FeatureIterator_next(FeatureIteratorObject *self) {
+    if (!self->generator) return NULL;
+    if (self->in_use) {
+        PyErr_SetString(PyExc_RuntimeError, "Feature iterator is already used by another thread.");
+        return NULL;
+    }
+    self->in_use = true;
+
+    std::unique_ptr<Data> result;
+    std::string error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        result = self->generator->next(self->batch_size);
+    } catch (const std::exception& e) {
+        error = e.what();
+    }
+    Py_END_ALLOW_THREADS
+
+    self->in_use = false;
+    self->stats = self->generator->stats();
+
+    if (!result) {
+        FeatureIterator_release(self);
+        PyErr_SetString(PyExc_RuntimeError, error.c_str());
+        return NULL;
+    }
+
+    // the BAM file is released as soon as the region is exhausted
+    if (self->generator->done()) FeatureIterator_release(self);
+    if (result->size == 0) return NULL;
+
+    return to_arrays(*result, self->geometry);
+}
+
+static PyObject* FeatureIterator_get_stats(FeatureIteratorObject *self, void *closure) {
+    auto& stats = self->stats;
+    return Py_BuildValue(
+        "{s:d,s:d,s:l,s:l,s:l,s:l,s:l}",
+        "pileup_time", stats.pileup_time, "build_time", stats.build_time, "positions", stats.positions,
+        "windows", stats.windows, "depth_sum", stats.depth_sum, "max_depth", stats.max_depth,
+        "skipped_reads", stats.skipped_reads
+    );
+}
+
+static PyGetSetDef FeatureIterator_getset[] = {
+        {
+                "stats", (getter) FeatureIterator_get_stats, NULL,
+                "Statistics of batches generated so far: pileup_time and build_time in seconds, numbers of "
+                "processed positions and generated windows, depth_sum and max_depth of the pileup, and the number "
+                "of skipped_reads dropped by the depth cap.",
+                NULL
+        },
+        {NULL}
+};
+
+static void FeatureIterator_dealloc(FeatureIteratorObject *self) {
+    FeatureIterator_release(self);
+    Py_TYPE(self)->tp_free((PyObject*) self);
+}
+
 static PyMethodDef gen_methods[] = {
         {
-                "generate_features", generate_features_cpp, METH_VARARGS,
-                "Generate features for polisher."
+                "generate_features", (PyCFunction) generate_features_cpp, METH_VARARGS | METH_KEYWORDS,
+                "Generate features for polisher from a BAM file path or an opened gen.BAMFile. "
+                "The reference may be a slice of the contig beginning at the optional ref_start. "
+                "Reads are sampled with the optional seed, by default derived from the region, "
+                "and the GIL is released while features are generated. "
+                "Window geometry is set with the optional rows, cols, stride, max_ins and ref_rows, "
+                "which default to the module constants of the same names. "
+                "The optional max_depth caps the number of reads overlapping any position by skipping reads as "
+                "they enter the pileup, 0 keeps all reads. "
+                "Returns positions as an (N, cols, 2) int64 array and examples as an (N, rows, cols) uint8 array."
         },
         {NULL, NULL, 0, NULL}
 };
@@ -59,5 +355,61 @@ static struct PyModuleDef gen_definition = {
 PyMODINIT_FUNC PyInit_gen(void) {
     Py_Initialize();
     import_array();
-    return PyModule_Create(&gen_definition);
+
+    BAMFileType.tp_name = "gen.BAMFile";
+    BAMFileType.tp_doc = "BAM file opened once together with its index and header, reusable across generate_features calls.";
+    BAMFileType.tp_basicsize = sizeof(BAMFileObject);
+    BAMFileType.tp_flags = Py_TPFLAGS_DEFAULT;
+    BAMFileType.tp_new = PyType_GenericNew;
+    BAMFileType.tp_init = (initproc) BAMFile_init;
+    BAMFileType.tp_dealloc = (destructor) BAMFile_dealloc;
+    if (PyType_Ready(&BAMFileType) < 0) return NULL;
+
+    FeatureIteratorType.tp_name = "gen.FeatureIterator";
+    FeatureIteratorType.tp_doc =
+        "Iterator over features of a region, taking the same arguments as generate_features and an optional "
+        "batch_size, which defaults to BATCH_SIZE. Windows are generated as the pileup advances and yielded in "
+        "batches of (positions, examples) arrays of at most batch_size windows, which are identical to the "
+        "windows returned by generate_features for the same arguments. An opened gen.BAMFile is reserved until "
+        "the iterator is exhausted or destroyed.";
+    FeatureIteratorType.tp_basicsize = sizeof(FeatureIteratorObject);
+    FeatureIteratorType.tp_flags = Py_TPFLAGS_DEFAULT;
+    FeatureIteratorType.tp_new = PyType_GenericNew;
+    FeatureIteratorType.tp_init = (initproc) FeatureIterator_init;
+    FeatureIteratorType.tp_dealloc = (destructor) FeatureIterator_dealloc;
+    FeatureIteratorType.tp_iter = PyObject_SelfIter;
+    FeatureIteratorType.tp_iternext = (iternextfunc) FeatureIterator_next;
+    FeatureIteratorType.tp_getset = FeatureIterator_getset;
+    if (PyType_Ready(&FeatureIteratorType) < 0) return NULL;
+
+    PyObject *module = PyModule_Create(&gen_definition);
+    if (!module) return NULL;
+
+    Py_INCREF(&BAMFileType);
+    if (PyModule_AddObject(module, "BAMFile", (PyObject*) &BAMFileType) < 0) {
+        Py_DECREF(&BAMFileType);
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    Py_INCREF(&FeatureIteratorType);
+    if (PyModule_AddObject(module, "FeatureIterator", (PyObject*) &FeatureIteratorType) < 0) {
+        Py_DECREF(&FeatureIteratorType);
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    // default feature geometry and batch size
+    Geometry geometry;
+    if (PyModule_AddIntConstant(module, "ROWS", geometry.rows) < 0 ||
+            PyModule_AddIntConstant(module, "COLS", geometry.cols) < 0 ||
+            PyModule_AddIntConstant(module, "STRIDE", geometry.stride) < 0 ||
+            PyModule_AddIntConstant(module, "MAX_INS", geometry.max_ins) < 0 ||
+            PyModule_AddIntConstant(module, "REF_ROWS", geometry.ref_rows) < 0 ||
+            PyModule_AddIntConstant(module, "BATCH_SIZE", BATCH_SIZE) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    return module;
 }
\ No newline at end of file
@@ -1,8 +1,16 @@
 import argparse
-from data_generator import generate_inference_data, generate_train_data, generate_regions
-from Bio import SeqIO
-from hdf5_writer import TrainHDF5Writer, InferenceHDF5Writer
+from data_generator import iter_inference_data, iter_train_data, generate_regions, open_files, Region, CollectedFunction
+import pysam
+from hdf5_writer import TrainHDF5Writer, InferenceHDF5Writer, ShardIndexHDF5Writer, LAYOUTS, REGIONS_LAYOUT
+from async_writer import AsyncWriter, run_indexed, QUEUE_SIZE_PER_WORKER
+from planner import plan_regions, print_cost_report
+from feature_cache import FeatureCache
+from profiler import Profiler
+from shard_writer import ShardedFunction
+from geometry import add_geometry_arguments, parse_geometry
+from hdf5_options import add_hdf5_arguments, parse_hdf5_options
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 def main():
     parser = argparse.ArgumentParser()
@@ -11,38 +19,103 @@ def main():
     parser.add_argument('--ref_path', type=str)
     parser.add_argument('--out_path', type=str)
     parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--executor', type=str, choices=['process', 'thread'], default='process')
+    parser.add_argument('--layout', type=str, choices=LAYOUTS, default=REGIONS_LAYOUT)
+    parser.add_argument('--queue_size', type=int, default=None)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--shards', action='store_true')
+    parser.add_argument('--plan_regions', action='store_true')
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--cache_size', type=float, default=10.0)
+    parser.add_argument('--max_depth', type=int, default=0)
+    parser.add_argument('--profile_path', type=str, default=None)
+    parser.add_argument('--progress', action='store_true')
+    add_geometry_arguments(parser)
+    add_hdf5_arguments(parser)
     args = parser.parse_args()
 
-    with open(args.ref_path, 'r') as ref_file:
-        refs = [(str(r.id), str(r.seq)) for r in SeqIO.parse(ref_file, 'fasta')]
+    geometry = parse_geometry(args)
+    print(f'>> window geometry: {geometry}')
+    options = parse_hdf5_options(args)
+
+    queue_size = args.queue_size or QUEUE_SIZE_PER_WORKER * args.num_workers
 
     train = args.truth_genome_path is not None
-    generation_function = generate_train_data if train else generate_inference_data
+    generation_function = iter_train_data if train else iter_inference_data
     data_writer_class = TrainHDF5Writer if train else InferenceHDF5Writer
+    pool_class = ThreadPool if args.executor == 'thread' else Pool
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = FeatureCache(args.cache_dir, int(args.cache_size * 2**30))
+        input_paths = [args.reads_path, args.ref_path] + ([args.truth_genome_path] if train else [])
+        generation_function = cache.cached(generation_function, input_paths)
+
+    # batches are streamed to the writer by worker threads, or written to
+    # segment files by workers, which are linked to the output file written
+    # in the parent process; whole regions are collected only to be passed
+    # from worker processes
+    stream = args.executor == 'thread' and not args.shards
+    if args.shards:
+        generation_function = ShardedFunction(generation_function, args.out_path, data_writer_class, geometry, options)
+        data_writer_class = ShardIndexHDF5Writer
+    elif not stream:
+        generation_function = CollectedFunction(generation_function)
+
+    with data_writer_class(args.out_path, args.layout, args.resume, geometry, options) as writer, pysam.FastaFile(args.ref_path) as ref_file:
+        writer.write_contigs((ref_name, ref_file.fetch(ref_name)) for ref_name in ref_file.references)
 
-    with data_writer_class(args.out_path) as writer:
-        writer.write_contigs(refs)
+        with pool_class(processes=args.num_workers, initializer=open_files, initargs=(args.reads_path, args.ref_path, args.truth_genome_path)) as pool:
+            # regions depend on the number of workers and planning arguments,
+            # so a resumed file reuses the regions it was planned with
+            if writer.regions is not None:
+                regions = [Region.parse(region) for region in writer.regions]
+                costs = writer.region_costs
+                print(f'>> resuming - reusing planned regions: {len(regions)}')
+            else:
+                refs = list(zip(ref_file.references, ref_file.lengths))
+                costs = None
+                if args.plan_regions:
+                    regions, costs = plan_regions(pool, args.reads_path, refs, args.num_workers, args.max_depth)
+                else:
+                    regions = [region for ref_name, ref_len in refs for region in generate_regions(ref_len, ref_name)]
+                writer.write_regions([str(region) for region in regions], costs)
 
-        arguments = []
-        for ref_name, ref in refs:
-            for region in generate_regions(ref, ref_name):
-                arguments.append((args.reads_path, args.truth_genome_path, ref, region) if train else (args.reads_path, ref, region))
+            regions = [region for region in regions if str(region) not in writer.completed]
+            arguments = [
+                (args.reads_path, args.truth_genome_path, args.ref_path, geometry, args.max_depth, region) if train
+                else (args.reads_path, args.ref_path, geometry, args.max_depth, region)
+                for region in regions
+            ]
 
-        print(f'>> data generation started - number of tasks: {len(arguments)}')
+            # the profiler wraps the cache, so that cache hits are profiled too
+            profiler = None
+            if args.profile_path is not None or args.progress:
+                profiler = Profiler(regions, args.progress)
+                generation_function = profiler.wrap(generation_function)
 
-        with Pool(processes=args.num_workers) as pool:
-            regions_finished = 0
-            for result in pool.imap(generation_function, arguments):
-                if not result: continue
-                writer.store(result)
-                regions_finished += 1
+            if writer.completed:
+                print(f'>> resuming - skipped completed tasks: {len(writer.completed)}')
+            print(f'>> data generation started - number of tasks: {len(arguments)}')
 
-                if regions_finished % 10 == 0:
-                    print(f'>> writing to disk started')
-                    writer.write()
-                    print(f'>> writing to disk finished')
+            elapsed = [0.0] * len(regions)
+            with AsyncWriter(writer, regions, queue_size) as async_writer:
+                tasks = async_writer.tasks(generation_function, arguments, stream)
+                for idx, result, region_time in pool.imap_unordered(run_indexed, tasks):
+                    if profiler is not None: result = profiler.record(idx, result)
+                    if cache is not None: result = cache.record(result)
+                    elapsed[idx] = region_time
+                    async_writer.put(idx, result)
 
-            writer.write()
+        if costs is not None:
+            print_cost_report(regions, costs, elapsed)
+        if cache is not None:
+            cache.print_stats()
+        if profiler is not None:
+            profiler.print_summary()
+            if args.profile_path is not None:
+                profiler.write(args.profile_path)
+                print(f'>> profile written to {args.profile_path}')
 
 if __name__ == '__main__':
     main()
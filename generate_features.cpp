@@ -1,145 +1,303 @@
 #include "generate_features.h"
 #include "models.h"
 
-std::unordered_map<Bases, uint8_t, EnumClassHash> ENCODED_BASES = {
-        {Bases::A, 0},
-        {Bases::C, 1},
-        {Bases::G, 2},
-        {Bases::T, 3},
-        {Bases::GAP, 4},
-        {Bases::UNKNOWN, 5}
-};
-
-std::unique_ptr<Data> generate_features(const char *file_name, const char *ref, const char *region) {
+#include <chrono>
+#include <climits>
+#include <cstdint>
+#include <cstring>
+#include <random>
+#include <stdexcept>
+
+uint64_t region_seed(const char *region) {
+    uint64_t hash = 14695981039346656037ULL;
+    for (auto c = region; *c; c++) {
+        hash ^= static_cast<uint8_t>(*c);
+        hash *= 1099511628211ULL;
+    }
+    return hash;
+}
+
+std::unique_ptr<Data> generate_features(
+    const char *file_name, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry, int max_depth
+) {
+    FeatureGenerator generator(file_name, ref, region, ref_start, seed, geometry, max_depth);
+    return generator.next(LONG_MAX);
+}
+
+std::unique_ptr<Data> generate_features(
+    BAMFile& bam_file, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry, int max_depth
+) {
+    FeatureGenerator generator(bam_file, ref, region, ref_start, seed, geometry, max_depth);
+    return generator.next(LONG_MAX);
+}
+
+// ############################################################################
+//                              FeatureGenerator
+// ############################################################################
+
+FeatureGenerator::FeatureGenerator(
+    const char *file_name, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry, int max_depth
+) : owned_bam_file_(openBAMFile(file_name)), pileup_iter_(owned_bam_file_->pileup(region, max_depth)),
+    ref_(ref), ref_start_(ref_start), geometry_(geometry), rng_(seed),
+    columns_(geometry.cols + geometry.max_ins + 1) {}
+
+FeatureGenerator::FeatureGenerator(
+    BAMFile& bam_file, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry, int max_depth
+) : pileup_iter_(bam_file.pileup(region, max_depth)),
+    ref_(ref), ref_start_(ref_start), geometry_(geometry), rng_(seed),
+    columns_(geometry.cols + geometry.max_ins + 1) {}
+
+using Clock = std::chrono::steady_clock;
+
+static double seconds(Clock::time_point start, Clock::time_point end) {
+    return std::chrono::duration<double>(end - start).count();
+}
+
+std::unique_ptr<Data> FeatureGenerator::next(long max_windows) {
     auto data = std::unique_ptr<Data>(new Data());
 
-    std::vector<std::pair<long, long>> position_queue;
-    std::unordered_map<std::pair<long, long>, std::unordered_map<uint32_t, PosInfo>, pair_hash> align_info;
-    std::unordered_map<uint32_t, std::pair<long, long>> align_bounds;
-    std::unordered_map<uint32_t, bool> strand;
+    // the pileup time is the time of the call not spent building windows
+    auto start = Clock::now();
+    double build_time = 0;
+    auto finish = [&]() {
+        stats_.build_time += build_time;
+        stats_.pileup_time += seconds(start, Clock::now()) - build_time;
+        stats_.windows += data->size;
+        stats_.skipped_reads = pileup_iter_->skipped_reads();
+        return std::move(data);
+    };
 
-    auto bam_file = openBAMFile(file_name);
-    auto pileup_iter = bam_file->pileup(region);
+    while (true) {
+        // windows ready in the buffer are emitted before the pileup advances,
+        // so the buffer never holds more than a window and a position
+        if (columns_.size() >= geometry_.cols) {
+            auto build_start = Clock::now();
+            while (columns_.size() >= geometry_.cols && data->size < max_windows) add_window(*data);
+            build_time += seconds(build_start, Clock::now());
 
-    while (pileup_iter->has_next()) {
-        auto column = pileup_iter->next();
+            if (data->size == max_windows) return finish();
+        }
+
+        if (done_ || !pileup_iter_->has_next()) {
+            done_ = true;
+            return finish();
+        }
+
+        auto column = pileup_iter_->next();
 
         long ref_position = column->position;
-        if (ref_position < pileup_iter->start()) continue;
-        if (ref_position >= pileup_iter->end()) break;
+        if (ref_position < pileup_iter_->start()) continue;
+        if (ref_position >= pileup_iter_->end()) {
+            done_ = true;
+            return finish();
+        }
 
-        while(column->has_next()) {
-            auto r = column->next();
+        add_position(*column);
 
-            if (r->is_refskip()) continue;
+        long depth = column->count();
+        stats_.positions++;
+        stats_.depth_sum += depth;
+        stats_.max_depth = std::max(stats_.max_depth, depth);
+    }
+}
 
-            if (align_bounds.find(r->query_id()) == align_bounds.end()) {
-                align_bounds.emplace(r->query_id(), std::make_pair(r->ref_start(), r->ref_end()));
-            }
-            strand.emplace(r->query_id(), !r->rev());
+void FeatureGenerator::add_position(Position& column) {
+    // columns of the current position start at index first and there are
+    // n_columns of them, one for the position and one for every insertion
+    int first = columns_.size();
+    int n_columns = 0;
 
-            std::pair<long, long> index(ref_position, 0);
-            if (align_info.find(index) == align_info.end()) {
-                position_queue.emplace_back(ref_position, 0);
-            }
+    while(column.has_next()) {
+        auto r = column.next();
+        reads_.add(*r);
 
-            if (r->is_del()) {
-                // deletion
-                align_info[index].emplace(r->query_id(), PosInfo(Bases::GAP));
-            } else {
-                auto query_base = r->qbase(0);
-                align_info[index].emplace(r->query_id(), PosInfo(query_base));
+        if (r->is_refskip()) continue;
 
-                // insertion
-                for (int i = 1, n = std::min(r->indel(), MAX_INS); i <= n; i++) {
-                    index = std::pair<long, long>(ref_position, i);
+        if (n_columns == 0) {
+            columns_.push(column.position, 0);
+            n_columns++;
+        }
 
-                    if (align_info.find(index) == align_info.end()) {
-                        position_queue.emplace_back(ref_position, i);
-                    }
+        if (r->is_del()) {
+            // deletion
+            columns_[first].bases.emplace_back(r->query_id(), encode_base(Bases::GAP));
+        } else {
+            columns_[first].bases.emplace_back(r->query_id(), encode_base(r->qbase(0)));
 
-                    query_base = r->qbase(i);
-                    align_info[index].emplace(r->query_id(), PosInfo(query_base));
+            // insertion
+            for (int i = 1, n = std::min(r->indel(), geometry_.max_ins); i <= n; i++) {
+                if (i == n_columns) {
+                    columns_.push(column.position, i);
+                    n_columns++;
                 }
+
+                columns_[first + i].bases.emplace_back(r->query_id(), encode_base(r->qbase(i)));
             }
         }
+    }
+}
+
+void FeatureGenerator::add_window(Data& data) {
+    const int rows = geometry_.rows, cols = geometry_.cols;
+
+    // find aligns with a known base
+    uint32_t min_id = UINT32_MAX, max_id = 0;
+    for (auto s = 0; s < cols; s++) {
+        for (auto& base : columns_[s].bases) {
+            if (base.second == encode_base(Bases::UNKNOWN)) continue;
+
+            reads_[base.first].window = window_;
+            min_id = std::min(min_id, base.first);
+            max_id = std::max(max_id, base.first);
+        }
+    }
 
-        // building a feature matrix
-        while (position_queue.size() >= dimensions[1]) {
+    valid_.clear();
+    for (auto id = min_id; min_id <= max_id && id <= max_id; id++) {
+        auto& info = reads_[id];
+        if (info.window != window_) continue;
 
-            const auto it = position_queue.begin();
+        info.row = valid_.size();
+        valid_.push_back(id);
+    }
+    int valid_size = valid_.size();
 
-            // remove aligns with an unknown base
-            std::set<uint32_t> valid_aligns;
-            for (auto s = 0; s < dimensions[1]; s++) {
-                auto curr = it + s;
-                for (auto& align : align_info[*curr]) {
-                    if (align.second.base != Bases::UNKNOWN) {
-                        valid_aligns.emplace(align.first);
-                    }
-                }
+    // fill a row of every valid align, a base is unknown outside of the
+    // align and a gap inside of it unless the align has a base there
+    read_rows_.resize(valid_size * cols);
+    for (auto k = 0; k < valid_size; k++) {
+        auto& info = reads_[valid_[k]];
+        uint8_t* row = read_rows_.data() + k * cols;
+
+        for (auto s = 0; s < cols; s++) {
+            long position = columns_[s].position;
+            if (position < info.start || position > info.end) {
+                row[s] = encode_base(Bases::UNKNOWN);
+            } else {
+                row[s] = encode_base(Bases::GAP);
             }
+        }
+    }
 
-            std::vector<uint32_t> valid(valid_aligns.begin(), valid_aligns.end());
-            int valid_size = valid.size();
+    for (auto s = 0; s < cols; s++) {
+        for (auto& base : columns_[s].bases) {
+            auto& info = reads_[base.first];
+            if (info.window != window_) continue;
 
-            // initialize feature matrix
-            npy_intp dims[2];
-            for (int i = 0; i < 2; i++) dims[i] = dimensions[i];
-            auto X = PyArray_SimpleNew(2, dims, NPY_UINT8);
+            read_rows_[info.row * cols + s] = base.second;
+        }
+    }
 
-            uint8_t* value_ptr;
+    for (auto k = 0; k < valid_size; k++) {
+        if (reads_[valid_[k]].fwd) continue;
 
-            // fill first REF_ROWS with ref
-            for (auto s = 0; s < dimensions[1]; s++) {
-                auto curr = it + s; 
+        uint8_t* row = read_rows_.data() + k * cols;
+        for (auto s = 0; s < cols; s++) row[s] += REVERSE_OFFSET;
+    }
 
-                uint8_t value;
-                if (curr->second != 0) value = ENCODED_BASES[Bases::GAP];
-                else value = ENCODED_BASES[get_base(ref[curr->first])];
+    // initialize feature matrix
+    auto offset = data.X.size();
+    data.X.resize(offset + rows * cols);
+    uint8_t* X = data.X.data() + offset;
 
-                for (int r = 0; r < REF_ROWS; r++) {
-                    value_ptr = (uint8_t*) PyArray_GETPTR2(X, r, s);
-                    *value_ptr = value;
-                }
-            }
+    // fill first ref_rows with ref
+    for (auto s = 0; s < cols; s++) {
+        auto& curr = columns_[s];
 
-            // fill remaining (dimension[0] - REF_ROWS) rows with aligned reads
-            for (int r = REF_ROWS; r < dimensions[0]; r++) {
-                uint32_t query_id = valid[rand() % valid_size];
-
-                // auto it = position_queue.begin();
-                for (auto s = 0; s < dimensions[1]; s++) {
-                    auto curr = it + s;
-
-                    auto pos_itr = align_info[*curr].find(query_id);
-                    auto& bounds = align_bounds[query_id];
-                    uint8_t base;
-                    if (pos_itr == align_info[*curr].end()) {
-                        if (curr->first < bounds.first || curr->first > bounds.second) {
-                            base = ENCODED_BASES[Bases::UNKNOWN];
-                        } else {
-                            base = ENCODED_BASES[Bases::GAP];
-                        }
-                    } else {
-                        base = ENCODED_BASES[pos_itr->second.base];
-                    }
-
-                    auto& fwd = strand[query_id];
-                    value_ptr = (uint8_t*) PyArray_GETPTR2(X, r, s);
-                    *value_ptr = fwd ? base : (base + 6);
-                }
-            }
+        uint8_t value;
+        if (curr.ins != 0) value = encode_base(Bases::GAP);
+        else value = encode_base(get_base(ref_[curr.position - ref_start_]));
 
-            data->X.push_back(X);
-            data->positions.emplace_back(position_queue.begin(), position_queue.begin() + dimensions[1]);
+        for (int r = 0; r < geometry_.ref_rows; r++) {
+            X[r * cols + s] = value;
+        }
+    }
 
-            for (auto it = position_queue.begin(), end = position_queue.begin() + WINDOW; it != end; it++) {
-                align_info.erase(*it);
-            }
-            position_queue.erase(position_queue.begin(), position_queue.begin() + WINDOW);
+    // fill remaining (rows - ref_rows) rows with aligned reads, or with
+    // unknown bases if no read has a known base in the window
+    for (int r = geometry_.ref_rows; r < rows; r++) {
+        if (valid_size == 0) {
+            std::memset(X + r * cols, encode_base(Bases::UNKNOWN), cols);
+            continue;
         }
+
+        int k = rng_() % valid_size;
+        std::memcpy(X + r * cols, read_rows_.data() + k * cols, cols);
+    }
+
+    for (auto s = 0; s < cols; s++) {
+        data.positions.emplace_back(columns_[s].position, columns_[s].ins);
     }
+    data.size++;
+    window_++;
+
+    columns_.pop(geometry_.stride);
+    if (columns_.size() > 0) reads_.trim(columns_[0].position);
+}
+
+// ############################################################################
+//                                ColumnBuffer
+// ############################################################################
+
+ColumnBuffer::ColumnBuffer(int min_capacity) {
+    int capacity = 1;
+    while (capacity < min_capacity) capacity *= 2;
 
-    return data;
+    columns_.resize(capacity);
+    mask_ = capacity - 1;
+}
+
+Column& ColumnBuffer::push(long position, long ins) {
+    if (size_ == static_cast<int>(columns_.size())) throw std::runtime_error("Column buffer is full.");
+
+    auto& column = (*this)[size_++];
+    column.position = position;
+    column.ins = ins;
+    column.bases.clear();
+
+    return column;
+}
+
+void ColumnBuffer::pop(int n) {
+    head_ = (head_ + n) & mask_;
+    size_ -= n;
+}
+
+// ############################################################################
+//                                 ReadTable
+// ############################################################################
+
+ReadInfo& ReadTable::add(Alignment& read) {
+    auto id = read.query_id();
+    if (id < first_id_) throw std::runtime_error("Read is no longer stored in the read table.");
+
+    auto index = head_ + id - first_id_;
+    if (index >= reads_.size()) reads_.resize(index + 1);
+
+    // IDs skipped while the table grows belong to reads which already left
+    // the pileup, so they are kept with an end of -1 and trimmed right away
+    auto& info = reads_[index];
+    if (info.start < 0) {
+        info.start = read.ref_start();
+        info.end = read.ref_end();
+        info.fwd = !read.rev();
+    }
+
+    return info;
+}
+
+void ReadTable::trim(long position) {
+    while (head_ < reads_.size() && reads_[head_].end <= position) {
+        head_++;
+        first_id_++;
+    }
+
+    if (head_ > reads_.size() / 2) {
+        reads_.erase(reads_.begin(), reads_.begin() + head_);
+        head_ = 0;
+    }
 }
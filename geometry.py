@@ -0,0 +1,86 @@
+from collections import namedtuple
+
+Geometry = namedtuple('Geometry', ['rows', 'cols', 'stride', 'max_ins', 'ref_rows'])
+Geometry.__doc__ = """
+Geometry of generated windows.
+
+Attributes
+----------
+rows : number of rows of a window, i.e. number of sampled reads and reference rows
+cols : number of columns of a window, i.e. number of positions
+stride : distance between starts of consecutive windows in columns
+max_ins : maximum number of insertion columns after a single position
+ref_rows : number of rows filled with the reference
+"""
+
+# Matches defaults of `gen`, so that files written before geometry was stored
+# are read correctly.
+DEFAULT_GEOMETRY = Geometry(rows=200, cols=90, stride=30, max_ins=3, ref_rows=0)
+GEOMETRIES = {
+    'default': DEFAULT_GEOMETRY,
+    # fewer sampled reads and less overlap between windows for low-depth data
+    # and fast draft polishing
+    'fast': DEFAULT_GEOMETRY._replace(rows=64, stride=45),
+}
+
+def write_geometry(group, geometry):
+    """
+    Stores geometry in attributes of the provided .hdf5 group.
+
+    Parameters
+    ----------
+    group : .hdf5 group
+    geometry : `Geometry` object
+    """
+
+    for name, value in geometry._asdict().items():
+        group.attrs[name] = value
+
+def read_geometry(f):
+    """
+    Reads geometry stored in the `info` group of the provided .hdf5 file.
+
+    Parameters
+    ----------
+    f : .hdf5 file object
+
+    Returns
+    -------
+    geometry : `Geometry` object, `DEFAULT_GEOMETRY` if geometry is not stored
+    """
+
+    if 'info' not in f or 'rows' not in f['info'].attrs: return DEFAULT_GEOMETRY
+
+    attrs = f['info'].attrs
+    return Geometry(**{name: int(attrs[name]) for name in Geometry._fields})
+
+def add_geometry_arguments(parser):
+    """
+    Adds arguments selecting a geometry and overriding its fields to the
+    provided argument parser.
+
+    Parameters
+    ----------
+    parser : `argparse.ArgumentParser` object
+    """
+
+    parser.add_argument('--geometry', type=str, choices=list(GEOMETRIES), default='default')
+    for field in Geometry._fields:
+        parser.add_argument(f'--{field}', type=int, default=None)
+
+def parse_geometry(args):
+    """
+    Returns geometry selected by arguments added with `add_geometry_arguments`.
+
+    Parameters
+    ----------
+    args : parsed arguments
+
+    Returns
+    -------
+    geometry : `Geometry` object
+    """
+
+    return GEOMETRIES[args.geometry]._replace(
+        **{field: getattr(args, field) for field in Geometry._fields if getattr(args, field) is not None}
+    )
@@ -0,0 +1,145 @@
+from collections import namedtuple
+
+HDF5Options = namedtuple('HDF5Options', ['chunk_size', 'compression', 'compression_level', 'shuffle'])
+HDF5Options.__doc__ = """
+Chunking and filters of datasets written in .hdf5 files.
+
+Attributes
+----------
+chunk_size : number of windows in a chunk of examples
+compression : compression filter, one of `COMPRESSIONS`, or `None`
+compression_level : compression level of the `gzip` filter, from 0 to 9
+shuffle : a flag indicating whether bytes are shuffled before compression,
+    which groups bytes of the same significance of multi-byte values
+"""
+
+GZIP = 'gzip'
+LZF = 'lzf'
+COMPRESSIONS = [GZIP, LZF]
+
+# Matches how data was written before options were stored, so that files
+# written before are read correctly.
+DEFAULT_HDF5_OPTIONS = HDF5Options(chunk_size=1, compression=None, compression_level=4, shuffle=False)
+
+def check_hdf5_options(options):
+    """
+    Checks that the provided options are supported.
+
+    Parameters
+    ----------
+    options : `HDF5Options` object
+
+    Raises
+    ------
+    ValueError
+        If the chunk size, compression filter or compression level is invalid.
+    """
+
+    if options.chunk_size < 1: raise ValueError('Chunk size must be positive.')
+    if options.compression is not None and options.compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {options.compression}, expected one of {COMPRESSIONS}.')
+    if not 0 <= options.compression_level <= 9: raise ValueError('Compression level must be between 0 and 9.')
+
+def is_filtered(options):
+    """
+    Returns a flag indicating whether datasets are written with filters.
+    """
+
+    return options.compression is not None or options.shuffle
+
+def get_filters(options):
+    """
+    Returns filter arguments of `h5py.Group.create_dataset` selected by the
+    provided options.
+
+    Parameters
+    ----------
+    options : `HDF5Options` object
+
+    Returns
+    -------
+    filters : a dictionary of keyword arguments
+    """
+
+    filters = dict()
+    if options.compression is not None:
+        filters['compression'] = options.compression
+        if options.compression == GZIP: filters['compression_opts'] = options.compression_level
+    if options.shuffle:
+        filters['shuffle'] = True
+
+    return filters
+
+def write_hdf5_options(group, options):
+    """
+    Stores options in attributes of the provided .hdf5 group.
+
+    Parameters
+    ----------
+    group : .hdf5 group
+    options : `HDF5Options` object
+    """
+
+    group.attrs['chunk_size'] = options.chunk_size
+    group.attrs['compression'] = options.compression or 'none'
+    group.attrs['compression_level'] = options.compression_level
+    group.attrs['shuffle'] = options.shuffle
+
+def read_hdf5_options(f):
+    """
+    Reads options stored in the `info` group of the provided .hdf5 file.
+
+    Parameters
+    ----------
+    f : .hdf5 file object
+
+    Returns
+    -------
+    options : `HDF5Options` object, `DEFAULT_HDF5_OPTIONS` if options are not stored
+    """
+
+    if 'info' not in f or 'chunk_size' not in f['info'].attrs: return DEFAULT_HDF5_OPTIONS
+
+    attrs = f['info'].attrs
+    compression = str(attrs['compression'])
+    return HDF5Options(
+        chunk_size=int(attrs['chunk_size']),
+        compression=None if compression == 'none' else compression,
+        compression_level=int(attrs['compression_level']),
+        shuffle=bool(attrs['shuffle']),
+    )
+
+def add_hdf5_arguments(parser):
+    """
+    Adds arguments selecting chunking and filters of written datasets to the
+    provided argument parser.
+
+    Parameters
+    ----------
+    parser : `argparse.ArgumentParser` object
+    """
+
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_HDF5_OPTIONS.chunk_size)
+    parser.add_argument('--compression', type=str, choices=COMPRESSIONS, default=DEFAULT_HDF5_OPTIONS.compression)
+    parser.add_argument('--compression_level', type=int, default=DEFAULT_HDF5_OPTIONS.compression_level)
+    parser.add_argument('--shuffle_filter', action='store_true')
+
+def parse_hdf5_options(args):
+    """
+    Returns options selected by arguments added with `add_hdf5_arguments`.
+
+    Parameters
+    ----------
+    args : parsed arguments
+
+    Returns
+    -------
+    options : `HDF5Options` object
+    """
+
+    options = HDF5Options(
+        chunk_size=args.chunk_size, compression=args.compression,
+        compression_level=args.compression_level, shuffle=args.shuffle_filter,
+    )
+    check_hdf5_options(options)
+    return options
@@ -1,51 +1,177 @@
 import h5py
+import numpy as np
+import os
+import uuid
 from temporary_storage import TemporaryTrainStorage, TemporaryInferenceStorage
+from geometry import DEFAULT_GEOMETRY, write_geometry, read_geometry
+from hdf5_options import DEFAULT_HDF5_OPTIONS, check_hdf5_options, is_filtered, get_filters, write_hdf5_options, read_hdf5_options
 from abc import ABC
 from abc import abstractmethod
 
+REGIONS_LAYOUT = 'regions'
+CONTIGS_LAYOUT = 'contigs'
+LAYOUTS = [REGIONS_LAYOUT, CONTIGS_LAYOUT]
+
+SEGMENT_PREFIX = 'segment_'
+
 class HDF5Writer(ABC):
     """
     A class that represents a data writer for .hdf5 files.
 
+    Every write stores data in a new segment file in the
+    `<output_path>.segments` directory, which is never modified once written.
+    The output file only links data of segment files and is written anew on
+    every commit, after which it replaces the previous output file. A process
+    killed at any point therefore leaves either the output file of the
+    previous commit or the one of the new commit behind, while segment files
+    written after the last commit are removed when resuming.
+
+    Data can be written in one of two layouts:
+    - `regions` : every write creates a new group per contig containing
+        only the data stored since the previous write, which is linked to
+        the output file with an external link
+    - `contigs` : every contig has a single group in the output file with
+        virtual datasets concatenating data of the contig from all writes
+
+    Every write ends with a commit that records names of groups containing
+    data, their cumulative sample offsets and regions completed so far in
+    the `info` group. Regions planned for the file are stored as well, so
+    that a resumed file is generated for the same regions, which are
+    otherwise planned differently for different arguments. Geometry of
+    written windows and chunking and filters of datasets are stored in
+    attributes of the `info` group.
+
+    Examples are chunked by `chunk_size` windows. Filtered positions and
+    labels are chunked the same way, so that chunks of all datasets cover
+    the same windows, and are otherwise stored contiguously.
+
     Attributes
     ----------
     output_path : a path to output .hdf5 file
-    train : a flag that indicates whether data is intended for training
+    segment_dir : a path to the directory of segment files
+    layout : a layout in which data is written
+    resume : a flag indicating whether an existing file is resumed
+    geometry : geometry of written windows
+    options : chunking and filters of written datasets
+    storages : a dictionary of temporary storages, one per contig
+    groups : names of groups containing data
+    sizes : a dictionary of numbers of samples of groups containing data
+    sources : a dictionary of segment files of groups containing data,
+        relative to the output file, together with numbers of samples in them
+    changed : a set of groups to which data was added since the last commit
+    datasets : a dictionary of data types and sample shapes of datasets of
+        groups, `None` until data is written
+    contigs_file : a segment file containing contigs, relative to the output
+        file, `None` if not written
+    completed : a set of regions committed to the file
+    pending : regions completed since the last commit
+    regions : regions planned for the file, `None` if not written
+    region_costs : a dictionary of predicted costs of planned regions, `None`
+        if not written
     """
 
-    def __init__(self, output_path):
+    def __init__(self, output_path, layout=REGIONS_LAYOUT, resume=False, geometry=DEFAULT_GEOMETRY, options=DEFAULT_HDF5_OPTIONS):
         """
         Parameters
         ----------
         output_path : a path to output .hdf5 file
+        layout : a layout in which data is written, either `regions` or `contigs`
+        resume : a flag indicating whether an existing file is resumed
+        geometry : geometry of written windows
+        options : chunking and filters of written datasets
         """
 
+        if layout not in LAYOUTS: raise ValueError(f'Unknown layout {layout}.')
+        check_hdf5_options(options)
+
         self.output_path = output_path
+        self.segment_dir = get_segment_dir(output_path)
+        self.layout = layout
+        self.resume = resume
+        self.geometry = geometry
+        self.options = options
         self.storages = dict()
+        self.groups = []
+        self.sizes = dict()
+        self.sources = dict()
+        self.changed = set()
+        self.datasets = None
+        self.contigs_file = None
+        self.completed = set()
+        self.pending = []
+        self.regions = None
+        self.region_costs = None
 
     def __enter__(self):
-        self.f = h5py.File(self.output_path, 'w')
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+        if self.resume and os.path.exists(self.output_path):
+            self.__rollback()
+        else:
+            # an empty output file replaces the previous one before segment
+            # files linked by it are removed
+            self.__commit()
+
+        self.__remove_segments()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.f.close()
+        pass
 
     def write_contigs(self, refs):
         """
-        Writes contigs in the .hdf5 file.
+        Writes contigs in a new segment file and commits them, so that the
+        file can be resumed even if no data was written.
 
         Parameters
         ----------
         refs : an array of reference sequences
         """
 
-        contigs_group = self.f.create_group('contigs')
+        path = self.__segment_path()
+        with h5py.File(path, 'w') as f:
+            contigs_group = f.create_group('contigs')
+
+            for ref_name, ref in refs:
+                contig = contigs_group.create_group(ref_name)
+                contig.attrs['name'] = ref_name
+                contig.attrs['seq'] = ref
+                contig.attrs['len'] = len(ref)
+        sync(path)
+
+        previous_file, self.contigs_file = self.contigs_file, self.__relative_path(path)
+        self.__commit()
 
-        for ref_name, ref in refs:
-            contig = contigs_group.create_group(ref_name)
-            contig.attrs['name'] = ref_name
-            contig.attrs['seq'] = ref
-            contig.attrs['len'] = len(ref)
+        if previous_file is not None: os.remove(self.__absolute_path(previous_file))
+
+    def write_regions(self, regions, costs=None):
+        """
+        Writes regions planned for the file together with their predicted
+        costs and commits them, so that a resumed file is generated for the
+        same regions.
+
+        Parameters
+        ----------
+        regions : an array of region identifiers
+        costs : a dictionary of predicted costs keyed by region identifiers,
+            or `None`
+
+        Raises
+        ------
+        ValueError
+            If regions completed before are not among the provided ones.
+        """
+
+        unplanned = self.completed.difference(regions)
+        if unplanned:
+            raise ValueError(
+                f'Cannot resume a file with completed regions that are not planned, e.g. {min(unplanned)}. '
+                'Regions are planned differently for different arguments.'
+            )
+
+        self.regions = list(regions)
+        self.region_costs = dict(costs) if costs is not None else None
+        self.__commit()
 
     @abstractmethod
     def store(self, args):
@@ -55,40 +181,305 @@ class HDF5Writer(ABC):
         pass
 
 
+    def complete(self, region):
+        """
+        Marks a region as completed. The region is committed to the file
+        together with the data stored for it on the next write.
+
+        Parameters
+        ----------
+        region : region identifier
+        """
+
+        self.pending.append(region)
+
     def write(self):
         """
-        Writes all stored data in the .hdf5 file.
+        Writes all stored data in a new segment file and commits it.
         """
 
-        for storage in self.storages.values():
-            self.__write(storage)
-            storage.clear()
+        segment_path, groups = self.write_segment()
+        if segment_path is not None: self.add_segment(segment_path, groups)
+
+        self.__commit()
 
-    def __write(self, storage):
+    def write_segment(self):
         """
-        Writes a single storage chunk in the .hd5f file.
+        Writes all stored data in a new segment file without committing it.
+        The segment file is created only if there is data to write.
+
+        Returns
+        -------
+        segment_path : a path to the segment file, `None` if not created
+        groups : an array of names and sizes of written groups
         """
 
-        positions = storage.get_positions()
-        if len(positions) == 0: return
+        path, groups = self.__segment_path(), []
+
+        f = None
+        try:
+            for storage in self.storages.values():
+                if len(storage.get_positions()) > 0:
+                    if f is None: f = h5py.File(path, 'w')
+                    groups.append(self.__write(f, storage))
+                storage.clear()
+        finally:
+            if f is not None: f.close()
+
+        if f is None: return None, groups
+
+        sync(path)
+        return path, groups
+
+    def add_segment(self, segment_path, groups):
+        """
+        Adds groups written to a segment file, which are committed on the
+        next write.
 
+        Parameters
+        ----------
+        segment_path : a path to the segment file
+        groups : an array of names and sizes of written groups
+        """
+
+        file_name = self.__relative_path(segment_path)
+
+        for name, size in groups:
+            if name not in self.sources:
+                self.groups.append(name)
+                self.sizes[name] = 0
+                self.sources[name] = []
+            elif self.layout == REGIONS_LAYOUT:
+                raise ValueError(f'Group {name} is already written.')
+
+            self.sources[name].append((file_name, size))
+            self.sizes[name] += size
+            self.changed.add(name)
+
+    def __write(self, f, storage):
+        """
+        Writes a single storage chunk in a segment file.
+
+        Returns
+        -------
+        group : name and size of the written group
+        """
+
+        positions = storage.get_positions()
         X = storage.get_X()
         Y = storage.get_Y()
 
-        if Y: assert len(positions) == len(X) == len(Y)
+        if Y is not None: assert len(positions) == len(X) == len(Y)
         else: assert len(positions) == len(X)
 
-        start, end = positions[0][0][0], positions[-1][-1][0]
-
-        group = self.f.create_group(f'{storage.name}_{start}-{end}')
-        group['positions'] = positions
-
-        if Y: group['labels'] = Y
+        if self.layout == CONTIGS_LAYOUT:
+            name = storage.name
+        else:
+            start, end = positions[:, :, 0].min(), positions[:, :, 0].max()
+            name = f'{storage.name}_{start}-{end}'
 
+        group = f.create_group(name)
         group.attrs['contig'] = storage.name
         group.attrs['size'] = len(positions)
 
-        group.create_dataset('examples', data=X, chunks=(1, 200, 90))
+        datasets = [('positions', positions)] + ([('labels', Y)] if Y is not None else []) + [('examples', X)]
+        self.datasets = {dataset: (data.dtype, data.shape[1:]) for dataset, data in datasets}
+
+        filters = get_filters(self.options)
+        for dataset, data in datasets:
+            group.create_dataset(dataset, data=data, chunks=self.__chunks(data, examples=dataset == 'examples'), **filters)
+
+        return name, len(positions)
+
+    def __chunks(self, data, examples=False):
+        """
+        Returns the chunk shape of a dataset holding the provided data.
+
+        Parameters
+        ----------
+        data : an array of written data
+        examples : a flag indicating whether the data are examples
+
+        Returns
+        -------
+        chunks : chunk shape passed to `h5py.Group.create_dataset`
+        """
+
+        if not examples and not is_filtered(self.options): return None
+
+        # chunks cannot be longer than the data
+        return (min(self.options.chunk_size, len(data)),) + data.shape[1:]
+
+    def __commit(self):
+        """
+        Writes a new output file recording group names, cumulative sample
+        offsets of groups and completed regions in the `info` group and
+        linking data of segment files, and replaces the output file with it.
+        """
+
+        path = f'{self.output_path}.tmp'
+        completed = sorted(self.completed.union(self.pending))
+        sizes = [self.sizes[g] for g in self.groups]
+
+        with h5py.File(path, 'w') as f:
+            info = f.create_group('info')
+            info.attrs['layout'] = self.layout
+            write_geometry(info, self.geometry)
+            write_hdf5_options(info, self.options)
+
+            info.create_dataset('groups', data=np.array(self.groups, dtype=object), dtype=h5py.string_dtype())
+            info.create_dataset('offsets', data=np.concatenate(([0], np.cumsum(sizes, dtype=np.int64))))
+            info.create_dataset('completed', data=np.array(completed, dtype=object), dtype=h5py.string_dtype())
+
+            if self.regions is not None:
+                if self.region_costs is not None:
+                    info.create_dataset('region_costs', data=[self.region_costs[r] for r in self.regions], dtype=np.float64)
+                info.create_dataset('regions', data=np.array(self.regions, dtype=object), dtype=h5py.string_dtype())
+
+            if self.contigs_file is not None: f['contigs'] = h5py.ExternalLink(self.contigs_file, 'contigs')
+
+            if self.layout == REGIONS_LAYOUT:
+                for name in self.groups: f[name] = h5py.ExternalLink(self.sources[name][0][0], name)
+            else:
+                self.__create_virtual_groups(f)
+
+        sync(path)
+        os.replace(path, self.output_path)
+
+        self.completed.update(self.pending)
+        self.pending = []
+        self.changed.clear()
+
+    def __create_virtual_groups(self, f):
+        """
+        Creates groups of contigs in the `contigs` layout. Groups without new
+        data are copied from the output file of the last commit, which is
+        much faster than mapping their segment files again.
+        """
+
+        unchanged = [name for name in self.groups if name not in self.changed]
+        if not unchanged:
+            for name in self.groups: self.__create_virtual_group(f, name)
+            return
+
+        with h5py.File(self.output_path, 'r') as previous:
+            for name in self.groups:
+                if name in self.changed: self.__create_virtual_group(f, name)
+                else: previous.copy(previous[name], f, name=name)
+
+    def __create_virtual_group(self, f, name):
+        """
+        Creates a group of a contig whose datasets concatenate data of the
+        contig from all of its segment files.
+        """
+
+        size = self.sizes[name]
+
+        group = f.create_group(name)
+        group.attrs['contig'] = name
+        group.attrs['size'] = size
+
+        for dataset, (dtype, shape) in self.datasets.items():
+            layout = h5py.VirtualLayout(shape=(size,) + shape, dtype=dtype)
+
+            start = 0
+            for file_name, segment_size in self.sources[name]:
+                source = h5py.VirtualSource(file_name, f'{name}/{dataset}', shape=(segment_size,) + shape)
+                layout[start:start + segment_size] = source
+                start += segment_size
+
+            group.create_virtual_dataset(dataset, layout)
+
+    def __rollback(self):
+        """
+        Restores the state of the last commit of a resumed file. Segment
+        files written after it are removed afterwards, as they are not
+        linked from the output file.
+        """
+
+        with h5py.File(self.output_path, 'r') as f:
+            info = f['info']
+
+            layout = info.attrs['layout']
+            if layout != self.layout:
+                raise ValueError(f'Cannot resume a file written in the {layout} layout with the {self.layout} layout.')
+
+            geometry = read_geometry(f)
+            if geometry != self.geometry:
+                raise ValueError(f'Cannot resume a file written with {geometry} with {self.geometry}.')
+
+            options = read_hdf5_options(f)
+            if options != self.options:
+                raise ValueError(f'Cannot resume a file written with {options} with {self.options}.')
+
+            self.groups = list(info['groups'].asstr()[()]) if 'groups' in info else []
+            sizes = np.diff(info['offsets'][()]).tolist() if 'offsets' in info else []
+            self.sizes = dict(zip(self.groups, sizes))
+
+            if 'completed' in info:
+                self.completed = set(info['completed'].asstr()[()])
+
+            if 'regions' in info:
+                self.regions = list(info['regions'].asstr()[()])
+                if 'region_costs' in info: self.region_costs = dict(zip(self.regions, info['region_costs'][()].tolist()))
+
+            link = f.get('contigs', getlink=True)
+            if isinstance(link, h5py.ExternalLink): self.contigs_file = link.filename
+
+            # older versions wrote data in the output file itself
+            for name in f:
+                if name in ('info', 'contigs'): continue
+
+                link = f.get(name, getlink=True)
+                if name not in self.sizes or not (isinstance(link, h5py.ExternalLink) or all(d.is_virtual for d in f[name].values())):
+                    raise ValueError(f'Cannot resume a file with data written in it instead of segment files, e.g. {name}.')
+
+            for name in self.groups:
+                link = f.get(name, getlink=True)
+                if isinstance(link, h5py.ExternalLink):
+                    self.sources[name] = [(link.filename, self.sizes[name])]
+                    continue
+
+                group = f[name]
+                self.datasets = {dataset: (group[dataset].dtype, group[dataset].shape[1:]) for dataset in group}
+                # sources are ordered by the first samples they are mapped to
+                bounds = [(source.vspace.get_select_bounds(), source.file_name) for source in group['examples'].virtual_sources()]
+                self.sources[name] = [(file_name, int(end[0] - start[0] + 1)) for (start, end), file_name in sorted(bounds)]
+
+    def __remove_segments(self):
+        """
+        Removes segment files which are not linked from the output file.
+        """
+
+        linked = {self.__absolute_path(file_name) for sources in self.sources.values() for file_name, _ in sources}
+        if self.contigs_file is not None: linked.add(self.__absolute_path(self.contigs_file))
+
+        for entry in os.scandir(self.segment_dir):
+            if not entry.name.startswith(SEGMENT_PREFIX) or os.path.abspath(entry.path) in linked: continue
+            os.remove(entry.path)
+
+    def __segment_path(self):
+        """
+        Returns a path to a new segment file, which is unique, so that
+        segment files of other writers are never overwritten.
+        """
+
+        return os.path.join(self.segment_dir, f'{SEGMENT_PREFIX}{uuid.uuid4().hex}.hdf5')
+
+    def __relative_path(self, path):
+        """
+        Returns a path relative to the directory of the output file.
+        """
+
+        return os.path.relpath(path, os.path.dirname(os.path.abspath(self.output_path)))
+
+    def __absolute_path(self, file_name):
+        """
+        Returns an absolute path of a path relative to the directory of the
+        output file.
+        """
+
+        return os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(self.output_path)), file_name))
 
 class InferenceHDF5Writer(HDF5Writer):
 
@@ -113,3 +504,56 @@ class TrainHDF5Writer(HDF5Writer):
             storage = self.storages[contig] = TemporaryTrainStorage(contig)
 
         storage.store((positions, X, Y))
+
+class ShardIndexHDF5Writer(HDF5Writer):
+    """
+    A class that represents a writer of a master .hdf5 file indexing data
+    which workers write to segment files themselves, one per region. Only
+    the `regions` layout is supported.
+    """
+
+    def __init__(self, output_path, layout=REGIONS_LAYOUT, resume=False, geometry=DEFAULT_GEOMETRY, options=DEFAULT_HDF5_OPTIONS):
+        """
+        Parameters
+        ----------
+        output_path : a path to output .hdf5 file
+        layout : a layout in which data is written, has to be `regions`
+        resume : a flag indicating whether an existing file is resumed
+        geometry : geometry of written windows
+        options : chunking and filters of datasets written to segment files
+        """
+
+        if layout != REGIONS_LAYOUT: raise ValueError(f'Sharded output cannot be written in the {layout} layout.')
+        super().__init__(output_path, layout, resume, geometry, options)
+
+    def store(self, args):
+        """
+        Links groups written to a segment file by a worker. Links are
+        committed on the next write.
+
+        Parameters
+        ----------
+        segment_path : path to the segment file
+        groups : an array of names and sizes of written groups
+        """
+
+        self.add_segment(*args)
+
+def get_segment_dir(output_path):
+    """
+    Returns path to the directory of segment files of the provided output file.
+    """
+
+    return f'{output_path}.segments'
+
+def sync(path):
+    """
+    Flushes a closed file to the disk, so that it is complete before it is
+    linked or replaces another file.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
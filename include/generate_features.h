@@ -2,60 +2,162 @@
 #define GENERATE_FEATURES_H
 
 
-#include <Python.h>
+#include <cstdint>
 #include <memory>
+#include <random>
 #include <string>
-#include <unordered_map>
 #include <vector>
-#include <set>
 
 #include "models.h"
 
-extern "C" {
-    #define NO_IMPORT_ARRAY
-    #define PY_ARRAY_UNIQUE_SYMBOL gen_ARRAY_API
-    #include "numpy/arrayobject.h"
-}
-
 struct Data {
-    std::vector<std::vector<std::pair<long, long>>> positions;
-    std::vector<PyObject*> X;
+    // windows are stored back to back, positions as (N, cols) pairs and X as
+    // (N, rows, cols) row-major matrices
+    std::vector<std::pair<long, long>> positions;
+    std::vector<uint8_t> X;
+    long size = 0;
 };
 
-constexpr int dimensions[] = {200, 90};
-constexpr int CENTER = dimensions[1] / 2;
-constexpr int WINDOW = dimensions[1] / 3;
-constexpr int MAX_INS = 3;
-constexpr int REF_ROWS = 0;
+// window geometry, i.e. rows and columns of a window, the distance between
+// consecutive windows, maximum insertion length and number of reference rows
+struct Geometry {
+    int rows = 200;
+    int cols = 90;
+    int stride = 30;
+    int max_ins = 3;
+    int ref_rows = 0;
+};
 
-std::unique_ptr<Data> generate_features(const char *file_name, const char *ref, const char *region);
+// ref holds the reference sequence starting at the position ref_start and
+// reads are sampled with a random number generator initialized with seed;
+// reads entering the pileup are downsampled to max_depth, 0 keeps all reads
+std::unique_ptr<Data> generate_features(
+    const char *file_name, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry = Geometry(), int max_depth = 0
+);
+std::unique_ptr<Data> generate_features(
+    BAMFile& bam_file, const char *ref, const char *region, long ref_start, uint64_t seed,
+    const Geometry& geometry = Geometry(), int max_depth = 0
+);
+
+// a seed derived from the region string (64-bit FNV-1a), so that features
+// generated for a region do not depend on the order in which regions are processed
+uint64_t region_seed(const char *region);
+
+// encoded values of Bases, indexed by their enum values, and an offset added
+// to values of reads aligned to the reverse strand
+constexpr uint8_t ENCODED_BASES[] = {0, 1, 2, 3, 4, 5};
+constexpr uint8_t REVERSE_OFFSET = 6;
+
+inline uint8_t encode_base(Bases base) {
+    return ENCODED_BASES[static_cast<int>(base)];
+}
 
-struct PosInfo{ 
-    Bases base;
-    PosInfo(Bases b) : base(b) {};
+// a single feature column, i.e. a reference position or an insertion after it,
+// holding encoded bases of reads aligned to it in the order of read IDs
+struct Column {
+    long position;
+    long ins;
+    std::vector<std::pair<uint32_t, uint8_t>> bases;
 };
 
-struct EnumClassHash
-{
-    template <typename T>
-    std::size_t operator()(T t) const
-    {
-        return static_cast<std::size_t>(t);
-    }
+// a fixed-size ring buffer of columns waiting to be turned into windows,
+// whose memory is recycled as the front of the buffer advances
+class ColumnBuffer {
+
+    public:
+        explicit ColumnBuffer(int min_capacity);
+        Column& operator[](int i) { return columns_[(head_ + i) & mask_]; }
+        int size() const { return size_; }
+        Column& push(long position, long ins);
+        void pop(int n);
+
+    protected:
+        std::vector<Column> columns_;
+        int mask_;
+        int head_ = 0;
+        int size_ = 0;
 
 };
 
-extern std::unordered_map<Bases, uint8_t, EnumClassHash> ENCODED_BASES;
+struct ReadInfo {
+    long start = -1;
+    long end = -1;
+    bool fwd = true;
+    long window = -1;   // the last window in which the read has a known base
+    int row = 0;        // the row of the read in that window
+};
+
+// a table of reads indexed by pileup read IDs, which are assigned to reads in
+// increasing order as they enter the pileup
+class ReadTable {
+
+    public:
+        ReadInfo& operator[](uint32_t id) { return reads_[head_ + id - first_id_]; }
+        ReadInfo& add(Alignment& read);
+        void trim(long position);
 
-struct pair_hash {
+    protected:
+        std::vector<ReadInfo> reads_;
+        size_t head_ = 0;
+        uint32_t first_id_ = 0;
 
-    template <class T1, class T2>
-    std::size_t operator () (const std::pair<T1,T2> &p) const {
-        auto h1 = std::hash<T1>{}(p.first);
-        auto h2 = std::hash<T2>{}(p.second);
+};
+
+// time spent in the pileup and in building windows, numbers of processed
+// positions and windows, the sum and maximum of pileup depths and the number
+// of reads skipped by the depth cap
+struct GeneratorStats {
+    double pileup_time = 0;
+    double build_time = 0;
+    long positions = 0;
+    long windows = 0;
+    long depth_sum = 0;
+    long max_depth = 0;
+    long skipped_reads = 0;
+};
 
-        return h1 ^ h2;  
-    }
+// generates windows of a region in batches as the pileup advances, so that
+// memory does not grow with the size of the region; ref must outlive the
+// generator and the BAM file must not be used by anything else until the
+// generator is destroyed
+class FeatureGenerator {
+
+    public:
+        FeatureGenerator(
+            const char *file_name, const char *ref, const char *region, long ref_start, uint64_t seed,
+            const Geometry& geometry = Geometry(), int max_depth = 0
+        );
+        FeatureGenerator(
+            BAMFile& bam_file, const char *ref, const char *region, long ref_start, uint64_t seed,
+            const Geometry& geometry = Geometry(), int max_depth = 0
+        );
+        // returns at most max_windows windows, fewer only once the region is
+        // exhausted, after which empty batches are returned
+        std::unique_ptr<Data> next(long max_windows);
+        bool done() const { return done_; }
+        const GeneratorStats& stats() const { return stats_; }
+
+    protected:
+        std::unique_ptr<BAMFile> owned_bam_file_;
+        std::unique_ptr<PositionIterator> pileup_iter_;
+        const char *ref_;
+        long ref_start_;
+        Geometry geometry_;
+        std::mt19937_64 rng_;
+
+        ColumnBuffer columns_;
+        ReadTable reads_;
+        // reads with a known base in the current window, ordered by their IDs,
+        // and their (valid_.size(), cols) matrix of encoded bases
+        std::vector<uint32_t> valid_;
+        std::vector<uint8_t> read_rows_;
+        long window_ = 0;
+        bool done_ = false;
+        GeneratorStats stats_;
+
+        void add_position(Position& column);
+        void add_window(Data& data);
 
 };
 
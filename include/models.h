@@ -1,16 +1,26 @@
 #ifndef MODELS_H
 #define MODELS_H
 
+#include <functional>
 #include <memory>
+#include <queue>
+#include <stdexcept>
 #include <string>
+#include <vector>
 
 extern "C" {
     #include "../Dependencies/htslib-1.11/htslib/sam.h"
 
+    // max_depth caps the number of reads overlapping any position, where 0
+    // disables the cap; read_ends holds ends of admitted reads which may still
+    // overlap the next read
     typedef struct {
         htsFile* file;
         bam_hdr_t* header;
         hts_itr_t* iter;
+        int max_depth;
+        std::priority_queue<hts_pos_t, std::vector<hts_pos_t>, std::greater<hts_pos_t>> read_ends;
+        long skipped_reads;
     } PileupData;
 
     int iter_bam(void* data, bam1_t* b);
@@ -38,7 +48,7 @@ class BAMFile {
 
     public:
         friend std::unique_ptr<BAMFile> openBAMFile(const char *);
-        std::unique_ptr<PositionIterator> pileup(const std::string&);
+        std::unique_ptr<PositionIterator> pileup(const std::string&, int max_depth = 0);
 
     protected:
         std::unique_ptr<htsFile, decltype(&hts_close)> bam_;
@@ -56,11 +66,13 @@ class BAMFile {
 class PositionIterator {
 
     public:
-        friend std::unique_ptr<PositionIterator> BAMFile::pileup(const std::string&);
+        friend std::unique_ptr<PositionIterator> BAMFile::pileup(const std::string&, int);
         std::unique_ptr<Position> next();
         bool has_next();
         int start() { return region_->start; };
         int end() { return region_->end; };
+        long skipped_reads() { return pileup_data_->skipped_reads; };
+        ~PositionIterator();
 
     protected:
         std::unique_ptr<PileupData> pileup_data_;
@@ -4,9 +4,9 @@ from model import RNN
 from dataset import InferenceDataset
 from torch.utils.data import DataLoader
 import torch
-from coder import Coder
-from collections import defaultdict, Counter
-import itertools
+from consensus import Votes
+from collections import defaultdict
+import numpy as np
 from Bio.Seq import Seq
 from Bio import SeqIO, SeqRecord
 
@@ -15,9 +15,36 @@ def inference(args):
     model = RNN.load_from_checkpoint(args.model_path).to('cuda:0' if cuda_available else 'cpu')
 
     dataset = InferenceDataset(args.data_path)
-    dataloader = DataLoader(dataset, args.batch_size, num_workers=args.num_workers)
+    if (model.rows, model.cols) != (dataset.geometry.rows, dataset.geometry.cols):
+        raise ValueError(f'Model expects {model.rows}x{model.cols} windows, data contains '
+            f'{dataset.geometry.rows}x{dataset.geometry.cols} windows.')
 
-    result = defaultdict(lambda: defaultdict(lambda: Counter()))
+    records = polish_contigs(model, dataset, args.batch_size, args.num_workers)
+
+    with open(args.out_path, 'w') as f:
+        SeqIO.write(records, f, 'fasta')
+
+def polish_contigs(model, dataset, batch_size, num_workers):
+    """
+    Predicts bases of all windows of the provided dataset and builds
+    consensus contigs.
+
+    Parameters
+    ----------
+    model : model used for prediction
+    dataset : inference dataset
+    batch_size : batch size of the inference data
+    num_workers : number of subprocesses used for data loading
+
+    Returns
+    -------
+    records : an array of polished contigs
+    """
+
+    cuda_available = torch.cuda.is_available()
+    dataloader = DataLoader(dataset, batch_size, num_workers=num_workers)
+
+    result = defaultdict(lambda: Votes(dataset.geometry.max_ins))
 
     print('>> started inference')
     for batch in dataloader:
@@ -27,40 +54,23 @@ def inference(args):
         output = model(X)
         Y = torch.argmax(output, dim=2).long().cpu().numpy()
 
-        for c, pos, ys in zip(contig, position, Y):
-            for p, y in zip(pos, ys):
-                base = Coder.decode(y)
-
-                current_position = (p[0].item(), p[1].item())
-                result[c][current_position][base] += 1
+        contig = np.array(contig)
+        for c in np.unique(contig):
+            mask = contig == c
+            result[c].add(position.numpy()[mask], Y[mask])
 
     print('>> started processing of results')
     contigs = dataset.contigs
     records = []
     for contig in result:
-        values = result[contig]
-
-        sorted_positions = sorted(values)
-        sorted_positions = list(itertools.dropwhile(lambda x: x[1] != 0, sorted_positions))
-
-        first = sorted_positions[0][0]
-        contig_data = contigs[contig]
-        seq = contig_data[0][:first]
-
-        for _, p in enumerate(sorted_positions):
-            base, _ = values[p].most_common(1)[0]
-            if base == Coder.GAP: continue
-            seq += base
-
-        last_position = sorted_positions[-1][0]
-        seq += contig_data[0][last_position+1:]
+        seq = result[contig].consensus(contigs[contig][0])
+        if seq is None: continue
 
         seq = Seq(seq)
         record = SeqRecord.SeqRecord(seq, id=contig)
         records.append(record)
 
-    with open(args.out_path, 'w') as f:
-        SeqIO.write(records, f, 'fasta')
+    return records
 
 def main():
     parser = argparse.ArgumentParser()
@@ -12,6 +12,8 @@ class RNN(core.LightningModule):
     Attributes
     ----------
     input_size : input size
+    rows : number of rows of an input window
+    cols : number of columns of an input window
     accuracy : metrics object for calculating accuracy
     """
 
@@ -20,8 +22,10 @@ class RNN(core.LightningModule):
     HIDDEN_SIZE = 128
     NUM_LAYERS = 3
     DROPOUT = 0.2
+    ROWS = 200
+    COLS = 90
 
-    def __init__(self, input_size=INPUT_SIZE, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS, dropout=DROPOUT):
+    def __init__(self, input_size=INPUT_SIZE, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS, dropout=DROPOUT, rows=ROWS, cols=COLS):
         """
         Parameters
         ----------
@@ -29,16 +33,21 @@ class RNN(core.LightningModule):
         hidden_size : number of features in the hidden state in GRU
         num_layers : number of recurrent layers in GRU
         dropout : dropout probability
+        rows : number of rows of an input window
+        cols : number of columns of an input window
         """
 
         super().__init__()
+        self.save_hyperparameters()
 
         self.in_size = input_size
+        self.rows = rows
+        self.cols = cols
         self.accuracy = metrics.Accuracy()
 
         self.embedding_layer = nn.Embedding(12, 50)
         self.dropout_layer_1 = nn.Dropout(dropout)
-        self.linear_layer_1 = nn.Linear(200, 100)
+        self.linear_layer_1 = nn.Linear(rows, 100)
         self.dropout_layer_2 = nn.Dropout(dropout)
         self.linear_layer_2 = nn.Linear(100, 10)
         self.dropout_layer_3 = nn.Dropout(dropout)
@@ -81,7 +90,7 @@ class RNN(core.LightningModule):
 
         x = self.dropout_layer_3(x)
 
-        x = x.reshape(-1, 90, self.in_size)
+        x = x.reshape(-1, self.cols, self.in_size)
         x, _ = self.gru_layer(x)
 
         return self.linear_layer_3(x)
@@ -21,6 +21,22 @@ extern "C" {
             if (b->core.flag & filter_flag) continue;
             if (b->core.flag & BAM_FPAIRED && ((b->core.flag & BAM_FPROPER_PAIR) == 0)) continue;
             if (b->core.qual < min_mapping_quality) continue;
+
+            if (plp_data->max_depth > 0) {
+                // reads arrive sorted by their start, so a read is admitted
+                // only while fewer than max_depth admitted reads overlap its
+                // start, which keeps the cap independent of sampling seeds;
+                // earlier reads are preferred, and since reads starting before
+                // the region are seen only if they overlap its start, reads
+                // admitted near the region start depend on where it starts
+                auto& ends = plp_data->read_ends;
+                while (!ends.empty() && ends.top() <= b->core.pos) ends.pop();
+                if (ends.size() >= static_cast<size_t>(plp_data->max_depth)) {
+                    plp_data->skipped_reads++;
+                    continue;
+                }
+                ends.push(bam_endpos(b));
+            }
             break;
         }
 
@@ -51,11 +67,13 @@ std::unique_ptr<BAMFile> openBAMFile(const char *file_name) {
     return std::unique_ptr<BAMFile>(new BAMFile(std::move(bam), std::move(idx), std::move(header)));
 }
 
-std::unique_ptr<PositionIterator> BAMFile::pileup(const std::string& region) {
+std::unique_ptr<PositionIterator> BAMFile::pileup(const std::string& region, int max_depth) {
     std::unique_ptr<PileupData> data(new PileupData);
     data->file = this->bam_.get();
     data->header = this->header_.get();
     data->iter = bam_itr_querys(this->bam_idx_.get(), this->header_.get(), region.c_str());
+    data->max_depth = max_depth;
+    data->skipped_reads = 0;
 
     auto data_raw = data.get();
     bam_mplp_t mplp = bam_mplp_init(1, iter_bam, (void **) &data_raw);
@@ -87,6 +105,10 @@ PositionIterator::PositionIterator(
     pileup_(std::move(pileup)),
     region_(std::move(region)) {}
 
+PositionIterator::~PositionIterator() {
+    if (pileup_data_->iter) hts_itr_destroy(pileup_data_->iter);
+}
+
 bool PositionIterator::has_next() {
     if (processed_) {
         current_next_ = bam_mplp_auto(mplp_iter_.get(), &tid_, &pos_, &count_, pileup_.get());
@@ -0,0 +1,320 @@
+import heapq
+import os
+import struct
+import numpy as np
+import pysam
+from data_generator import Region, WINDOW, OVERLAP
+
+COST_BIN = 1_000
+# Size of the tiles of the linear BAM index, and the number of compressed
+# bytes of reads read to relate compressed bytes to aligned read bases.
+INDEX_TILE = 16_384
+CALIBRATION_SIZE = 1 << 20
+MIN_WINDOW = 10_000
+MAX_WINDOW = 400_000
+TASKS_PER_WORKER = 4
+# Cost of processing a single reference column regardless of its depth,
+# expressed in aligned read bases.
+COLUMN_COST = 20
+
+# Mirrors read filtering done by `iter_bam` in models.cpp.
+FILTER_FLAG = 0x4 | 0x100 | 0x200 | 0x400 | 0x800
+MIN_MAPPING_QUALITY = 10
+# Pseudo-bin of the BAI index holding offsets of the first and the last read
+# of a contig.
+PSEUDO_BIN = 37450
+
+def read_index_offsets(reads_path):
+    """
+    Reads compressed file offsets of index tiles from the BAI index of the
+    provided aligned reads file. Offsets of a contig are followed by the
+    offset of the end of its reads, so that their differences are sizes of
+    reads starting in every tile.
+
+    Parameters
+    ----------
+    reads_path : path to the aligned reads file
+
+    Returns
+    -------
+    offsets : a dictionary of offset arrays of contigs with an indexed tile,
+        None if there is no BAI index
+    """
+
+    index_paths = [reads_path + '.bai', os.path.splitext(reads_path)[0] + '.bai']
+    index_path = next((path for path in index_paths if os.path.isfile(path)), None)
+    if index_path is None: return None
+
+    with open(index_path, 'rb') as f: data = f.read()
+    if data[:4] != b'BAI\1': return None
+
+    with pysam.AlignmentFile(reads_path, 'rb') as reads_file:
+        ref_names = reads_file.references
+
+    offsets = dict()
+    n_ref, = struct.unpack_from('<i', data, 4)
+    position = 8
+    for ref_name in ref_names[:n_ref]:
+        end = 0
+        n_bin, = struct.unpack_from('<i', data, position)
+        position += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, position)
+            if bin_id == PSEUDO_BIN: end, = struct.unpack_from('<Q', data, position + 16)
+            position += 8 + 16 * n_chunk
+
+        n_intv, = struct.unpack_from('<i', data, position)
+        tiles = np.frombuffer(data, dtype='<u8', count=n_intv, offset=position + 4)
+        position += 4 + 8 * n_intv
+        if n_intv == 0: continue
+
+        # tiles without reads are stored as zeros, or as offsets of preceding
+        # tiles, so zeros are replaced with offsets of the first read
+        tiles = np.append(tiles, np.uint64(end)) >> np.uint64(16)
+        tiles[tiles == 0] = tiles[tiles > 0].min() if np.any(tiles > 0) else 0
+        offsets[ref_name] = np.maximum.accumulate(tiles.astype(np.int64))
+
+    return offsets
+
+def admitted_reads(reads, max_depth):
+    """
+    Filters reads the same way as reads entering the pileup are filtered.
+
+    Parameters
+    ----------
+    reads : reads sorted by their start
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
+
+    Returns
+    -------
+    reads : a generator of admitted reads
+    """
+
+    # ends of admitted reads which may still overlap the next read
+    active_ends = []
+    for read in reads:
+        if read.flag & FILTER_FLAG: continue
+        if read.is_paired and not read.is_proper_pair: continue
+        if read.mapping_quality < MIN_MAPPING_QUALITY: continue
+
+        if max_depth > 0:
+            while active_ends and active_ends[0] <= read.reference_start: heapq.heappop(active_ends)
+            if len(active_ends) >= max_depth: continue
+            heapq.heappush(active_ends, read.reference_end)
+
+        yield read
+
+def coverage_integral(starts, ends, positions):
+    """
+    Computes the number of aligned read bases preceding every provided position.
+
+    Parameters
+    ----------
+    starts : sorted read start positions
+    ends : sorted read end positions
+    positions : positions at which the integral is evaluated
+
+    Returns
+    -------
+    integral : an array of aligned base counts, one per position
+    """
+
+    starts_sum = np.concatenate(([0], np.cumsum(starts)))
+    ends_sum = np.concatenate(([0], np.cumsum(ends)))
+
+    started = np.searchsorted(starts, positions)
+    ended = np.searchsorted(ends, positions)
+
+    return (started * positions - starts_sum[started]) - (ended * positions - ends_sum[ended])
+
+def estimate_costs(args):
+    """
+    Estimates the cost of generating data along a single contig. The cost of
+    a region is the number of aligned read bases inside it, which is
+    proportional to the amount of pileup work done for it, increased by a
+    fixed cost of every reference column.
+
+    Aligned bases are estimated from the BAI index, without reading all
+    reads; compressed sizes of reads starting in every index tile are
+    converted to aligned bases using reads read from the contig start, and
+    spread over the mean read length. Estimated depths are capped at
+    `max_depth`. Reads are counted exactly if there is no index or if all
+    reads of the contig are read that way.
+
+    Parameters
+    ----------
+    reads_path : path to the aligned reads file
+    ref_name : contig name
+    length : contig length
+    bin_size : distance between positions at which the cost is evaluated
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
+    offsets : compressed offsets of index tiles (see `read_index_offsets`),
+        None if there is no index
+    calibration_size : number of compressed bytes of reads read to convert
+        compressed sizes to aligned bases
+
+    Returns
+    -------
+    ref_name : contig name
+    edges : positions at which the cost is evaluated, ending with `length`
+    cumulative : cumulative cost at every edge
+    """
+
+    reads_path, ref_name, length, bin_size, max_depth, offsets, calibration_size = args
+    edges = np.append(np.arange(0, length, bin_size, dtype=np.int64), length)
+
+    reads = []
+    with pysam.AlignmentFile(reads_path, 'rb') as reads_file:
+        first_offset = None
+        for read in admitted_reads(reads_file.fetch(ref_name), 0):
+            reads.append(read)
+
+            offset = reads_file.tell() >> 16
+            if first_offset is None: first_offset = offset
+            if offsets is not None and offset - first_offset >= max(calibration_size, 1): break
+        else:
+            # all reads are read, so aligned bases are counted exactly
+            reads = list(admitted_reads(reads, max_depth))
+            starts = np.sort(np.array([r.reference_start for r in reads], dtype=np.int64))
+            ends = np.sort(np.array([r.reference_end for r in reads], dtype=np.int64))
+            return ref_name, edges, coverage_integral(starts, ends, edges) + COLUMN_COST * edges
+
+    # reads following the first one are stored within the read bytes
+    bases_per_byte = sum(r.reference_length for r in reads[1:]) / (offset - first_offset)
+    read_length = np.mean([r.reference_length for r in reads])
+
+    tile_edges = np.append(np.arange(0, length, INDEX_TILE, dtype=np.int64), length)
+    num_tiles = len(tile_edges) - 1
+
+    tile_bases = np.zeros(num_tiles)
+    sizes = np.diff(offsets)[:num_tiles]
+    tile_bases[:len(sizes)] = sizes * bases_per_byte
+
+    # bases of reads starting in a tile are spread over the tiles they cover
+    span = max(int(np.ceil(read_length / INDEX_TILE)), 1)
+    tile_bases = np.convolve(tile_bases, np.ones(span) / span)[:num_tiles]
+
+    depths = tile_bases / np.diff(tile_edges)
+    if max_depth > 0: depths = np.minimum(depths, max_depth)
+
+    tile_cumulative = np.concatenate(([0], np.cumsum(depths * np.diff(tile_edges))))
+    return ref_name, edges, np.interp(edges, tile_edges, tile_cumulative) + COLUMN_COST * edges
+
+def split_regions(ref_name, edges, cumulative, target_cost, min_window=MIN_WINDOW, max_window=MAX_WINDOW, overlap=OVERLAP):
+    """
+    Divides a contig into regions of approximately equal cost. Expensive
+    stretches are split into regions no shorter than `min_window`, while cheap
+    ones are merged into regions no longer than `max_window`. Consecutive
+    regions overlap the same way as regions created by `generate_regions`.
+
+    Parameters
+    ----------
+    ref_name : contig name
+    edges : positions at which the cost is evaluated, ending with contig length
+    cumulative : cumulative cost at every edge
+    target_cost : desired cost of a single region
+    min_window : minimum size of a region
+    max_window : maximum size of a region
+    overlap : size of a window overlap
+
+    Returns
+    -------
+    regions : generated regions together with their predicted costs
+    """
+
+    length = int(edges[-1])
+
+    start = 0
+    while True:
+        start_cost = np.interp(start, edges, cumulative)
+
+        i = min(np.searchsorted(cumulative, start_cost + target_cost), len(edges) - 1)
+        end = min(max(int(edges[i]), start + min_window), start + max_window, length)
+        if length - end < min_window: end = length
+
+        yield Region(name=ref_name, start=start, end=end), np.interp(end, edges, cumulative) - start_cost
+
+        if end >= length: break
+        start = end - overlap
+
+def plan_regions(pool, reads_path, refs, num_workers, max_depth=0, bin_size=COST_BIN, window=WINDOW,
+        min_window=MIN_WINDOW, max_window=MAX_WINDOW, overlap=OVERLAP, calibration_size=CALIBRATION_SIZE):
+    """
+    Plans regions for the provided contigs based on their estimated costs.
+
+    The target cost of a region is the cost of an average `window` sized
+    region, lowered when needed so that every worker receives at least a few
+    tasks. Regions are ordered from the most to the least expensive one, so
+    that stragglers are started first.
+
+    Parameters
+    ----------
+    pool : process pool used for cost estimation
+    reads_path : path to the aligned reads file
+    refs : an array of contig names and lengths
+    num_workers : number of workers processing regions
+    max_depth : maximum number of reads overlapping a position, 0 keeps all reads
+    bin_size : distance between positions at which the cost is evaluated
+    window : size of a region with average cost
+    min_window : minimum size of a region
+    max_window : maximum size of a region
+    overlap : size of a window overlap
+    calibration_size : number of compressed bytes of reads read per contig to
+        estimate costs from the index
+
+    Returns
+    -------
+    regions : planned regions
+    costs : a dictionary of predicted region costs
+    """
+
+    if min_window <= overlap: raise ValueError('Minimum region size must be larger than the overlap.')
+
+    # the index is read once, while contigs are estimated in parallel
+    offsets = read_index_offsets(reads_path)
+    estimates = pool.map(estimate_costs, [
+        (reads_path, ref_name, length, bin_size, max_depth, offsets.get(ref_name) if offsets else None, calibration_size)
+        for ref_name, length in refs
+    ])
+
+    total_cost = sum(cumulative[-1] for _, _, cumulative in estimates)
+    total_length = sum(edges[-1] for _, edges, _ in estimates)
+    target_cost = max(min(total_cost / total_length * window, total_cost / (TASKS_PER_WORKER * num_workers)), 1)
+
+    planned = []
+    for ref_name, edges, cumulative in estimates:
+        planned.extend(split_regions(ref_name, edges, cumulative, target_cost, min_window, max_window, overlap))
+    planned.sort(key=lambda p: p[1], reverse=True)
+
+    print(f'>> planned regions: {len(planned)}, target cost: {target_cost:.0f}')
+
+    return [region for region, _ in planned], {str(region): cost for region, cost in planned}
+
+def print_cost_report(regions, costs, elapsed, top=5):
+    """
+    Prints predicted and actual costs of processed regions. Predicted costs
+    are converted to seconds using the overall measured throughput.
+
+    Parameters
+    ----------
+    regions : processed regions
+    costs : a dictionary of predicted region costs
+    elapsed : an array of measured processing times, one per region
+    top : number of the most expensive regions to print
+    """
+
+    if len(regions) == 0: return
+
+    predicted = np.array([costs[str(region)] for region in regions])
+    actual = np.array(elapsed)
+
+    scale = actual.sum() / predicted.sum() if predicted.sum() > 0 else 0.0
+    predicted = predicted * scale
+
+    if len(regions) > 1 and predicted.std() > 0 and actual.std() > 0:
+        correlation = np.corrcoef(predicted, actual)[0, 1]
+        print(f'>> region cost - predicted vs actual correlation: {correlation:.3f}')
+    print(f'>> region time - max: {actual.max():.2f}s, mean: {actual.mean():.2f}s, total: {actual.sum():.2f}s')
+
+    for i in np.argsort(actual)[::-1][:top]:
+        print(f'>> {regions[i]} - predicted: {predicted[i]:.2f}s, actual: {actual[i]:.2f}s')
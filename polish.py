@@ -0,0 +1,373 @@
+import argparse
+import queue
+import threading
+import time
+import multiprocessing
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pysam
+import torch
+from Bio import SeqIO, SeqRecord
+from Bio.Seq import Seq
+from consensus import Votes
+from data_generator import iter_inference_data, generate_regions, open_files
+from geometry import add_geometry_arguments, parse_geometry
+from model import RNN
+import gen
+
+FEATURE_QUEUE_SIZE_PER_WORKER = 4
+VOTE_QUEUE_SIZE = 16
+POLL_INTERVAL = 0.1
+
+# queue through which workers pass generated batches to the model and an
+# event set when polishing is aborted
+feature_queue = None
+stopped = None
+
+def init_worker(features, stop_event, reads_path, ref_path):
+    """
+    Initializes a feature generation worker. Intended to be used as a
+    `multiprocessing.Pool` or `ThreadPool` initializer.
+
+    Parameters
+    ----------
+    features : queue of generated batches
+    stop_event : an event set when polishing is aborted
+    reads_path : path to the aligned reads file
+    ref_path : path to the draft assembly file
+    """
+
+    global feature_queue, stopped
+    feature_queue = features
+    stopped = stop_event
+    open_files(reads_path, ref_path)
+
+def put_batch(item):
+    """
+    Puts an item in the feature queue, waiting while the queue is full.
+
+    Parameters
+    ----------
+    item : item passed to the model
+
+    Returns
+    -------
+    put : a flag indicating whether the item was put, `False` if polishing was aborted
+    """
+
+    while not stopped.is_set():
+        try:
+            feature_queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+def generate_batches(args):
+    """
+    Generates features of a single region and passes them to the model in
+    batches as the pileup advances, followed by a marker of a finished region.
+
+    Parameters
+    ----------
+    idx : region index
+    batch_size : maximum number of windows in a batch
+    generation_args : arguments passed to `iter_inference_data`
+    """
+
+    idx, batch_size, generation_args = args
+
+    for _, positions, examples in iter_inference_data(generation_args, batch_size):
+        if not put_batch((idx, positions, examples)): return
+    put_batch((idx, None, None))
+
+class ConsensusWriter:
+    """
+    A class that accumulates votes and writes consensus contigs in a
+    dedicated thread.
+
+    Votes are passed to the writer thread through a bounded queue. A contig
+    is polished and written to the output file as soon as all of its regions
+    are finished, after which its votes are released.
+
+    Attributes
+    ----------
+    out_file : output FASTA file
+    contigs : a dictionary of contig sequences
+    remaining : a dictionary of numbers of unfinished regions per contig
+    max_ins : maximum insertion index of a position
+    queue : queue of votes and finished regions passed to the writer thread
+    thread : writer thread
+    error : an exception raised in the writer thread
+    written : number of written contigs
+    """
+
+    def __init__(self, out_file, contigs, regions, max_ins, queue_size=VOTE_QUEUE_SIZE):
+        """
+        Parameters
+        ----------
+        out_file : output FASTA file
+        contigs : a dictionary of contig sequences
+        regions : all polished regions
+        max_ins : maximum insertion index of a position
+        queue_size : maximum number of items waiting in the queue
+        """
+
+        self.out_file = out_file
+        self.contigs = contigs
+        self.max_ins = max_ins
+
+        self.remaining = dict()
+        for region in regions:
+            self.remaining[region.name] = self.remaining.get(region.name, 0) + 1
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.error = None
+        self.written = 0
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.queue.put(None)
+        self.thread.join()
+
+        if type is None: self.__check_error()
+
+    def add(self, contig, positions, Y):
+        """
+        Passes votes of predicted bases to the writer thread.
+
+        Parameters
+        ----------
+        contig : contig name
+        positions : an (N, cols, 2) array of window positions
+        Y : an (N, cols) array of predicted base encodings
+        """
+
+        self.__check_error()
+        self.queue.put((contig, positions, Y))
+
+    def finish(self, contig):
+        """
+        Marks a region of the provided contig as finished.
+
+        Parameters
+        ----------
+        contig : contig name
+        """
+
+        self.__check_error()
+        self.queue.put((contig, None, None))
+
+    def __check_error(self):
+        """
+        Raises an exception raised in the writer thread, if any.
+        """
+
+        if self.error: raise RuntimeError('Consensus writer thread failed.') from self.error
+
+    def __run(self):
+        """
+        Receives votes, accumulates them and writes finished contigs.
+        """
+
+        votes = dict()
+
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None: break
+
+                contig, positions, Y = item
+                if contig not in votes: votes[contig] = Votes(self.max_ins)
+
+                if positions is not None:
+                    votes[contig].add(positions, Y)
+                    continue
+
+                self.remaining[contig] -= 1
+                if self.remaining[contig] > 0: continue
+
+                seq = votes.pop(contig).consensus(self.contigs[contig])
+                if seq is None:
+                    print(f'>> no windows generated for {contig}, contig is skipped')
+                    continue
+
+                SeqIO.write(SeqRecord.SeqRecord(Seq(seq), id=contig), self.out_file, 'fasta')
+                self.out_file.flush()
+                self.written += 1
+                print(f'>> polished {contig}')
+
+        except BaseException as e:
+            self.error = e
+            # keep consuming so that the producer never blocks on a full queue
+            while self.queue.get() is not None: pass
+
+def predict(model, device, batch):
+    """
+    Predicts bases of the provided windows.
+
+    Parameters
+    ----------
+    model : model used for prediction
+    device : device on which the model runs
+    batch : an array of (contig, positions, examples) triples
+
+    Returns
+    -------
+    predictions : an array of (contig, positions, Y) triples
+    """
+
+    X = torch.from_numpy(np.concatenate([examples for _, _, examples in batch])).to(device).long()
+    with torch.no_grad():
+        Y = torch.argmax(model(X), dim=2).cpu().numpy()
+
+    predictions = []
+    start = 0
+    for contig, positions, _ in batch:
+        end = start + len(positions)
+        predictions.append((contig, positions, Y[start:end]))
+        start = end
+
+    return predictions
+
+def polish(args):
+    geometry = parse_geometry(args)
+    print(f'>> window geometry: {geometry}')
+
+    # errors raised in pool initializers are never reported, so the reads
+    # file is opened once up front to fail early
+    gen.BAMFile(args.reads_path)
+
+    with pysam.FastaFile(args.ref_path) as ref_file:
+        contigs = {ref_name: ref_file.fetch(ref_name) for ref_name in ref_file.references}
+    regions = [region for ref_name, seq in contigs.items() for region in generate_regions(len(seq), ref_name)]
+    arguments = [
+        (idx, args.batch_size, (args.reads_path, args.ref_path, geometry, args.max_depth, region))
+        for idx, region in enumerate(regions)
+    ]
+
+    queue_size = args.queue_size or FEATURE_QUEUE_SIZE_PER_WORKER * args.num_workers
+    if args.executor == 'thread':
+        pool_class, features, stop_event = ThreadPool, queue.Queue(maxsize=queue_size), threading.Event()
+    else:
+        pool_class, features, stop_event = Pool, multiprocessing.Queue(maxsize=queue_size), multiprocessing.Event()
+
+    # workers are started before the model is loaded, so that they do not
+    # inherit its memory
+    initargs = (features, stop_event, args.reads_path, args.ref_path)
+    with pool_class(processes=args.num_workers, initializer=init_worker, initargs=initargs) as pool:
+        tasks = pool.map_async(generate_batches, arguments, chunksize=1)
+
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+        model = RNN.load_from_checkpoint(args.model_path).to(device)
+        model.eval()
+
+        try:
+            if (model.rows, model.cols) != (geometry.rows, geometry.cols):
+                raise ValueError(f'Model expects {model.rows}x{model.cols} windows, geometry is {geometry.rows}x{geometry.cols}.')
+
+            print(f'>> polishing started - number of regions: {len(regions)}')
+            start = time.perf_counter()
+
+            with open(args.out_path, 'w') as out_file, \
+                    ConsensusWriter(out_file, contigs, regions, geometry.max_ins, args.vote_queue_size) as writer:
+                windows, model_time = polish_regions(model, device, features, tasks, regions, writer, args.batch_size)
+
+            elapsed = time.perf_counter() - start
+            print(f'>> polished contigs: {writer.written}/{len(contigs)}, windows: {windows}, '
+                f'{windows / elapsed:,.0f} windows/s, model busy: {model_time:.2f}s, total: {elapsed:.2f}s')
+        except BaseException:
+            # workers waiting on the full queue are stopped so that the pool
+            # can be terminated
+            stop_event.set()
+            raise
+
+def polish_regions(model, device, features, tasks, regions, writer, batch_size):
+    """
+    Predicts bases of windows generated by workers in batches and passes
+    them to the consensus writer. Regions are reported as finished once all
+    of their windows are passed.
+
+    Parameters
+    ----------
+    model : model used for prediction
+    device : device on which the model runs
+    features : queue of generated batches
+    tasks : result of the asynchronous generation of all regions
+    regions : polished regions
+    writer : consensus writer
+    batch_size : minimum number of windows passed to the model at once
+
+    Returns
+    -------
+    windows : number of polished windows
+    model_time : time spent in the model
+    """
+
+    # windows waiting for the model and contigs of regions finished since
+    # the last prediction
+    batch, batch_windows, finished = [], 0, []
+    windows, model_time = 0, 0.0
+
+    remaining = len(regions)
+    while remaining > 0 or batch or finished:
+        item = None
+        if remaining > 0 and batch_windows < batch_size:
+            try:
+                item = features.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                # results are only checked to surface worker errors
+                if tasks.ready() and not tasks.successful(): tasks.get()
+                continue
+
+        if item is not None:
+            idx, positions, examples = item
+            contig = regions[idx].name
+
+            if positions is None:
+                finished.append(contig)
+                remaining -= 1
+            else:
+                batch.append((contig, positions, examples))
+                batch_windows += len(positions)
+                windows += len(positions)
+
+            if remaining > 0 and batch_windows < batch_size: continue
+
+        if batch:
+            model_start = time.perf_counter()
+            for contig, positions, Y in predict(model, device, batch):
+                writer.add(contig, positions, Y)
+            model_time += time.perf_counter() - model_start
+
+        for contig in finished: writer.finish(contig)
+        batch, batch_windows, finished = [], 0, []
+
+    tasks.get()
+    return windows, model_time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str)
+    parser.add_argument('--reads_path', type=str)
+    parser.add_argument('--ref_path', type=str)
+    parser.add_argument('--out_path', type=str)
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--executor', type=str, choices=['process', 'thread'], default='process')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--queue_size', type=int, default=None)
+    parser.add_argument('--vote_queue_size', type=int, default=VOTE_QUEUE_SIZE)
+    parser.add_argument('--max_depth', type=int, default=0)
+    add_geometry_arguments(parser)
+    args = parser.parse_args()
+
+    polish(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+import csv
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+from collections import namedtuple
+from feature_cache import CachedResult
+
+# metrics of the region processed in the current thread, `None` if the
+# region is not profiled
+current = threading.local()
+
+ProfiledResult = namedtuple('ProfiledResult', ['result', 'metrics'])
+
+# metrics added up over a region, maxima are kept for the ones starting with `max_`
+SUMMED_METRICS = [
+    'total_time', 'pileup_time', 'build_time', 'label_time', 'write_time', 'transfer_time',
+    'positions', 'depth_sum', 'skipped_reads', 'windows', 'dropped_windows', 'result_bytes',
+]
+COLUMNS = ['region', 'worker', 'cache_hit'] + SUMMED_METRICS + ['mean_depth', 'max_depth', 'peak_rss']
+
+def add_metrics(**values):
+    """
+    Adds values to metrics of the region processed in the current thread.
+    Values of metrics whose names start with `max_` replace smaller ones.
+    Does nothing if the region is not profiled.
+
+    Parameters
+    ----------
+    values : metric values keyed by metric names
+    """
+
+    metrics = getattr(current, 'metrics', None)
+    if metrics is None: return
+
+    for name, value in values.items():
+        if name.startswith('max_'):
+            metrics[name] = max(metrics.get(name, value), value)
+        else:
+            metrics[name] = metrics.get(name, 0) + value
+
+def peak_rss():
+    """
+    Returns peak resident set size of the current process in bytes.
+    """
+
+    # Linux reports the maximum resident set size in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class ProfiledFunction:
+    """
+    A generation function wrapped with profiling. Metrics recorded with
+    `add_metrics` while the function runs are returned together with its
+    result, the wall time of the call and the peak RSS of the worker.
+
+    A function yielding batches is profiled while its batches are consumed,
+    and the profiled result is returned by the wrapping generator once all
+    batches are yielded.
+
+    Attributes
+    ----------
+    function : generation function
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, args):
+        current.metrics = metrics = dict()
+        start = time.perf_counter()
+        try:
+            result = self.function(args)
+        finally:
+            current.metrics = None
+
+        if inspect.isgenerator(result): return self.__profile_batches(result, metrics, start)
+
+        data = result.result if isinstance(result, CachedResult) else result
+        # sharded results only name groups written by the worker
+        result_bytes = sum(getattr(a, 'nbytes', 0) for a in data[1:]) if data else 0
+
+        return self.__finish(result, metrics, start, result_bytes)
+
+    def __profile_batches(self, batches, metrics, start):
+        """
+        Yields batches of the provided generator, recording metrics while
+        they are generated.
+        """
+
+        result_bytes = 0
+        while True:
+            current.metrics = metrics
+            try:
+                batch = next(batches)
+            except StopIteration as e:
+                result = e.value
+                break
+            finally:
+                current.metrics = None
+
+            result_bytes += sum(a.nbytes for a in batch[1:])
+            yield batch
+
+        return self.__finish(result, metrics, start, result_bytes)
+
+    def __finish(self, result, metrics, start, result_bytes):
+        """
+        Adds metrics of the finished call to its result.
+        """
+
+        metrics['total_time'] = time.perf_counter() - start
+        metrics['peak_rss'] = peak_rss()
+        metrics['worker'] = f'{os.getpid()}/{threading.current_thread().name}'
+        metrics['cache_hit'] = isinstance(result, CachedResult) and result.hit
+        metrics['result_bytes'] = result_bytes
+
+        # wall clock time, since it is compared with the time in the parent
+        metrics['finished_at'] = time.time()
+
+        return ProfiledResult(result, metrics)
+
+class Profiler:
+    """
+    A class that aggregates per-region metrics in the parent process, reports
+    progress and writes a report.
+
+    Attributes
+    ----------
+    regions : processed regions, indexed by task index
+    progress : a flag indicating whether a progress line is printed for every region
+    rows : metrics of processed regions
+    start : time at which processing started
+    total_bases : total length of all regions
+    done_bases : total length of processed regions
+    """
+
+    def __init__(self, regions, progress=False):
+        """
+        Parameters
+        ----------
+        regions : processed regions, indexed by task index
+        progress : a flag indicating whether a progress line is printed for every region
+        """
+
+        self.regions = regions
+        self.progress = progress
+        self.rows = []
+
+        self.start = time.perf_counter()
+        self.total_bases = sum(r.end - r.start for r in regions)
+        self.done_bases = 0
+
+    def wrap(self, function):
+        """
+        Wraps a generation function so that it returns `ProfiledResult` objects.
+
+        Parameters
+        ----------
+        function : generation function
+
+        Returns
+        -------
+        profiled_function : a picklable wrapped generation function
+        """
+
+        return ProfiledFunction(function)
+
+    def record(self, idx, profiled_result):
+        """
+        Records metrics of a result returned by a wrapped generation function.
+
+        Parameters
+        ----------
+        idx : task index
+        profiled_result : `ProfiledResult` object
+
+        Returns
+        -------
+        result : generation result
+        """
+
+        metrics = dict(profiled_result.metrics)
+        metrics['transfer_time'] = max(time.time() - metrics.pop('finished_at'), 0.0)
+
+        region = self.regions[idx]
+        row = {name: metrics.get(name, 0) for name in COLUMNS}
+        row['region'] = str(region)
+        row['mean_depth'] = row['depth_sum'] / row['positions'] if row['positions'] else 0.0
+        self.rows.append(row)
+
+        self.done_bases += region.end - region.start
+        if self.progress: self.print_progress()
+
+        return profiled_result.result
+
+    def print_progress(self):
+        """
+        Prints the number of processed regions and the estimated remaining time,
+        assuming that the remaining regions are processed at the same rate per base.
+        """
+
+        elapsed = time.perf_counter() - self.start
+        remaining = elapsed * (self.total_bases - self.done_bases) / self.done_bases if self.done_bases else 0.0
+        windows = sum(row['windows'] - row['dropped_windows'] for row in self.rows)
+
+        print(f'>> progress: {len(self.rows)}/{len(self.regions)} regions '
+            f'({self.done_bases / max(self.total_bases, 1):.1%} of bases), {windows} windows, '
+            f'elapsed: {format_time(elapsed)}, ETA: {format_time(remaining)}')
+
+    def summary(self, top=5):
+        """
+        Returns totals of all metrics, the maximum peak RSS of every worker
+        and the slowest regions.
+
+        Parameters
+        ----------
+        top : number of the slowest regions
+
+        Returns
+        -------
+        summary : a dictionary of aggregated metrics
+        """
+
+        totals = {name: sum(row[name] for row in self.rows) for name in SUMMED_METRICS}
+
+        workers = dict()
+        for row in self.rows:
+            workers[row['worker']] = max(workers.get(row['worker'], 0), row['peak_rss'])
+
+        return {
+            'regions': len(self.rows),
+            'cache_hits': sum(bool(row['cache_hit']) for row in self.rows),
+            'elapsed': time.perf_counter() - self.start,
+            'totals': totals,
+            'mean_depth': totals['depth_sum'] / totals['positions'] if totals['positions'] else 0.0,
+            'max_depth': max((row['max_depth'] for row in self.rows), default=0),
+            'peak_rss': workers,
+            'slowest': [row['region'] for row in sorted(self.rows, key=lambda r: r['total_time'], reverse=True)[:top]],
+        }
+
+    def print_summary(self):
+        """
+        Prints the split of generation time and the slowest regions.
+        """
+
+        if not self.rows: return
+        summary = self.summary()
+        totals = summary['totals']
+
+        other = totals['total_time'] - sum(totals[name] for name in ('pileup_time', 'build_time', 'label_time', 'write_time'))
+        print(f'>> region time - pileup: {totals["pileup_time"]:.2f}s, matrix build: {totals["build_time"]:.2f}s, '
+            f'labels: {totals["label_time"]:.2f}s, shard writes: {totals["write_time"]:.2f}s, other: {other:.2f}s, '
+            f'transfer: {totals["transfer_time"]:.2f}s')
+        print(f'>> windows - generated: {totals["windows"]}, dropped for unknown labels: {totals["dropped_windows"]}, '
+            f'pileup depth - mean: {summary["mean_depth"]:.1f}, max: {summary["max_depth"]}, '
+            f'reads skipped by the depth cap: {totals["skipped_reads"]}')
+        print(f'>> worker peak RSS - max: {max(summary["peak_rss"].values()) / 2**20:.1f} MB')
+        print(f'>> slowest regions: {", ".join(summary["slowest"])}')
+
+    def write(self, path):
+        """
+        Writes per-region metrics in CSV format, or in JSON format together
+        with the summary if the path ends with `.json`.
+
+        Parameters
+        ----------
+        path : path to the report
+        """
+
+        if path.endswith('.json'):
+            with open(path, 'w') as report_file:
+                json.dump({'summary': self.summary(), 'regions': self.rows}, report_file, indent=4)
+            return
+
+        with open(path, 'w', newline='') as report_file:
+            writer = csv.DictWriter(report_file, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.rows)
+
+def format_time(seconds):
+    """
+    Formats a duration as hours, minutes and seconds.
+    """
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
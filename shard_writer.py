@@ -0,0 +1,58 @@
+import time
+from collections import namedtuple
+from data_generator import consume_batches
+from feature_cache import CachedResult
+from profiler import add_metrics
+
+ShardedResult = namedtuple('ShardedResult', ['segment_path', 'groups'])
+
+class ShardedFunction:
+    """
+    A generation function whose batches are stored by the worker and written
+    to a segment file of the output file once the whole region is generated,
+    instead of being passed to the parent process, which receives only the
+    path to the segment file and names and sizes of written groups as
+    `ShardedResult` objects.
+
+    Every region is written to a new segment file, which is never modified
+    afterwards, so that groups linked from the output file are always
+    readable, even if a worker is killed while writing another region.
+
+    Attributes
+    ----------
+    function : generation function yielding batches, optionally wrapped with
+        the feature cache
+    out_path : path to the output file, next to which segment files are written
+    writer_class : class of the .hdf5 data writer of segment files
+    geometry : geometry of written windows
+    options : chunking and filters of written datasets
+    """
+
+    def __init__(self, function, out_path, writer_class, geometry, options):
+        self.function = function
+        self.out_path = out_path
+        self.writer_class = writer_class
+        self.geometry = geometry
+        self.options = options
+
+    def __call__(self, args):
+        # batches are stored as they are generated and written once the whole
+        # region is generated, so that regions are committed at once; the
+        # writer only writes a segment file and never the output file itself
+        writer = self.writer_class(self.out_path, geometry=self.geometry, options=self.options)
+        write_time = 0.0
+
+        def store(batch):
+            nonlocal write_time
+            start = time.perf_counter()
+            writer.store(batch)
+            write_time += time.perf_counter() - start
+
+        result = consume_batches(self.function(args), store)
+
+        start = time.perf_counter()
+        segment_path, groups = writer.write_segment()
+        add_metrics(write_time=write_time + time.perf_counter() - start)
+
+        sharded = ShardedResult(segment_path, groups) if segment_path is not None else None
+        return result._replace(result=sharded) if isinstance(result, CachedResult) else sharded
@@ -1,3 +1,4 @@
+import numpy as np
 from abc import ABC
 from abc import abstractmethod
 
@@ -8,8 +9,8 @@ class TemporaryStorage(ABC):
     Attributes
     ----------
     name : region to which data corresponds
-    positions: an array of positions
-    X : an array of examples/features
+    positions: a list of stored position arrays
+    X : a list of stored example/feature arrays
     """
 
     def __init__(self, name):
@@ -45,10 +46,10 @@ class TemporaryStorage(ABC):
 
         Returns
         -------
-        positions : stored positions
+        positions : stored positions concatenated into a single array
         """
 
-        return self.positions
+        return concatenate(self.positions)
 
     def get_X(self):
         """
@@ -56,10 +57,10 @@ class TemporaryStorage(ABC):
 
         Returns
         -------
-        X : stored examples
+        X : stored examples concatenated into a single array
         """
 
-        return self.X
+        return concatenate(self.X)
     
     @abstractmethod
     def get_Y(self):
@@ -79,7 +80,7 @@ class TemporaryTrainStorage(TemporaryStorage):
 
     Attributes
     ----------
-    Y : an array of labels
+    Y : a list of stored label arrays
     """
 
     def __init__(self, name):
@@ -92,17 +93,16 @@ class TemporaryTrainStorage(TemporaryStorage):
         assert Y is not None
         assert len(positions) == len(X) == len(Y)
 
-        for i, position in enumerate(positions):
-            self.positions.append(position)
-            self.X.append(X[i])
-            self.Y.append(Y[i])
+        self.positions.append(positions)
+        self.X.append(X)
+        self.Y.append(Y)
 
     def clear(self):
         super().clear()
         del self.Y[:]
 
     def get_Y(self):
-        return self.Y
+        return concatenate(self.Y)
 
 class TemporaryInferenceStorage(TemporaryStorage):
     """
@@ -117,9 +117,24 @@ class TemporaryInferenceStorage(TemporaryStorage):
 
         assert len(positions) == len(X)
 
-        for i, position in enumerate(positions):
-            self.positions.append(position)
-            self.X.append(X[i])
+        self.positions.append(positions)
+        self.X.append(X)
 
     def get_Y(self):
-        return None
\ No newline at end of file
+        return None
+
+def concatenate(arrays):
+    """
+    Concatenates stored arrays along the first axis.
+
+    Parameters
+    ----------
+    arrays : a list of arrays
+
+    Returns
+    -------
+    array : a single array, or an empty list if nothing is stored
+    """
+
+    if not arrays: return []
+    return np.concatenate(arrays)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import RandomSampler, SequentialSampler
+from dataset import TrainDataset, BlockShuffleSampler, batch_loader
+from geometry import DEFAULT_GEOMETRY
+from hdf5_writer import TrainHDF5Writer, LAYOUTS
+
+GEOMETRY = DEFAULT_GEOMETRY._replace(rows=4, cols=6)
+
+@pytest.fixture(params=LAYOUTS)
+def train_path(request, tmp_path):
+    path = str(tmp_path / 'train.hdf5')
+    rng = np.random.default_rng(0)
+
+    with TrainHDF5Writer(path, request.param, geometry=GEOMETRY) as writer:
+        writer.write_contigs([('a', 'ACGT' * 100), ('b', 'ACGT' * 100)])
+        start = 0
+        for size in (7, 1, 30, 12):
+            for contig in ('a', 'b'):
+                P = np.zeros((size, GEOMETRY.cols, 2), dtype=np.int64)
+                P[:, :, 0] = start + np.arange(size)[:, None]
+                X = rng.integers(0, 255, (size, GEOMETRY.rows, GEOMETRY.cols), dtype=np.uint8)
+                Y = rng.integers(0, 5, (size, GEOMETRY.cols), dtype=np.int64)
+                writer.store((contig, P, X, Y))
+            start += size
+            writer.write()
+
+    return path
+
+def read_samples(dataset):
+    X, Y = zip(*(dataset[i] for i in range(len(dataset))))
+    return np.stack(X), np.stack(Y)
+
+def test_batch_matches_samples(train_path):
+    dataset = TrainDataset(train_path)
+    X, Y = read_samples(dataset)
+
+    rng = np.random.default_rng(1)
+    for indices in ([], [3], list(range(len(dataset))), rng.integers(0, len(dataset), 50).tolist(), [5, 5, 0, 99, 4]):
+        batch_X, batch_Y = dataset[indices]
+        assert np.array_equal(batch_X, X[indices]) and batch_X.dtype == X.dtype
+        assert np.array_equal(batch_Y, Y[indices]) and batch_Y.dtype == Y.dtype
+
+    with pytest.raises(IndexError):
+        dataset[[0, len(dataset)]]
+
+# samplers draw from their own generator, since the data loader draws from
+# the default one
+@pytest.mark.parametrize('create_sampler', [
+    lambda dataset: SequentialSampler(dataset),
+    lambda dataset: RandomSampler(dataset, generator=torch.Generator().manual_seed(0)),
+    lambda dataset: BlockShuffleSampler(dataset, 4, torch.Generator().manual_seed(0)),
+])
+def test_batch_loader_matches_samples(train_path, create_sampler):
+    dataset = TrainDataset(train_path)
+    X, Y = read_samples(dataset)
+
+    indices = torch.tensor(list(create_sampler(dataset)))
+    batches = list(batch_loader(dataset, 16, create_sampler(dataset)))
+    assert [len(batch_X) for batch_X, _ in batches[:-1]] == [16] * (len(batches) - 1)
+
+    batch_X = torch.cat([batch_X for batch_X, _ in batches])
+    batch_Y = torch.cat([batch_Y for _, batch_Y in batches])
+    assert torch.equal(batch_X, torch.from_numpy(X)[indices])
+    assert torch.equal(batch_Y, torch.from_numpy(Y)[indices])
@@ -0,0 +1,153 @@
+import numpy as np
+import pysam
+import pytest
+import gen
+
+REF = 'ACGTTGCAAGCTTCGAGCAT'
+GEOMETRY = {'rows': 64, 'cols': 4, 'stride': 2, 'max_ins': 2, 'ref_rows': 1}
+
+# (start, cigar, query, reverse) of reads, covering insertions, deletions,
+# unknown bases and a read without a single known base
+READS = [
+    (0, '10M', REF[0:10], False),
+    (2, '3M2I3M', REF[2:5] + 'TT' + REF[5:8], True),
+    (4, '2M2D4M', REF[4:6] + REF[8:12], False),
+    (6, '6M', REF[6:9] + 'N' + REF[10:12], True),
+    (14, '6M', 'NNNNNN', False),
+]
+
+# bases are encoded as A, C, G, T, gap and unknown, with an offset of 6 for
+# reads aligned to the reverse strand
+A, C, G, T, GAP, N = range(6)
+a, c, g, t, gap, n = range(6, 12)
+
+EXPECTED_POSITIONS = [
+    [(0, 0), (1, 0), (2, 0), (3, 0)],
+    [(2, 0), (3, 0), (4, 0), (4, 1)],
+    [(4, 0), (4, 1), (4, 2), (5, 0)],
+    [(4, 2), (5, 0), (6, 0), (7, 0)],
+    [(6, 0), (7, 0), (8, 0), (9, 0)],
+    [(8, 0), (9, 0), (10, 0), (11, 0)],
+    [(10, 0), (11, 0), (14, 0), (15, 0)],
+    [(14, 0), (15, 0), (16, 0), (17, 0)],
+    [(16, 0), (17, 0), (18, 0), (19, 0)],
+]
+
+EXPECTED_REF_ROWS = [
+    [A, C, G, T],
+    [G, T, T, GAP],
+    [T, GAP, GAP, G],
+    [GAP, G, C, A],
+    [C, A, A, G],
+    [A, G, C, T],
+    [C, T, G, A],
+    [G, A, G, C],
+    [G, C, A, T],
+]
+
+# distinct read rows of windows, a read is unknown before its start and after
+# its end, and a gap at its end position and where it has no base
+EXPECTED_READ_ROWS = [
+    [[A, C, G, T], [n, n, g, t]],
+    [[G, T, T, GAP], [N, N, T, GAP], [g, t, t, t]],
+    [[T, GAP, GAP, G], [t, t, t, g]],
+    [[GAP, G, C, A], [GAP, G, GAP, GAP], [t, g, c, a], [n, n, c, a]],
+    [[C, A, A, G], [GAP, GAP, A, G], [c, a, a, n], [c, a, gap, n]],
+    [[A, G, C, T], [A, G, GAP, N], [a, n, c, t]],
+    [[C, T, N, N], [c, t, n, n]],
+    # no read has a known base
+    [[N, N, N, N]],
+    [[N, N, N, N]],
+]
+
+def write_bam(path, reads):
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'ctg', 'LN': len(REF)}]}
+
+    with pysam.AlignmentFile(path, 'wb', header=header) as f:
+        for i, (start, cigar, query, reverse) in enumerate(reads):
+            r = pysam.AlignedSegment(f.header)
+            r.query_name = f'r{i}'
+            r.reference_id = 0
+            r.reference_start = start
+            r.mapping_quality = 60
+            r.cigarstring = cigar
+            r.query_sequence = query
+            r.is_reverse = reverse
+            f.write(r)
+    pysam.index(path)
+
+@pytest.fixture(scope='module')
+def reads_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('features') / 'reads.bam')
+    write_bam(path, READS)
+    return path
+
+def read_rows(X):
+    return sorted(map(tuple, np.unique(X[GEOMETRY['ref_rows']:], axis=0).tolist()))
+
+def test_features_of_synthetic_reads(reads_path):
+    P, X = gen.generate_features(reads_path, REF, 'ctg', seed=0, **GEOMETRY)
+
+    assert P.tolist() == [list(map(list, p)) for p in EXPECTED_POSITIONS]
+    assert X.shape == (len(EXPECTED_POSITIONS), GEOMETRY['rows'], GEOMETRY['cols'])
+    assert X[:, 0].tolist() == EXPECTED_REF_ROWS
+
+    # with many more rows than reads, every read is sampled in every window
+    for x, expected in zip(X, EXPECTED_READ_ROWS):
+        assert read_rows(x) == sorted(map(tuple, expected))
+
+def test_features_of_subregion(reads_path):
+    P, X = gen.generate_features(reads_path, REF[6:12], 'ctg:7-12', ref_start=6, seed=0, **GEOMETRY)
+
+    assert P.tolist() == [[[6, 0], [7, 0], [8, 0], [9, 0]], [[8, 0], [9, 0], [10, 0], [11, 0]]]
+    assert X[:, 0].tolist() == EXPECTED_REF_ROWS[4:6]
+    for x, expected in zip(X, EXPECTED_READ_ROWS[4:6]):
+        assert read_rows(x) == sorted(map(tuple, expected))
+
+def test_features_are_reproducible(reads_path):
+    bam = gen.BAMFile(reads_path)
+    P, X = gen.generate_features(bam, REF, 'ctg', seed=3, **GEOMETRY)
+
+    same_P, same_X = gen.generate_features(reads_path, REF, 'ctg', seed=3, **GEOMETRY)
+    assert np.array_equal(P, same_P) and np.array_equal(X, same_X)
+
+    batches = list(gen.FeatureIterator(bam, REF, 'ctg', seed=3, batch_size=2, **GEOMETRY))
+    assert [len(batch_P) for batch_P, _ in batches] == [2, 2, 2, 2, 1]
+    assert np.array_equal(np.concatenate([batch_P for batch_P, _ in batches]), P)
+    assert np.array_equal(np.concatenate([batch_X for _, batch_X in batches]), X)
+
+# (start, length) of reads, with a depth of at most 3; with a cap of 2, reads
+# starting at 2, 7 and 13 are skipped since two admitted reads overlap their
+# starts, while the read starting at 6 is admitted as the one starting at 0
+# with length 6 ends there
+DEEP_READS = [(0, 10), (0, 6), (2, 4), (6, 6), (7, 5), (10, 5), (12, 3), (13, 2)]
+
+@pytest.fixture(scope='module')
+def deep_reads_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('depth') / 'reads.bam')
+    write_bam(path, [(start, f'{length}M', REF[start:start + length], False) for start, length in DEEP_READS])
+    return path
+
+def pileup_stats(path, region, max_depth):
+    features = gen.FeatureIterator(path, REF, region, seed=0, max_depth=max_depth, **GEOMETRY)
+    for _ in features: pass
+
+    stats = features.stats
+    return stats['positions'], stats['depth_sum'], stats['max_depth'], stats['skipped_reads']
+
+def test_max_depth_of_known_pileup(deep_reads_path):
+    assert pileup_stats(deep_reads_path, 'ctg', 0) == (15, 41, 3, 0)
+    assert pileup_stats(deep_reads_path, 'ctg', 3) == (15, 41, 3, 0)
+
+    # reads starting at 0, 0, 6, 10 and 12 are admitted
+    assert pileup_stats(deep_reads_path, 'ctg', 2) == (15, 30, 2, 3)
+    assert pileup_stats(deep_reads_path, 'ctg', 1) == (15, 15, 1, 6)
+
+def test_max_depth_depends_on_region_start(deep_reads_path):
+    # reads are admitted in the order of their starts, so reads starting
+    # before a region which are admitted from the contig start are not seen
+    # from the region start; with the reads starting at 0 unseen, the read
+    # starting at 7 is admitted at positions 11 to 14 instead of the one
+    # starting at 10, and the one starting at 13 as well
+    assert pileup_stats(deep_reads_path, 'ctg:12-15', 2) == (4, 7, 2, 1)
+    assert pileup_stats(deep_reads_path, 'ctg:12-15', 0) == (4, 11, 3, 0)
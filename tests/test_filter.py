@@ -0,0 +1,121 @@
+import copy
+import itertools
+from collections import namedtuple
+import numpy as np
+import pytest
+from data_generator import TargetAlign, AlignIndex, filter_aligns
+
+SyntheticAlign = namedtuple('SyntheticAlign', ['reference_start', 'reference_length'])
+
+def pairwise_filter_aligns(aligns, len_threshold=2.0, overlap_threshold=0.5, min_len=1000):
+    """
+    Filters aligns by resolving every pair of aligns, as aligns were
+    filtered before overlapping pairs were found with a sweep.
+    """
+
+    to_be_removed = set()
+    for i, j in itertools.combinations(aligns, 2):
+        first, second = sorted((i, j), key=lambda a: a.align.reference_start)
+
+        if second.start >= first.end: continue
+        overlap_start, overlap_end = second.start, first.end
+
+        shorter, longer = sorted((i, j), key=lambda a: a.align.reference_length)
+
+        len_ratio = longer.align.reference_length / shorter.align.reference_length
+        overlap_ratio = (overlap_end - overlap_start) / shorter.align.reference_length
+
+        if len_ratio < len_threshold:
+            if overlap_ratio < overlap_threshold:
+                first.end = overlap_start
+                second.start = overlap_end
+            else:
+                to_be_removed.add(shorter)
+                to_be_removed.add(longer)
+
+        else:
+            if overlap_ratio >= overlap_threshold:
+                to_be_removed.add(shorter)
+            else:
+                second.start = overlap_end
+
+    filtered_aligns = list(filter(lambda a: (a.end - a.start >= min_len) and a not in to_be_removed, aligns))
+    filtered_aligns.sort(key=lambda a: a.start)
+    return filtered_aligns
+
+def is_in_region(position, aligns):
+    return any(align.start <= position < align.end for align in aligns)
+
+def make_aligns(intervals):
+    """
+    Creates aligns from (start, end) intervals, ordered by reference start
+    as they are read from the truth genome file.
+    """
+
+    return [TargetAlign(SyntheticAlign(s, e - s), s, e) for s, e in sorted(intervals)]
+
+def summarize(aligns, filtered_aligns):
+    index = {id(a): i for i, a in enumerate(aligns)}
+    return [(index[id(a)], a.start, a.end) for a in filtered_aligns]
+
+def random_intervals(rng, num_aligns, mean_len):
+    starts = rng.integers(0, num_aligns * mean_len // 2, num_aligns)
+    lengths = rng.integers(mean_len // 10, 2 * mean_len, num_aligns)
+    return [(int(s), int(s + l)) for s, l in zip(starts, lengths)]
+
+INTERVALS = {
+    'disjoint': [(0, 2000), (5000, 8000), (10000, 11000)],
+    'touching': [(0, 2000), (2000, 4000), (4000, 5500), (5500, 5600)],
+    'nested': [(0, 10000), (2000, 3000), (4000, 9000), (5000, 6000)],
+    'nested similar length': [(0, 3000), (500, 2500), (600, 2400)],
+    'same start': [(1000, 3000), (1000, 5000), (1000, 2500)],
+    'same interval': [(1000, 3000), (1000, 3000)],
+    'chain': [(0, 3000), (2500, 5500), (5000, 8000), (7500, 10500)],
+    'short': [(0, 900), (500, 1400), (1300, 1500)],
+    'empty': [],
+}
+
+def check_filter(intervals, **kwargs):
+    aligns = make_aligns(intervals)
+    expected_aligns = copy.deepcopy(aligns)
+
+    filtered_aligns = filter_aligns(aligns, **kwargs)
+    expected = pairwise_filter_aligns(expected_aligns, **kwargs)
+
+    assert summarize(aligns, filtered_aligns) == summarize(expected_aligns, expected)
+
+@pytest.mark.parametrize('name', INTERVALS)
+def test_filter_aligns_matches_pairwise_filter(name):
+    check_filter(INTERVALS[name])
+
+@pytest.mark.parametrize('len_threshold, overlap_threshold, min_len', [(2.0, 0.5, 1000), (1.2, 0.1, 1), (5.0, 0.9, 500)])
+def test_filter_aligns_matches_pairwise_filter_of_random_aligns(len_threshold, overlap_threshold, min_len):
+    rng = np.random.default_rng(0)
+    for num_aligns in (2, 5, 20, 100):
+        for _ in range(20):
+            intervals = random_intervals(rng, num_aligns, 3000)
+            check_filter(intervals, len_threshold=len_threshold, overlap_threshold=overlap_threshold, min_len=min_len)
+
+def check_index(aligns):
+    bounds = [p for a in aligns for p in (a.start, a.end)]
+    positions = sorted({p + d for p in bounds for d in (-1, 0, 1)} | {-5, 0})
+
+    contained = AlignIndex(aligns).contains(np.array(positions))
+    assert contained.tolist() == [is_in_region(p, aligns) for p in positions]
+    assert [bool(AlignIndex(aligns).contains(p)) for p in positions] == contained.tolist()
+
+@pytest.mark.parametrize('name', INTERVALS)
+def test_align_index_matches_linear_scan(name):
+    aligns = make_aligns(INTERVALS[name])
+    check_index(aligns)
+    check_index(filter_aligns(aligns, min_len=1))
+
+def test_align_index_matches_linear_scan_of_random_aligns():
+    rng = np.random.default_rng(1)
+    for num_aligns in (1, 5, 20, 100):
+        for _ in range(20):
+            aligns = make_aligns(random_intervals(rng, num_aligns, 3000))
+            check_index(aligns)
+
+            # aligns trimmed by filtering can end up empty or inverted
+            check_index(filter_aligns(aligns, min_len=-10_000))
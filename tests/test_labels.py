@@ -0,0 +1,261 @@
+import itertools
+import numpy as np
+import pysam
+import pytest
+from coder import Coder
+from data_generator import Region, TargetAlign, LabelTable, assign_labels, expand_cigar, get_postions_and_labels
+
+REF_LENGTH = 1000
+
+def make_align(cigar, query, reference_start=100):
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'ctg', 'LN': REF_LENGTH}]})
+    r = pysam.AlignedSegment(header)
+    r.query_name = 'truth'
+    r.reference_id = 0
+    r.reference_start = reference_start
+    r.cigarstring = cigar
+    r.query_sequence = query
+    return r
+
+def reference_positions_and_labels(r, region):
+    """
+    Walks aligned pairs returned by `pysam.AlignedSegment.get_aligned_pairs`,
+    as labels were extracted before they were vectorized.
+    """
+
+    start, end = region.start, region.end
+    if start is None: start = 0
+    if end is None: end = float('inf')
+    start, end = max(start, r.reference_start), min(end, r.reference_end)
+
+    positions, labels = [], []
+    current_position, insert_count = None, 0
+    pairs = itertools.dropwhile(lambda p: p[1] is None or p[1] < start, r.get_aligned_pairs())
+    for query_position, ref_position in pairs:
+        if ref_position == r.reference_end or (ref_position is not None and ref_position >= end): break
+
+        if ref_position is None:
+            insert_count += 1
+        else:
+            insert_count = 0
+            current_position = ref_position
+        positions.append((current_position, insert_count))
+
+        label = r.query_sequence[query_position].upper() if query_position is not None else Coder.GAP
+        labels.append(Coder.encode(label) if label in Coder.encodings else Coder.encode(Coder.UNKNOWN))
+
+    return np.array(positions, dtype=np.int64).reshape(-1, 2), np.array(labels, dtype=np.uint8)
+
+def random_query(rng, length):
+    return ''.join(rng.choice(list('ACGTacgtNnRYKMSWrykmswBDHV'), length))
+
+# (cigar, query length) pairs covering clips, skips, sequence match and
+# mismatch operations and insertions next to aligned blocks
+CIGARS = [
+    ('10M', 10),
+    ('3S10M2S', 15),
+    ('5H3S10M2S4H', 15),
+    ('4M3I4M', 11),
+    ('4M2D4M', 8),
+    ('4M20N4M', 8),
+    ('3=1X4=2I3X', 13),
+    ('2S3I5M', 10),
+    ('5M3I2S', 10),
+    ('2H3I5M4I3H', 12),
+    ('2M1I1D1I2M2N1=1X', 9),
+]
+
+REGIONS = [
+    (None, None),
+    (0, REF_LENGTH),
+    (100, 105),
+    (102, 106),
+    (104, 130),
+    (103, 104),
+    (200, 300),
+]
+
+@pytest.mark.parametrize('cigar, query_length', CIGARS)
+def test_expand_cigar_matches_aligned_pairs(cigar, query_length):
+    rng = np.random.default_rng(0)
+    r = make_align(cigar, random_query(rng, query_length))
+
+    ref_positions, query_positions = expand_cigar(r)
+    pairs = [
+        (q if q >= 0 else None, p if p >= 0 else None)
+        for q, p in zip(query_positions.tolist(), ref_positions.tolist())
+    ]
+    assert pairs == r.get_aligned_pairs()
+
+@pytest.mark.parametrize('cigar, query_length', CIGARS)
+@pytest.mark.parametrize('start, end', REGIONS)
+def test_positions_and_labels_match_aligned_pairs(cigar, query_length, start, end):
+    rng = np.random.default_rng(1)
+    r = make_align(cigar, random_query(rng, query_length))
+    align = TargetAlign(align=r, start=r.reference_start, end=r.reference_end)
+    region = Region('ctg', start, end)
+
+    positions, labels = get_postions_and_labels(align, region)
+    expected_positions, expected_labels = reference_positions_and_labels(r, region)
+
+    assert np.array_equal(positions, expected_positions)
+    assert np.array_equal(labels, expected_labels)
+
+def test_positions_and_labels_match_aligned_pairs_of_random_cigars():
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        operations = rng.choice(list('MIDN=X'), rng.integers(1, 12))
+        operations[0] = rng.choice(list('MI=X'))
+        cigar = ''.join(f'{rng.integers(1, 6)}{op}' for op in operations)
+        clips = [f'{rng.integers(1, 4)}{op}' if rng.random() < 0.3 else '' for op in 'HSSH']
+        cigar = clips[0] + clips[1] + cigar + clips[2] + clips[3]
+
+        query_length = sum(length for length, op in parse_cigar(cigar) if op in 'MIS=X')
+        r = make_align(cigar, random_query(rng, query_length))
+        align = TargetAlign(align=r, start=r.reference_start, end=r.reference_end)
+
+        start = int(rng.integers(95, r.reference_end + 5))
+        region = Region('ctg', start, start + int(rng.integers(1, 30)))
+
+        positions, labels = get_postions_and_labels(align, region)
+        expected_positions, expected_labels = reference_positions_and_labels(r, region)
+
+        assert np.array_equal(positions, expected_positions), cigar
+        assert np.array_equal(labels, expected_labels), cigar
+
+def parse_cigar(cigar):
+    length = ''
+    for c in cigar:
+        if c.isdigit():
+            length += c
+        else:
+            yield int(length), c
+            length = ''
+
+def dict_labels(positions, label_positions, labels):
+    """
+    Looks labels of window positions up in a dictionary, as labels were
+    assigned before the dense label table.
+    """
+
+    position_label_dict = dict()
+    positions_with_unknown_base = set()
+    for position, label in zip(map(tuple, label_positions.tolist()), labels.tolist()):
+        if label == Coder.encode(Coder.UNKNOWN):
+            positions_with_unknown_base.add(position)
+        else:
+            position_label_dict[position] = label
+
+    to_yield, Y = [], []
+    for P in positions:
+        window_labels = []
+        for p in map(tuple, P.tolist()):
+            if p in positions_with_unknown_base: break
+
+            try:
+                window_labels.append(position_label_dict[p])
+            except KeyError:
+                if p[1] != 0:
+                    window_labels.append(Coder.encode(Coder.GAP))
+                else:
+                    raise KeyError(f'error: No label mapping for position {p}!')
+
+        else:
+            Y.append(window_labels)
+        to_yield.append(len(window_labels) == len(P))
+
+    return np.array(to_yield, dtype=bool), np.array(Y, dtype=np.int64).reshape(-1, positions.shape[1])
+
+def random_labelled_positions(rng, start, end, max_ins, unknown_rate):
+    """
+    Returns positions of reference bases in [start, end) followed by
+    random numbers of insertions, and their random labels.
+    """
+
+    positions = [(p, i) for p in range(start, end) for i in range(1 + rng.integers(0, max_ins + 1) if rng.random() < 0.3 else 1)]
+    labels = rng.choice([Coder.encode(b) for b in 'ACGT' + Coder.GAP], len(positions))
+    labels[rng.random(len(positions)) < unknown_rate] = Coder.encode(Coder.UNKNOWN)
+    return np.array(positions, dtype=np.int64).reshape(-1, 2), labels.astype(np.uint8)
+
+def random_windows(rng, num_windows, width, start, end, max_ins):
+    """
+    Returns windows of consecutive reference positions in [start, end)
+    followed by random numbers of insertion positions.
+    """
+
+    windows = []
+    for _ in range(num_windows):
+        window, p = [], int(rng.integers(start, end))
+        while len(window) < width:
+            window.extend((p, i) for i in range(1 + rng.integers(0, max_ins + 1) if rng.random() < 0.3 else 1))
+            p += 1
+        windows.append(window[:width])
+    return np.array(windows, dtype=np.int64).reshape(num_windows, width, 2)
+
+def check_labels(positions, label_positions, labels):
+    max_ins = int(positions[..., 1].max()) if positions.size > 0 else 0
+    table = LabelTable(label_positions, labels, max_ins)
+
+    try:
+        expected = dict_labels(positions, label_positions, labels)
+    except KeyError:
+        with pytest.raises(KeyError):
+            assign_labels(positions, table)
+        return
+
+    to_yield, Y = assign_labels(positions, table)
+    assert np.array_equal(to_yield, expected[0])
+    assert np.array_equal(Y, expected[1])
+
+@pytest.mark.parametrize('unknown_rate', [0.0, 0.01, 0.2])
+def test_label_table_matches_dict_lookups(unknown_rate):
+    rng = np.random.default_rng(3)
+    for _ in range(50):
+        label_positions, labels = random_labelled_positions(rng, 100, 300, 3, unknown_rate)
+
+        # windows insert more often than the align, so that insertion
+        # positions without labels are looked up as well
+        positions = random_windows(rng, 20, 10, 100, 290, 5)
+        check_labels(positions, label_positions, labels)
+
+def test_label_table_matches_dict_lookups_of_windows_leaving_align():
+    rng = np.random.default_rng(4)
+    for unknown_rate in (0.0, 0.05, 0.5):
+        for _ in range(100):
+            label_positions, labels = random_labelled_positions(rng, 100, 150, 2, unknown_rate)
+            positions = random_windows(rng, 1, 10, 80, 160, 2)
+            check_labels(positions, label_positions, labels)
+
+def test_label_table_of_windows_with_unknown_labels():
+    label_positions = np.array([(10, 0), (11, 0), (11, 1), (12, 0), (13, 0), (14, 0)], dtype=np.int64)
+    labels = np.array([Coder.encode(b) for b in 'AC' + Coder.UNKNOWN + 'G' + Coder.UNKNOWN + 'T'], dtype=np.uint8)
+    table = LabelTable(label_positions, labels, 2)
+
+    positions = np.array([
+        [(10, 0), (11, 0), (12, 0)],
+        [(10, 0), (11, 0), (11, 1)],
+        [(12, 0), (12, 1), (14, 0)],
+        [(13, 0), (14, 0), (15, 0)],
+        [(12, 0), (13, 0), (14, 0)],
+    ], dtype=np.int64)
+    to_yield, Y = assign_labels(positions, table)
+
+    assert to_yield.tolist() == [True, False, True, False, False]
+    assert Y.tolist() == [
+        [Coder.encode('A'), Coder.encode('C'), Coder.encode('G')],
+        [Coder.encode('G'), Coder.encode(Coder.GAP), Coder.encode('T')],
+    ]
+    check_labels(positions, label_positions, labels)
+
+    # reference positions without labels are errors unless the window is
+    # already discarded
+    with pytest.raises(KeyError):
+        assign_labels(np.array([[(14, 0), (15, 0), (13, 0)]], dtype=np.int64), table)
+
+def test_label_table_without_windows_or_labels():
+    table = LabelTable(np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.uint8), 0)
+    to_yield, Y = assign_labels(np.empty((0, 4, 2), dtype=np.int64), table)
+    assert to_yield.shape == (0,) and Y.shape == (0, 4)
+
+    with pytest.raises(KeyError):
+        assign_labels(np.array([[(1, 0), (2, 0)]], dtype=np.int64), table)
@@ -0,0 +1,65 @@
+import numpy as np
+import pysam
+import pytest
+from planner import read_index_offsets, estimate_costs
+
+LENGTH = 100_000
+READ_LENGTH = 1_000
+DEEP_START, DEEP_END = 30_000, 50_000
+
+@pytest.fixture(scope='module')
+def reads_path(tmp_path_factory):
+    """
+    Writes reads with a depth of 10, and of 100 between `DEEP_START` and
+    `DEEP_END`. Reads have random sequences, so that compressed sizes of
+    reads are proportional to their lengths.
+    """
+
+    path = str(tmp_path_factory.mktemp('planner') / 'reads.bam')
+    rng = np.random.default_rng(0)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'ctg', 'LN': LENGTH}, {'SN': 'empty', 'LN': 1_000}]}
+
+    starts = sorted(set(range(0, LENGTH - READ_LENGTH, 100)) | set(range(DEEP_START, DEEP_END - READ_LENGTH, 10)))
+    seqs = np.array(list(b'ACGT'), dtype=np.uint8)[rng.integers(0, 4, (len(starts), READ_LENGTH))]
+    with pysam.AlignmentFile(path, 'wb', header=header) as f:
+        for i, (start, seq) in enumerate(zip(starts, seqs)):
+            r = pysam.AlignedSegment(f.header)
+            r.query_name = f'r{i}'
+            r.reference_id = 0
+            r.reference_start = start
+            r.mapping_quality = 60
+            r.cigarstring = f'{READ_LENGTH}M'
+            r.query_sequence = seq.tobytes().decode()
+            f.write(r)
+    pysam.index(path)
+
+    return path
+
+def region_cost(edges, cumulative, start, end):
+    return np.interp(end, edges, cumulative) - np.interp(start, edges, cumulative)
+
+@pytest.mark.parametrize('max_depth', [0, 20])
+def test_index_estimate_matches_exact_costs(reads_path, max_depth):
+    offsets = read_index_offsets(reads_path)
+    assert list(offsets) == ['ctg']
+
+    _, edges, exact = estimate_costs((reads_path, 'ctg', LENGTH, 1_000, max_depth, None, 0))
+    _, index_edges, estimated = estimate_costs((reads_path, 'ctg', LENGTH, 1_000, max_depth, offsets['ctg'], 50_000))
+
+    assert np.array_equal(edges, index_edges)
+    assert estimated[-1] == pytest.approx(exact[-1], rel=0.1)
+
+    for cumulative in (exact, estimated):
+        deep_cost = region_cost(edges, cumulative, DEEP_START, DEEP_END)
+        shallow_cost = region_cost(edges, cumulative, DEEP_END + 10_000, DEEP_END + 30_000)
+        assert deep_cost / shallow_cost == pytest.approx(exact_ratio(max_depth), rel=0.3)
+
+def exact_ratio(max_depth):
+    # 20 columns of cost per position are added to aligned bases
+    deep, shallow = 100, 10
+    if max_depth > 0: deep = min(deep, max_depth)
+    return (deep + 20) / (shallow + 20)
+
+def test_costs_of_contig_without_reads(reads_path):
+    _, edges, cumulative = estimate_costs((reads_path, 'empty', 1_000, 100, 0, None, 50_000))
+    assert np.array_equal(cumulative, 20 * edges)
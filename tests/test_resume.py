@@ -0,0 +1,230 @@
+import os
+import subprocess
+import sys
+import h5py
+import numpy as np
+import pysam
+import pytest
+import generate
+from hdf5_writer import HDF5Writer
+
+CONTIGS = {'ctg1': 120_000, 'ctg2': 90_000}
+READ_LENGTH = 2_000
+READ_STEP = 250
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    """
+    Writes a reference, reads covering it and a truth genome aligned to it,
+    all of which match the reference exactly.
+    """
+
+    path = tmp_path_factory.mktemp('data')
+    rng = np.random.default_rng(0)
+    seqs = {name: ''.join(rng.choice(list('ACGT'), length)) for name, length in CONTIGS.items()}
+
+    ref_path = str(path / 'ref.fasta')
+    with open(ref_path, 'w') as f:
+        for name, seq in seqs.items(): f.write(f'>{name}\n{seq}\n')
+    pysam.faidx(ref_path)
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': n, 'LN': l} for n, l in CONTIGS.items()]}
+
+    def write_bam(bam_path, aligns):
+        with pysam.AlignmentFile(bam_path, 'wb', header=header) as f:
+            for i, (ref_id, start, seq) in enumerate(aligns):
+                r = pysam.AlignedSegment(f.header)
+                r.query_name = f'r{i}'
+                r.reference_id = ref_id
+                r.reference_start = start
+                r.mapping_quality = 60
+                r.cigarstring = f'{len(seq)}M'
+                r.query_sequence = seq
+                f.write(r)
+        pysam.index(bam_path)
+
+    reads = [
+        (ref_id, start, seq[start:start + READ_LENGTH])
+        for ref_id, seq in enumerate(seqs.values())
+        for start in range(0, len(seq) - READ_LENGTH + 1, READ_STEP)
+    ]
+    reads_path = str(path / 'reads.bam')
+    write_bam(reads_path, reads)
+
+    truth_path = str(path / 'truth.bam')
+    write_bam(truth_path, [(ref_id, 0, seq) for ref_id, seq in enumerate(seqs.values())])
+
+    return reads_path, truth_path, ref_path
+
+def run(data, out_path, *args):
+    reads_path, truth_path, ref_path = data
+    argv = [
+        'generate.py', '--reads_path', reads_path, '--truth_genome_path', truth_path, '--ref_path', ref_path,
+        '--out_path', str(out_path), '--executor', 'thread', '--plan_regions', *args,
+    ]
+    old_argv, sys.argv = sys.argv, argv
+    try:
+        generate.main()
+    finally:
+        sys.argv = old_argv
+
+def run_interrupted(data, out_path, monkeypatch, *args):
+    """
+    Runs generation which fails on the second write, after regions of the
+    first one are committed.
+    """
+
+    write = HDF5Writer.write
+    calls = []
+
+    def failing_write(self):
+        calls.append(None)
+        if len(calls) == 2: raise OSError('interrupted')
+        write(self)
+
+    with monkeypatch.context() as m:
+        m.setattr(HDF5Writer, 'write', failing_write)
+        with pytest.raises(RuntimeError):
+            run(data, out_path, *args)
+
+# a script running generation which exits without any cleanup on the given
+# call of `os.replace`, which replaces the output file on every commit, or of
+# `h5py.File.close`, before a written segment or output file is flushed
+KILL_SCRIPT = """
+import os, sys
+import h5py
+import generate
+
+function, count = sys.argv[1], int(sys.argv[2])
+module, name = (os, 'replace') if function == 'replace' else (h5py.File, 'close')
+original, calls = getattr(module, name), []
+
+def killing(*args, **kwargs):
+    calls.append(None)
+    if len(calls) == count: os._exit(KILLED)
+    return original(*args, **kwargs)
+
+setattr(module, name, killing)
+sys.argv = ['generate.py'] + sys.argv[3:]
+generate.main()
+"""
+KILLED = 3
+
+def run_killed(data, out_path, function, count, *args):
+    """
+    Runs generation in a separate process, which is killed on the given call
+    of the provided function.
+    """
+
+    reads_path, truth_path, ref_path = data
+    argv = [
+        '--reads_path', reads_path, '--truth_genome_path', truth_path, '--ref_path', ref_path,
+        '--out_path', str(out_path), '--executor', 'thread', '--plan_regions', *args,
+    ]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    script = KILL_SCRIPT.replace('KILLED', str(KILLED))
+    process = subprocess.run([sys.executable, '-c', script, function, str(count), *argv], env=env, capture_output=True)
+    assert process.returncode == KILLED, process.stderr.decode()
+
+def read_windows(path):
+    """
+    Returns contigs and first positions of all windows in the file.
+    """
+
+    windows = []
+    with h5py.File(path, 'r') as f:
+        for name in f['info']['groups'].asstr()[()]:
+            group = f[name]
+            starts = group['positions'][:, 0, :]
+            windows.extend((group.attrs['contig'], int(p), int(i)) for p, i in starts)
+    return windows
+
+def test_resume_with_different_number_of_workers(data, tmp_path, monkeypatch):
+    run(data, tmp_path / 'expected.hdf5', '--num_workers', '3')
+    expected = read_windows(tmp_path / 'expected.hdf5')
+
+    out_path = tmp_path / 'out.hdf5'
+    run_interrupted(data, out_path, monkeypatch, '--num_workers', '3')
+    with h5py.File(out_path, 'r') as f:
+        regions = list(f['info']['regions'].asstr()[()])
+        completed = set(f['info']['completed'].asstr()[()])
+    assert 0 < len(completed) < len(regions)
+
+    run(data, out_path, '--num_workers', '1', '--resume')
+    with h5py.File(out_path, 'r') as f:
+        assert list(f['info']['regions'].asstr()[()]) == regions
+        assert set(f['info']['completed'].asstr()[()]) == set(regions)
+
+    # consecutive regions overlap, so windows are compared with those of an
+    # uninterrupted run instead of being unique
+    assert sorted(read_windows(out_path)) == sorted(expected)
+
+def test_resume_without_stored_regions_planned_differently(data, tmp_path, monkeypatch):
+    out_path = tmp_path / 'out.hdf5'
+    run_interrupted(data, out_path, monkeypatch, '--num_workers', '3')
+
+    # files written before regions were stored
+    with h5py.File(out_path, 'a') as f:
+        del f['info']['regions'], f['info']['region_costs']
+
+    with pytest.raises(ValueError):
+        run(data, out_path, '--num_workers', '1', '--resume')
+
+@pytest.mark.parametrize('args', [('--executor', 'thread'), ('--executor', 'thread', '--shards'), ('--executor', 'process', '--shards')])
+def test_streamed_batches_match_collected_results(data, tmp_path, args):
+    run(data, tmp_path / 'expected.hdf5', '--num_workers', '2', '--executor', 'process')
+
+    # shards list groups in the order in which regions are finished
+    run(data, tmp_path / 'out.hdf5', '--num_workers', '2', *args)
+    assert sorted(read_windows(tmp_path / 'out.hdf5')) == sorted(read_windows(tmp_path / 'expected.hdf5'))
+
+def linked_files(path):
+    """
+    Returns names of segment files linked from the file, by external links
+    or virtual datasets.
+    """
+
+    linked = set()
+    with h5py.File(path, 'r') as f:
+        for name in f:
+            link = f.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                linked.add(link.filename)
+                continue
+
+            for dataset in f[name].values():
+                if dataset.is_virtual: linked.update(source.file_name for source in dataset.virtual_sources())
+    return {os.path.basename(file_name) for file_name in linked}
+
+# commits are the first three, of an empty file, contigs and regions, and
+# the ones of every write, each preceded by closing its segment file
+@pytest.mark.parametrize('function, count, args', [
+    ('replace', 4, ()),
+    ('replace', 5, ()),
+    ('close', 5, ()),
+    ('close', 6, ()),
+    ('close', 8, ()),
+    ('replace', 5, ('--layout', 'contigs')),
+    ('close', 8, ('--shards',)),
+])
+def test_resume_after_kill_during_commit(data, tmp_path, function, count, args):
+    run(data, tmp_path / 'expected.hdf5', '--num_workers', '3', *args)
+    expected = read_windows(tmp_path / 'expected.hdf5')
+
+    out_path = tmp_path / 'out.hdf5'
+    run_killed(data, out_path, function, count, '--num_workers', '3', *args)
+
+    # the file of the last commit is left behind and can be read
+    with h5py.File(out_path, 'r') as f:
+        regions = list(f['info']['regions'].asstr()[()])
+        completed = set(f['info']['completed'].asstr()[()])
+    assert completed.issubset(regions) and len(completed) < len(regions)
+    read_windows(out_path)
+
+    run(data, out_path, '--num_workers', '3', '--resume', *args)
+    with h5py.File(out_path, 'r') as f:
+        assert set(f['info']['completed'].asstr()[()]) == set(regions)
+    assert sorted(read_windows(out_path)) == sorted(expected)
+
+    # segment files written after the last commit are removed
+    assert set(os.listdir(f'{out_path}.segments')) == linked_files(out_path)
@@ -11,8 +11,8 @@ PATIENCE = 7
 N_GPU = 1
 
 def train(args):
-    model = RNN()
     data_module = DataModule(args)
+    model = RNN(rows=data_module.geometry.rows, cols=data_module.geometry.cols)
 
     callbacks_list = None
     if args.val_path: